@@ -7,10 +7,10 @@ param(
 . (Join-Path $workingDir "KeyCloakUtils.ps1")
 
 try {
-    Get-Command -ErrorAction Stop jq | Out-Null
+    Get-Command -ErrorAction Stop python | Out-Null
 }
 catch [System.Management.Automation.CommandNotFoundException] {
-    throw "jq (https://stedolan.github.io/jq/) is not on the path, but is required for proper operation. Please install with Chocolatey or Scoop and try again."
+    throw "python 3 (https://www.python.org/downloads/) is not on the path, but is required for proper operation. Please install with Chocolatey or Scoop and try again."
 }
 
 $importDir = Join-Path $workingDir "import/variants/$containerName"
@@ -25,6 +25,6 @@ Write-Host "Exporting KeyCloak configuration to $importDir."
 Invoke-KeyCloakMigration -action "export" -composeFilePath $composeFilePath -showOutput $showOutput -containerName $containerName
 
 Write-Host "Sorting export files."
-Get-ChildItem -Path $importDir -File | ForEach-Object {
-    Get-Content $_.FullName | jq -S -f (Join-Path $workingDir "exportProcessing.jq") | Set-Content $_.FullName
-}
+$exportFiles = Get-ChildItem -Path $importDir -File | ForEach-Object { $_.FullName }
+python (Join-Path $workingDir "aws-inf/realm_canonicalize.py") @exportFiles
+if ($LASTEXITCODE -ne 0) { throw "Sorting export files failed." }
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import os, json, shutil, argparse, tempfile
+from realm_stream import JsonStream, DEFAULT_CHUNK_SIZE
+
+# Puts a keycloak export into a stable form so re-exporting an unchanged realm gives the same file:
+# the generated KeyProvider components are dropped, object keys are sorted and every array is sorted.
+# This used to be `jq -S -f exportProcessing.jq` (del the KeyProviders then walk/sort). Arrays of
+# objects are now ordered by the first identity key they have instead of by their whole content, which
+# is both cheaper and keeps an entity in the same spot when something inside it changes. Objects with
+# none of the keys (authenticationExecutions...) or sharing an identity fall back to their content.
+IDENTITY_KEYS = ['id', 'alias', 'clientId', 'name']
+GENERATED_COMPONENTS = ['org.keycloak.keys.KeyProvider']
+
+def _type_rank(value) -> int:
+    # jq's ordering of types: null < false < true < numbers < strings < arrays < objects
+    if value is None:
+        return 0
+    if value is False:
+        return 1
+    if value is True:
+        return 2
+    if isinstance(value, (int, float)):
+        return 3
+    if isinstance(value, str):
+        return 4
+    if isinstance(value, list):
+        return 5
+    return 6
+
+def _canonical_text(value) -> str:
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+def _sort_key(value) -> tuple:
+    rank = _type_rank(value)
+    if rank < 3:
+        return (rank, )
+    if rank < 5:
+        return (rank, value)
+    if rank == 6:
+        for index, key in enumerate(IDENTITY_KEYS):
+            identity = value.get(key)
+            if identity is not None and _type_rank(identity) in (3, 4):
+                return (rank, index, _type_rank(identity), identity)
+    return (rank, len(IDENTITY_KEYS), 0, _canonical_text(value))
+
+def sort_array(items: list) -> list:
+    keys = [ _sort_key(item) for item in items ]
+    # two entries with the same identity (or a plain duplicate) are put in content order too so the
+    # result never depends on the order things came out of keycloak in
+    if len(set(keys)) < len(keys):
+        keys = [ key + (_canonical_text(item), ) for key, item in zip(keys, items) ]
+    return [ item for _, item in sorted(zip(keys, items), key=lambda pair: pair[0]) ]
+
+def canonicalize(value):
+    if isinstance(value, dict):
+        return { key: canonicalize(item) for key, item in value.items() }
+    if isinstance(value, list):
+        return sort_array([ canonicalize(item) for item in value ])
+    return value
+
+def drop_generated_components(components) -> None:
+    if isinstance(components, dict):
+        for component in GENERATED_COMPONENTS:
+            components.pop(component, None)
+
+def canonicalize_realm(realm_dict: dict) -> dict:
+    drop_generated_components(realm_dict.get('components'))
+    return canonicalize(realm_dict)
+
+def _dump(value, level: int) -> str:
+    # the layout jq -S gave: two space indent, sorted keys, utf-8 left as is
+    return json.dumps(value, indent=2, sort_keys=True, ensure_ascii=False).replace('\n', '\n' + '  ' * level)
+
+def _canonical_section(stream: JsonStream, key: str) -> str:
+    if key != 'components' and stream.peek() == '[':
+        # big top level arrays (users) are canonicalized an element at a time and only their text kept
+        elements = [ ]
+        for element, _ in stream.iter_array():
+            element = canonicalize(element)
+            elements.append((_sort_key(element), _dump(element, 2)))
+        if len(set(key for key, _ in elements)) < len(elements):
+            # same tie break as sort_array; rare enough that reparsing the text beats keeping every element
+            elements = [ (key + (_canonical_text(json.loads(text)), ), text) for key, text in elements ]
+        elements.sort(key=lambda element: element[0])
+        if not elements:
+            return '[]'
+        return '[\n    ' + ',\n    '.join([ text for _, text in elements ]) + '\n  ]'
+    value, _ = stream.read_value()
+    if key == 'components':
+        drop_generated_components(value)
+    return _dump(canonicalize(value), 1)
+
+# Canonicalizes a realm (or users) export a top level section at a time; only the canonical text of
+# each section is held on to until the file's written out with its keys in order
+def canonicalize_realm_file(file_path: str, output_path: str = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+    output_path = output_path or file_path
+    print(f"Canonicalizing realm export {file_path} to {output_path}")
+    with open(file_path, encoding='utf-8') as f:
+        stream = JsonStream(f, chunk_size)
+        if stream.peek() != '{':
+            value, _ = stream.read_value()
+            text = _dump(canonicalize(value), 0)
+        else:
+            sections = { key: _canonical_section(stream, key) for key in stream.iter_object_keys() }
+            members = [ f"{json.dumps(key, ensure_ascii=False)}: {sections[key]}" for key in sorted(sections) ]
+            text = '{\n  ' + ',\n  '.join(members) + '\n}' if members else '{}'
+    directory = os.path.dirname(os.path.abspath(output_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.realm-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(text + '\n')
+        if os.path.exists(output_path):
+            shutil.copymode(output_path, temp_path)
+        else:
+            os.chmod(temp_path, 0o644)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+if __name__== "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", type=str, nargs='+', help="Realm/user export files to canonicalize in place")
+    parser.add_argument("-o", "--output-file", type=str, help="File to write the canonical json to instead (single input only)")
+    args = parser.parse_args()
+    if args.output_file and len(args.files) > 1:
+        parser.error("-o/--output-file only works with a single input file")
+    for file_path in args.files:
+        canonicalize_realm_file(file_path, args.output_file)
@@ -0,0 +1,195 @@
+import os, re, json, glob
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+from realm_stream import load_realm_sections, write_realm_file
+from realm_transform import RealmDocument, apply_sso_metadata, disable_user, update_client_properties, update_csp_header
+from saml_metadata import SamlIdpMetadata, SamlMetadataResolver, saml_metadata_resolver
+
+DEFAULT_PLAN_WORKERS = 4
+PLAN_ENTRY_KEYS = ['files', 'outputDir', 'disableUsers', 'identityProviders', 'cspHeader', 'clients']
+UNRESOLVED_VAR = re.compile(r'\$\{?[A-Za-z_][A-Za-z0-9_]*\}?')
+
+# A plan is a list of transforms to run against realm files:
+# {
+#   "transforms": [
+#     {
+#       "files"            : [ "import/variants/*/navex-realm.json" ],  # paths/globs, relative to the working dir
+#       "outputDir"        : "transformed-import",                      # optional; files are always updated in place too
+#       "disableUsers"     : true,
+#       "identityProviders": [ { "alias": "doorman", "metadataUrl": "${DoormanMetadataUrl}" } ],
+#       "cspHeader"        : { "domains": "${NavexRootDomains}", "wildcardPrefix": true },
+#       "clients"          : [ { "clientId": "appshell", "property": "redirectUris", "values": [ "..." ], "append": false } ]
+#     }
+#   ]
+# }
+# Strings get ${EnvVar}s filled in from the environment. Entries hitting the same file are merged so
+# every file is loaded and written once. Transforms of the same kind run in the order they're listed;
+# the kinds run in the same order as a single realm_transform run (users, sso, csp header, clients).
+
+def load_plan_file(file_path: str) -> dict:
+    print(f"Loading transform plan from {file_path}")
+    with open(file_path) as f:
+        if file_path.endswith(('.yml', '.yaml')):
+            # only needed for yaml plans so it isn't a hard requirement of the script
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+def expand_plan_vars(value, errors: List[str]):
+    if isinstance(value, dict):
+        return { k: expand_plan_vars(v, errors) for k, v in value.items() }
+    if isinstance(value, list):
+        return [ expand_plan_vars(v, errors) for v in value ]
+    if isinstance(value, str):
+        expanded = os.path.expandvars(value)
+        for unresolved in UNRESOLVED_VAR.findall(expanded):
+            errors.append(f"{unresolved} in '{value}' isn't set in the environment")
+        return expanded
+    return value
+
+def _as_list(value) -> list:
+    return value if isinstance(value, list) else [value]
+
+# Everything a plan does to one realm file
+class RealmFilePlan( ):
+    def __init__(self, realm_file: str):
+        self.realm_file = realm_file
+        self.output_paths = [ realm_file ]
+        self.disable_users = False
+        self.identity_providers = [ ]
+        self.csp_header = None
+        self.client_updates = [ ]
+
+    def sections(self) -> List[str]:
+        # users aren't loaded; they're streamed through disable_user when the file's written
+        sections = [ ]
+        if self.identity_providers:
+            sections.append('identityProviders')
+        if self.csp_header:
+            sections.append('browserSecurityHeaders')
+        if self.client_updates:
+            sections.append('clients')
+        return sections
+
+    def validate(self) -> List[str]:
+        try:
+            realm = RealmDocument(load_realm_sections(self.realm_file, self.sections()))
+        except (OSError, ValueError) as e:
+            return [ f"{self.realm_file}: can't be read: {e}" ]
+        errors = [ ]
+        for idp in self.identity_providers:
+            if not realm.has_identity_provider(idp['alias']):
+                errors.append(f"{self.realm_file}: no identityProvider with alias {idp['alias']}")
+        if self.csp_header and 'browserSecurityHeaders' not in realm.realm_dict:
+            errors.append(f"{self.realm_file}: no browserSecurityHeaders to set the CSP header on")
+        for client_id, property, _, _ in self.client_updates:
+            if not realm.has_client(client_id):
+                errors.append(f"{self.realm_file}: no client with clientId {client_id}")
+            elif property not in realm.client(client_id):
+                errors.append(f"{self.realm_file}: client {client_id} has no property {property}")
+        return errors
+
+    def apply(self) -> None:
+        sections = self.sections()
+        realm = RealmDocument(load_realm_sections(self.realm_file, sections))
+        print(f"Transforming keycloak v{realm.realm_dict.get('keycloakVersion')} realm file: {self.realm_file}")
+        for idp in self.identity_providers:
+            # fetched for the whole plan up front; see run_plan
+            apply_sso_metadata(realm, idp['alias'], SamlIdpMetadata.from_dict(idp['metadata']))
+        if self.csp_header:
+            update_csp_header(realm, self.csp_header['domains'], self.csp_header['wildcardPrefix'])
+        if self.client_updates:
+            update_client_properties(realm, self.client_updates)
+        element_transforms = { 'users': disable_user } if self.disable_users else { }
+        write_realm_file(self.realm_file, self.output_paths, { section: realm.realm_dict[section] for section in sections }, element_transforms)
+
+# Checks the shape of the plan and turns it into one RealmFilePlan per file. Every problem found is
+# reported in one go rather than one per run.
+def build_file_plans(plan: dict) -> List[RealmFilePlan]:
+    errors = [ ]
+    plan = expand_plan_vars(plan, errors)
+    file_plans = { }
+    outputs = { }
+    entries = plan.get('transforms') if isinstance(plan, dict) else None
+    if not isinstance(entries, list) or not entries:
+        raise RuntimeError("Transform plan needs a non empty 'transforms' list")
+    for index, entry in enumerate(entries):
+        name = f"transforms[{index}]"
+        if not isinstance(entry, dict):
+            errors.append(f"{name}: expected an object; got {entry}")
+            continue
+        unknown = [ key for key in entry if key not in PLAN_ENTRY_KEYS ]
+        if unknown:
+            errors.append(f"{name}: unknown keys {unknown}; expected some of {PLAN_ENTRY_KEYS}")
+        realm_files = [ ]
+        for pattern in _as_list(entry.get('files', [])):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                errors.append(f"{name}: no realm files match {pattern}")
+            realm_files.extend(matches)
+        if not realm_files:
+            errors.append(f"{name}: no files to transform")
+        for idp in _as_list(entry.get('identityProviders', [])):
+            if not isinstance(idp, dict) or not idp.get('alias') or not idp.get('metadataUrl'):
+                errors.append(f"{name}: identityProviders need an alias and a metadataUrl; got {idp}")
+        csp_header = entry.get('cspHeader')
+        if csp_header is not None:
+            if not isinstance(csp_header, dict) or not csp_header.get('domains'):
+                errors.append(f"{name}: cspHeader needs a list (or comma delimited string) of domains; got {csp_header}")
+                csp_header = None
+            else:
+                # same handling as --csp-header
+                domains = csp_header['domains'].split(',') if isinstance(csp_header['domains'], str) else csp_header['domains']
+                csp_header = { 'domains': [ d.lower() for d in domains ], 'wildcardPrefix': bool(csp_header.get('wildcardPrefix')) }
+        client_updates = [ ]
+        for client in _as_list(entry.get('clients', [])):
+            if not isinstance(client, dict) or not client.get('clientId') or not client.get('property') or 'values' not in client:
+                errors.append(f"{name}: clients need a clientId, property and values; got {client}")
+                continue
+            client_updates.append((client['clientId'], client['property'], _as_list(client['values']), bool(client.get('append'))))
+        for realm_file in realm_files:
+            file_plan = file_plans.setdefault(os.path.normpath(realm_file), RealmFilePlan(realm_file))
+            file_plan.disable_users = file_plan.disable_users or bool(entry.get('disableUsers'))
+            file_plan.identity_providers.extend([ idp for idp in _as_list(entry.get('identityProviders', [])) if isinstance(idp, dict) ])
+            if csp_header:
+                file_plan.csp_header = csp_header
+            file_plan.client_updates.extend(client_updates)
+            if entry.get('outputDir'):
+                output_path = os.path.join(entry['outputDir'], os.path.basename(realm_file))
+                if outputs.setdefault(os.path.normpath(output_path), realm_file) != realm_file:
+                    errors.append(f"{name}: {realm_file} and {outputs[os.path.normpath(output_path)]} would both be written to {output_path}")
+                elif output_path not in file_plan.output_paths:
+                    file_plan.output_paths.append(output_path)
+    if errors:
+        raise RuntimeError("Transform plan is invalid:\n  " + "\n  ".join(errors))
+    return list(file_plans.values())
+
+def _validate_file_plan(file_plan: RealmFilePlan) -> List[str]:
+    return file_plan.validate()
+
+def _apply_file_plan(file_plan: RealmFilePlan) -> str:
+    file_plan.apply()
+    return file_plan.realm_file
+
+def _map_file_plans(func, file_plans: List[RealmFilePlan], workers: int) -> list:
+    # a process each so the json work on separate files actually runs side by side
+    if workers <= 1 or len(file_plans) == 1:
+        return [ func(file_plan) for file_plan in file_plans ]
+    with ProcessPoolExecutor(max_workers=min(workers, len(file_plans))) as executor:
+        return list(executor.map(func, file_plans))
+
+# Checks every target in every file exists and fetches every idp's metadata (each url once, all at
+# the same time) before changing any of them, then transforms the files
+def run_plan(plan_file: str, workers: int = DEFAULT_PLAN_WORKERS, resolver: SamlMetadataResolver = None) -> None:
+    file_plans = build_file_plans(load_plan_file(plan_file))
+    print(f"Validating transform plan against {len(file_plans)} realm file(s)...")
+    errors = [ error for file_errors in _map_file_plans(_validate_file_plan, file_plans, workers) for error in file_errors ]
+    if errors:
+        raise RuntimeError("Transform plan targets missing from realm files:\n  " + "\n  ".join(errors))
+    idps = [ idp for file_plan in file_plans for idp in file_plan.identity_providers ]
+    if idps:
+        metadata = (resolver or saml_metadata_resolver).resolve_many([ idp['metadataUrl'] for idp in idps ])
+        for idp in idps:
+            idp['metadata'] = metadata[idp['metadataUrl']].to_dict()
+    for realm_file in _map_file_plans(_apply_file_plan, file_plans, workers):
+        print(f"Finished transforming {realm_file}")
@@ -0,0 +1,191 @@
+import os, json, shutil, tempfile
+from typing import Callable, Dict, Iterator, List, Tuple
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+JSON_WHITESPACE = ' \t\n\r'
+# what can come after a value; a number cut off by the end of the buffer ("1" of "1e5") decodes fine
+# but won't be followed by one of these until the rest of it has been read
+JSON_VALUE_ENDS = JSON_WHITESPACE + ',:]}'
+
+# Reads a json document off a file a value at a time. Only what's been read and not consumed yet is
+# kept around, so walking a realm export one top level section (or one array element) at a time
+# never holds more than that section/element in memory. Values are decoded with the stdlib decoder;
+# their source text comes back with them so untouched values can be copied through byte for byte.
+class JsonStream( ):
+    def __init__(self, f, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size: int = None) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in JSON_WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char: str) -> None:
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected '{char}' but found '{found or 'end of file'}' while streaming realm json")
+        self.pos += 1
+
+    def read_value(self) -> Tuple[object, str]:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in JSON_VALUE_ENDS):
+                    break
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # grow by at least what's buffered so one big value costs a few reparses, not one per chunk
+            if not self._fill(max(self.chunk_size, len(self.buffer) - self.pos)):
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                break
+        raw = self.buffer[self.pos:end]
+        self.pos = end
+        return value, raw
+
+    # yields (value, raw text) for each element of the array the stream is sitting on
+    def iter_array(self) -> Iterator[Tuple[object, str]]:
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            if self.peek() == ',':
+                self.pos += 1
+                continue
+            self.expect(']')
+            return
+
+    # yields each top level key; the caller has to consume its value (read_value/iter_array) before the next one
+    def iter_object_keys(self) -> Iterator[str]:
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key, _ = self.read_value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+                continue
+            self.expect('}')
+            return
+
+def _indent(text: str, level: int) -> str:
+    # json.dumps never leaves a raw newline inside a string so this only touches the layout
+    return text.replace('\n', '\n' + '  ' * level)
+
+def _dump(value, level: int) -> str:
+    return _indent(json.dumps(value, indent=2), level)
+
+# Top level scalars plus the named sections of a realm export. Everything else is skipped over
+# without being kept; arrays are stepped through an element at a time.
+def load_realm_sections(file_path: str, sections: List[str], chunk_size: int = DEFAULT_CHUNK_SIZE) -> dict:
+    print(f"Loading sections {sections} from realm file {file_path}")
+    realm_dict = { }
+    with open(file_path, encoding='utf-8') as f:
+        stream = JsonStream(f, chunk_size)
+        for key in stream.iter_object_keys():
+            if key in sections:
+                realm_dict[key], _ = stream.read_value()
+            elif stream.peek() == '[':
+                for _ in stream.iter_array():
+                    pass
+            else:
+                value, _ = stream.read_value()
+                if not isinstance(value, (dict, list)):
+                    realm_dict[key] = value
+    return realm_dict
+
+def _write_all(files: list, text: str) -> None:
+    for f in files:
+        f.write(text)
+
+# Writes the realm in file_path back out to every path in output_paths in one pass over it:
+#  - sections in replaced_sections are written from the given values
+#  - arrays in element_transforms are streamed through, each element handed to the function; it
+#    changes the element in place and returns True if it did, otherwise the source text is kept
+#  - everything else is copied through as it is in the source
+# Outputs are written next to their destination and moved into place once all of them are complete,
+# so writing over the source file (or dying half way) never leaves a partial realm behind. Layout
+# matches json.dump(indent=2) for everything that's written from a value.
+def write_realm_file(file_path: str, output_paths: List[str], replaced_sections: Dict[str, object] = None,
+                     element_transforms: Dict[str, Callable[[dict], bool]] = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+    replaced_sections = replaced_sections or { }
+    element_transforms = element_transforms or { }
+    output_paths = list(dict.fromkeys(output_paths))
+    print(f"Writing realm file {file_path} to {output_paths}; rewriting sections {sorted(set(replaced_sections) | set(element_transforms))}")
+    temp_paths = [ ]
+    outputs = [ ]
+    try:
+        for output_path in output_paths:
+            directory = os.path.dirname(os.path.abspath(output_path))
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.realm-')
+            temp_paths.append(temp_path)
+            outputs.append(os.fdopen(fd, 'w', encoding='utf-8'))
+        with open(file_path, encoding='utf-8') as f:
+            stream = JsonStream(f, chunk_size)
+            written = set()
+            separator = '{\n  '
+            for key in stream.iter_object_keys():
+                written.add(key)
+                _write_all(outputs, f"{separator}{json.dumps(key)}: ")
+                separator = ',\n  '
+                if key in replaced_sections:
+                    stream.read_value()
+                    _write_all(outputs, _dump(replaced_sections[key], 1))
+                elif stream.peek() == '[':
+                    transform = element_transforms.get(key)
+                    element_separator = '[\n    '
+                    for element, raw in stream.iter_array():
+                        if transform and transform(element):
+                            raw = _dump(element, 2)
+                        _write_all(outputs, element_separator + raw)
+                        element_separator = ',\n    '
+                    _write_all(outputs, '[]' if element_separator == '[\n    ' else '\n  ]')
+                else:
+                    _, raw = stream.read_value()
+                    _write_all(outputs, raw)
+            # a replaced section the source didn't have yet goes on the end
+            for key in [ k for k in replaced_sections if k not in written ]:
+                _write_all(outputs, f"{separator}{json.dumps(key)}: {_dump(replaced_sections[key], 1)}")
+                separator = ',\n  '
+            _write_all(outputs, '{}' if separator == '{\n  ' else '\n}')
+        for output in outputs:
+            output.close()
+        for temp_path, output_path in zip(temp_paths, output_paths):
+            # mkstemp files are owner only; keep whatever the file being replaced had
+            if os.path.exists(output_path):
+                shutil.copymode(output_path, temp_path)
+            else:
+                os.chmod(temp_path, 0o644)
+            os.replace(temp_path, output_path)
+        temp_paths = [ ]
+    finally:
+        for output in outputs:
+            output.close()
+        for temp_path in temp_paths:
+            os.remove(temp_path)
@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 
 import argparse,json
-from urllib3 import PoolManager
-from xml.etree.ElementTree import fromstring as xml_fromstring
-from typing import List
+from typing import List, Tuple, Union
+from realm_stream import load_realm_sections, write_realm_file
+from saml_metadata import SamlIdpMetadata, SamlMetadataResolver, saml_metadata_resolver
 
 
 def load_json_file(file_path: str) -> dict:
@@ -16,10 +16,57 @@ def save_dict_as_json(file_path: str, dictionary: dict) -> None:
     with open(file_path, 'w') as f:
         json.dump(dictionary, f, indent=2)
 
-def update_client_property(realm_dict: dict, client_id: str, property: str, value: List[str], append: bool) -> None:
+# Wraps a loaded realm dict with lookups by clientId/client id, idp alias and username. Each index
+# is built the first time it's needed and reused after that, so a run doing lots of transforms pays
+# for one pass over clients/users instead of one per transform. The dicts handed back are the ones in
+# the realm dict, so changing them changes the realm.
+class RealmDocument( ):
+    def __init__(self, realm_dict: dict):
+        self.realm_dict = realm_dict
+        self._indexes = { }
+
+    def _index(self, section: str, key: str) -> dict:
+        if (section, key) not in self._indexes:
+            self._indexes[(section, key)] = { item[key]: item for item in self.realm_dict.get(section, []) if key in item }
+        return self._indexes[(section, key)]
+
+    def _lookup(self, section: str, key: str, value: str) -> dict:
+        try:
+            return self._index(section, key)[value]
+        except KeyError:
+            raise RuntimeError(f"No entry in {section} with {key} {value} in realm file") from None
+
+    def client(self, client_id: str) -> dict:
+        return self._lookup('clients', 'clientId', client_id)
+
+    def client_by_uuid(self, uuid: str) -> dict:
+        return self._lookup('clients', 'id', uuid)
+
+    def identity_provider(self, alias: str) -> dict:
+        return self._lookup('identityProviders', 'alias', alias)
+
+    def user(self, username: str) -> dict:
+        return self._lookup('users', 'username', username)
+
+    def users_with_credentials(self) -> List[dict]:
+        if ('users', 'credentials') not in self._indexes:
+            self._indexes[('users', 'credentials')] = [ user for user in self.realm_dict.get('users', []) if user.get('credentials') ]
+        return self._indexes[('users', 'credentials')]
+
+    def has_client(self, client_id: str) -> bool:
+        return client_id in self._index('clients', 'clientId')
+
+    def has_identity_provider(self, alias: str) -> bool:
+        return alias in self._index('identityProviders', 'alias')
+
+# the transforms take either; wrapping a plain dict is cheap since nothing gets indexed until it's used
+def as_realm_document(realm: Union[dict, RealmDocument]) -> RealmDocument:
+    return realm if isinstance(realm, RealmDocument) else RealmDocument(realm)
+
+def update_client_property(realm_dict: Union[dict, RealmDocument], client_id: str, property: str, value: List[str], append: bool) -> None:
     value = value if isinstance(value, list) else [value]
     print(f"Searching for client id {client_id} in realm file...")
-    client = next( c for c in realm_dict['clients'] if c['clientId'] == client_id )
+    client = as_realm_document(realm_dict).client(client_id)
     is_prop_list = isinstance(client[property], list)
     if not is_prop_list and len(value) < 2:
         print(f"Setting {client_id}.{property} to: {value[0]}")
@@ -34,28 +81,39 @@ def update_client_property(realm_dict: dict, client_id: str, property: str, valu
         raise RuntimeError(f"append=True specified but {property} is not an array on the client object")
     elif not is_prop_list and len(value) > 1:
         raise RuntimeError(f"Multiple values passed in for client property {property} that is not a list")
-        
 
-def update_sso_config(realm_dict: dict, idp_alias: str, metadata_url: str) -> None:
-    http = PoolManager(cert_reqs='CERT_NONE', assert_hostname=False)
-    print(f"Fetching metadata xml from: {metadata_url}")
-    
-    metadata_xml_string = http.request('GET', metadata_url).data.decode('utf-8')
-    xml = xml_fromstring(metadata_xml_string)
-    cert = xml.find('.//{http://www.w3.org/2000/09/xmldsig#}X509Certificate').text
-    ss_out_uri = xml.find('.//{urn:oasis:names:tc:SAML:2.0:metadata}SingleLogoutService').attrib['Location']
-    ss_in_uri = xml.find('.//{urn:oasis:names:tc:SAML:2.0:metadata}SingleSignOnService').attrib['Location']
+# (client_id, property, value(s), append) tuples. Every client is looked up before anything is
+# changed so a typo'd client id fails the run without leaving the realm half updated.
+def update_client_properties(realm_dict: Union[dict, RealmDocument], updates: List[Tuple[str, str, List[str], bool]]) -> None:
+    realm = as_realm_document(realm_dict)
+    missing = [ client_id for client_id, _, _, _ in updates if not realm.has_client(client_id) ]
+    if missing:
+        raise RuntimeError(f"Client id(s) {missing} not found in realm file")
+    for client_id, property, value, append in updates:
+        update_client_property(realm, client_id, property, value, append)
+        
 
+def apply_sso_metadata(realm_dict: Union[dict, RealmDocument], idp_alias: str, metadata: SamlIdpMetadata) -> None:
     print(f"Searching for identityProvider with alias {idp_alias}...")
-    idp = next( i for i in realm_dict['identityProviders'] if i['alias'] == idp_alias )
-    print(f"Setting signingCertificate to: {cert}")
-    idp['config']['signingCertificate'] = cert
-    print(f"Setting singleLogoutServiceUrl to: {ss_out_uri}")
-    idp['config']['singleLogoutServiceUrl'] = ss_out_uri
-    print(f"Setting singleSignOnServiceUrl to: {ss_in_uri}")
-    idp['config']['singleSignOnServiceUrl'] = ss_in_uri
-    
-def update_csp_header(realm_dict: dict, domains: List[str], prepend_wildcard: bool = False) -> None:
+    idp = as_realm_document(realm_dict).identity_provider(idp_alias)
+    print(f"Setting signingCertificate to: {metadata.signing_certificate}")
+    idp['config']['signingCertificate'] = metadata.signing_certificate
+    print(f"Setting singleLogoutServiceUrl to: {metadata.single_logout_service_url}")
+    idp['config']['singleLogoutServiceUrl'] = metadata.single_logout_service_url
+    print(f"Setting singleSignOnServiceUrl to: {metadata.single_sign_on_service_url}")
+    idp['config']['singleSignOnServiceUrl'] = metadata.single_sign_on_service_url
+
+def update_sso_config(realm_dict: Union[dict, RealmDocument], idp_alias: str, metadata_url: str, resolver: SamlMetadataResolver = None) -> None:
+    metadata = (resolver or saml_metadata_resolver).resolve(metadata_url)
+    apply_sso_metadata(realm_dict, idp_alias, metadata)
+
+# (idp alias, metadata url) pairs; all the metadata is fetched at once before any idp is touched
+def update_sso_configs(realm_dict: Union[dict, RealmDocument], idps: List[Tuple[str, str]], resolver: SamlMetadataResolver = None) -> None:
+    metadata = (resolver or saml_metadata_resolver).resolve_many([ metadata_url for _, metadata_url in idps ])
+    for idp_alias, metadata_url in idps:
+        apply_sso_metadata(realm_dict, idp_alias, metadata[metadata_url])
+
+def update_csp_header(realm_dict: Union[dict, RealmDocument], domains: List[str], prepend_wildcard: bool = False) -> None:
     domains = domains if isinstance(domains, list) else [domains]
     domains = [d.strip() for d in domains]
     if prepend_wildcard:
@@ -63,17 +121,22 @@ def update_csp_header(realm_dict: dict, domains: List[str], prepend_wildcard: bo
         domains = [ f"*.{d}" for d in domains ]
     domain_str = f"frame-src 'self'; frame-ancestors 'self' {' '.join(domains)}; object-src 'none';"
     print(f"Setting contentSecurityPolicy to: {domain_str}")
-    realm_dict['browserSecurityHeaders']['contentSecurityPolicy'] = domain_str
+    as_realm_document(realm_dict).realm_dict['browserSecurityHeaders']['contentSecurityPolicy'] = domain_str
+
+def disable_user(user: dict) -> bool:
+    if not user.get('credentials'):
+        return False
+    print(f"Disabling user {user['username']}. FirstName '{user.get('firstName')}' LastName '{user.get('lastName')}'")
+    user['enabled'] = False
+    return True
 
-def disable_users(realm_dict: dict) -> None:
-    for user in realm_dict['users']:
-        if user['credentials']:
-            print(f"Disabling user {user['username']}. FirstName '{user.get('firstName')}' LastName '{user.get('lastName')}'")
-            user['enabled'] = False
+def disable_users(realm_dict: Union[dict, RealmDocument]) -> None:
+    for user in as_realm_document(realm_dict).users_with_credentials():
+        disable_user(user)
 
 if __name__== "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-r", "--realm-file", type=str, help="Path to realm file that needs to be transformed", required=True)
+    parser.add_argument("-r", "--realm-file", type=str, help="Path to realm file that needs to be transformed")
     parser.add_argument("-o", "--output-file", type=str, help="File to write transformed json to")
     parser.add_argument("-i", "--inplace-update", action='store_true', help="Save changes to realm file passed in")
 
@@ -81,6 +144,7 @@ if __name__== "__main__":
 
     parser.add_argument("--idp-alias", type=str, help="identityProviders alias to update sso config from metadata url", required=False)
     parser.add_argument("--idp-metadata-url", type=str, help="Url to metadata of identity provider", required=False)
+    parser.add_argument("--metadata-cache-dir", type=str, help="Directory to cache identity provider metadata in between runs (default: $SAML_METADATA_CACHE_DIR)", required=False)
     
     parser.add_argument("--csp-header", type=str.lower, help="Comma delimited list of allowed domains", required=False)
     parser.add_argument("--wildcard-prefix", action='store_true', help="Prefix each domain with a *", required=False)
@@ -90,31 +154,51 @@ if __name__== "__main__":
     parser.add_argument("-v", "--client-value", type=str, action='append', help="List of values to set for a client property", default=[])
     parser.add_argument("--append", action='store_true', help="Add onto existing list; if not supplied the list is replaced")
 
+    parser.add_argument("--plan", type=str, help="JSON/YAML plan file of transforms to apply to many realm files in one go (see realm_plan.py)")
+    parser.add_argument("--workers", type=int, help="Number of realm files a plan transforms at once", default=4)
+
     args = parser.parse_args()
-    
-    realm_dict = load_json_file(args.realm_file)
+    resolver = SamlMetadataResolver(args.metadata_cache_dir) if args.metadata_cache_dir else saml_metadata_resolver
+    if args.plan:
+        from realm_plan import run_plan
+        run_plan(args.plan, args.workers, resolver)
+        raise SystemExit(0)
+    if not args.realm_file:
+        parser.error("one of -r/--realm-file or --plan is required")
+
+    # only the sections a transform is going to change get loaded (and written back out); users are
+    # streamed through one at a time instead since that's the list that gets big
+    sections = [ ]
+    if args.idp_alias and args.idp_metadata_url:
+        sections.append('identityProviders')
+    if args.csp_header:
+        sections.append('browserSecurityHeaders')
+    if args.client_id and args.client_property and args.client_value:
+        sections.append('clients')
+    realm_dict = load_realm_sections(args.realm_file, sections)
+    realm = RealmDocument(realm_dict)
     print(f"Transforming keycloak v{realm_dict['keycloakVersion']} realm file: {args.realm_file}")
 
+    element_transforms = { }
     if args.disable_users:
-        print("Disabling hardcoded users from realm file...")
-        disable_users(realm_dict)
+        print("Disabling hardcoded users from realm file as it's written...")
+        element_transforms['users'] = disable_user
     if args.idp_alias and args.idp_metadata_url:
         print("Transforming sso config...")
-        update_sso_config(realm_dict, args.idp_alias, args.idp_metadata_url)
+        update_sso_config(realm, args.idp_alias, args.idp_metadata_url, resolver)
     else:
         print("Skipping sso config transform; required arguments not present")
     if args.csp_header:
         print("Transforming CSP header...")
-        update_csp_header(realm_dict, args.csp_header.split(','), args.wildcard_prefix)
+        update_csp_header(realm, args.csp_header.split(','), args.wildcard_prefix)
     else:
         print("Skipping CSP header transform; required arguments not present")
     if args.client_id and args.client_property and args.client_value:
         print("Transforming client property...")
-        update_client_property(realm_dict, args.client_id, args.client_property, args.client_value, args.append)
+        update_client_property(realm, args.client_id, args.client_property, args.client_value, args.append)
     else:
         print("Skipping client property transform; required arguments not present")
 
-    if args.output_file:
-        save_dict_as_json(args.output_file, realm_dict)
-    if args.inplace_update:
-        save_dict_as_json(args.realm_file, realm_dict)
\ No newline at end of file
+    output_paths = [ path for path, wanted in [ (args.output_file, args.output_file), (args.realm_file, args.inplace_update) ] if wanted ]
+    if output_paths:
+        write_realm_file(args.realm_file, output_paths, { section: realm_dict[section] for section in sections }, element_transforms)
\ No newline at end of file
@@ -0,0 +1,143 @@
+import os, io, json, time, hashlib, tempfile, threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib3 import PoolManager, Timeout
+from xml.etree.ElementTree import iterparse
+from typing import Dict, List
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_RETRIES = 2
+DEFAULT_MAX_WORKERS = 4
+
+DSIG_NS = '{http://www.w3.org/2000/09/xmldsig#}'
+SAML_METADATA_NS = '{urn:oasis:names:tc:SAML:2.0:metadata}'
+X509_CERTIFICATE = f"{DSIG_NS}X509Certificate"
+SINGLE_LOGOUT_SERVICE = f"{SAML_METADATA_NS}SingleLogoutService"
+SINGLE_SIGN_ON_SERVICE = f"{SAML_METADATA_NS}SingleSignOnService"
+
+# The bits of an IdP's SAML metadata keycloak's identityProvider config needs
+class SamlIdpMetadata( ):
+    def __init__(self, signing_certificate: str, single_logout_service_url: str, single_sign_on_service_url: str):
+        self.signing_certificate = signing_certificate
+        self.single_logout_service_url = single_logout_service_url
+        self.single_sign_on_service_url = single_sign_on_service_url
+    def to_dict(self):
+        return {
+            'signingCertificate'    : self.signing_certificate,
+            'singleLogoutServiceUrl': self.single_logout_service_url,
+            'singleSignOnServiceUrl': self.single_sign_on_service_url
+        }
+    @classmethod
+    def from_dict(cls, metadata: dict) -> 'SamlIdpMetadata':
+        return cls(metadata['signingCertificate'], metadata['singleLogoutServiceUrl'], metadata['singleSignOnServiceUrl'])
+
+# One walk over the document picking up the first certificate and SLO/SSO endpoints (document order,
+# same as the .// finds this replaces), stopping as soon as it has all three
+def parse_saml_metadata(metadata_xml: bytes) -> SamlIdpMetadata:
+    found = { }
+    for event, element in iterparse(io.BytesIO(metadata_xml), events=('start', 'end')):
+        if event == 'start' and element.tag in (SINGLE_LOGOUT_SERVICE, SINGLE_SIGN_ON_SERVICE) and element.tag not in found:
+            found[element.tag] = element.attrib['Location']
+        elif event == 'end' and element.tag == X509_CERTIFICATE and element.tag not in found:
+            found[element.tag] = element.text
+        if len(found) == 3:
+            break
+    missing = [ tag for tag in (X509_CERTIFICATE, SINGLE_LOGOUT_SERVICE, SINGLE_SIGN_ON_SERVICE) if tag not in found ]
+    if missing:
+        raise RuntimeError(f"SAML metadata is missing {missing}")
+    return SamlIdpMetadata(found[X509_CERTIFICATE], found[SINGLE_LOGOUT_SERVICE], found[SINGLE_SIGN_ON_SERVICE])
+
+# Fetches and parses IdP metadata over one shared connection pool. Answers are kept in memory for the
+# life of the resolver, and in cache_dir (when given) along with the ETag/Last-Modified they came with,
+# so the next build only asks the IdP whether the metadata changed and skips the download when it
+# hasn't. A failed fetch is an error rather than a fall back to the cache; a stale signing cert would
+# only show up later as broken logins.
+class SamlMetadataResolver( ):
+    def __init__(self, cache_dir: str = None, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT, read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 retries: int = DEFAULT_RETRIES, max_workers: int = DEFAULT_MAX_WORKERS, http: PoolManager = None):
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        # same as before; the metadata endpoints don't all have certs that verify
+        self.http = http or PoolManager(cert_reqs='CERT_NONE', assert_hostname=False, maxsize=max_workers,
+                                        timeout=Timeout(connect=connect_timeout, read=read_timeout), retries=retries)
+        self._resolved = { }
+        self._lock = threading.Lock()
+        self.stats = {'memoryHits': 0, 'notModified': 0, 'fetched': 0}
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _cache_path(self, url: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def _load_cached(self, url: str) -> dict:
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cache_path(url)) as f:
+                cached = json.load(f)
+            return cached if cached.get('url') == url else None
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError):
+            print(f"Cached metadata for {url} is unreadable; fetching it again")
+            return None
+
+    def _save_cached(self, url: str, cached: dict) -> None:
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.saml-metadata-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cached, f)
+        os.replace(temp_path, self._cache_path(url))
+
+    def resolve(self, url: str) -> SamlIdpMetadata:
+        with self._lock:
+            if url in self._resolved:
+                self.stats['memoryHits'] += 1
+                return self._resolved[url]
+        cached = self._load_cached(url)
+        headers = { }
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('lastModified'):
+            headers['If-Modified-Since'] = cached['lastModified']
+        print(f"Fetching metadata xml from: {url}{' (revalidating cached copy)' if headers else ''}")
+        response = self.http.request('GET', url, headers=headers)
+        if response.status == 304 and cached:
+            print(f"Metadata at {url} hasn't changed since {cached.get('lastModified') or cached.get('etag')}; using cached copy")
+            self._count('notModified')
+            metadata = SamlIdpMetadata.from_dict(cached['metadata'])
+        elif response.status == 200:
+            self._count('fetched')
+            metadata = parse_saml_metadata(response.data)
+            # nothing to revalidate with means nothing worth keeping
+            if response.headers.get('ETag') or response.headers.get('Last-Modified'):
+                self._save_cached(url, {
+                    'url'         : url,
+                    'etag'        : response.headers.get('ETag'),
+                    'lastModified': response.headers.get('Last-Modified'),
+                    'fetchedAt'   : time.time(),
+                    'metadata'    : metadata.to_dict()
+                })
+        else:
+            raise RuntimeError(f"Fetching SAML metadata from {url} failed with status {response.status}")
+        with self._lock:
+            self._resolved[url] = metadata
+        return metadata
+
+    def resolve_many(self, urls: List[str]) -> Dict[str, SamlIdpMetadata]:
+        urls = list(dict.fromkeys(urls))
+        if len(urls) <= 1:
+            return { url: self.resolve(url) for url in urls }
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls))) as executor:
+            return dict(zip(urls, executor.map(self.resolve, urls)))
+
+# module level so every transform in a run shares the pool (and what's already been resolved)
+saml_metadata_resolver = SamlMetadataResolver(os.environ.get('SAML_METADATA_CACHE_DIR'))
@@ -1,7 +1,13 @@
+# has to be first so the cold start import timing covers everything below
+from .startup import startup_profile
+
 from .lambda_handlers import (
     cwe_rotate_handler, 
     cp_post_deploy_handler, 
-    cwe_remove_duplicant_users_alarm_handler
+    cwe_remove_duplicant_users_alarm_handler,
+    realm_sync_handler
 )
 
 from .apiproxy import KeyCloakApiProxy
+
+startup_profile.mark_imported()
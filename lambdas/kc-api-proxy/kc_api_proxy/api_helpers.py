@@ -1,5 +1,8 @@
-import os, logging
+import os, time, logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 from .apiproxy import KeyCloakApiProxy
+from .rotation import SecretRotationEngine, DEFAULT_MAX_WORKERS, get_elapsed_ms
 
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
@@ -11,50 +14,70 @@ def assemble_ssm_path(ssm_prefix: str, realm_name: str, client_id: str) -> str:
     # template has the dep around granting lambda role privs for the admin client
     return '/'.join([ssm_prefix, realm_name, client_id])
 
-def clear_all_realms_cache(kc: KeyCloakApiProxy):
-    realms = kc.get_realms()
-    for realm in realms:
-        realm_name = realm['realm']
-        kc.clear_realm_cache(realm_name)
-
-def clear_all_users_cache(kc: KeyCloakApiProxy):
-    realms = kc.get_realms()
-    for realm in realms:
-        realm_name = realm['realm']
-        kc.clear_user_cache(realm_name)
-
-def rotate_and_store_client_secrets(kc: KeyCloakApiProxy, ssm_client, sns_client, ssm_prefix: str, sns_topicarn: str):
-    realms = kc.get_realms()
-    for realm in realms:
-        realm_name = realm['realm']
-        confidential_clients = [ client for client in kc.get_clients(realm_name) if not client['publicClient'] and not client['bearerOnly'] ]
-        for client in confidential_clients:
-            secret = kc.rotate_secret(realm_name, client['id'])
-            ssm_path = assemble_ssm_path(ssm_prefix, realm_name, client['clientId'])
-            logger.info(f"Persisting rotated secret for {client['clientId']} ({client['id']}) to {ssm_path}")
-            ssm_client.put_parameter(
-                Name=ssm_path, 
-                Description='Keycloak client secret source of truth',
-                Value=secret['value'],
-                Type='SecureString',
-                Overwrite=True
-            )
-
-            sns_client.publish(
-                TopicArn=sns_topicarn,
-                Message='A Keycloak secret has been rotated',
-                MessageAttributes={
-                    'realmName': {
-                        'DataType': 'String',
-                        'StringValue': realm_name
-                    },
-                    'clientId': {
-                        'DataType': 'String',
-                        'StringValue': client['clientId']
-                    },
-                    'ssmPath': {
-                        'DataType': 'String',
-                        'StringValue': ssm_path
-                    }
-                },
-            )
+REALM_CACHE = 'realm'
+USER_CACHE = 'user'
+
+# Clears realm/user caches across every realm concurrently. The realm list is only fetched once
+# and a realm's cache isn't cleared again until something marks it dirty, so the handlers can
+# ask for "clear everything" as often as they like within one invocation.
+class CacheInvalidator( ):
+    def __init__(self, kc: KeyCloakApiProxy, max_workers: int = DEFAULT_MAX_WORKERS):
+        self.kc = kc
+        self.max_workers = max_workers
+        self._realm_names = None
+        self._cleared = set()
+        self.latencies = { }
+
+    def get_realm_names(self) -> List[str]:
+        if self._realm_names is None:
+            self._realm_names = [ realm['realm'] for realm in self.kc.get_realms() ]
+        return self._realm_names
+
+    def mark_dirty(self, realm_names: List[str] = None) -> None:
+        realm_names = self.get_realm_names() if realm_names is None else realm_names
+        self._cleared -= { (cache, realm_name) for cache in [REALM_CACHE, USER_CACHE] for realm_name in realm_names }
+
+    def _clear(self, cache: str, realm_name: str) -> int:
+        start = time.monotonic()
+        if cache == REALM_CACHE:
+            self.kc.clear_realm_cache(realm_name)
+        else:
+            self.kc.clear_user_cache(realm_name)
+        elapsed_ms = get_elapsed_ms(start)
+        self.latencies.setdefault(realm_name, { })[f"{cache}CacheMs"] = elapsed_ms
+        return elapsed_ms
+
+    def clear(self, cache: str, realm_names: List[str] = None) -> dict:
+        realm_names = self.get_realm_names() if realm_names is None else realm_names
+        pending = [ realm_name for realm_name in dict.fromkeys(realm_names) if (cache, realm_name) not in self._cleared ]
+        if not pending:
+            logger.info(f"{cache} cache already cleared for {realm_names} this invocation; skipping")
+            return { }
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending)), thread_name_prefix='kc-cache') as pool:
+            # map re-raises the first failure once everything has finished
+            latencies = dict(zip(pending, pool.map(lambda realm_name: self._clear(cache, realm_name), pending)))
+        self._cleared |= { (cache, realm_name) for realm_name in pending }
+        logger.info(f"Cleared {cache} cache for {len(pending)} realm(s) in ms: {latencies}")
+        return latencies
+
+    def clear_realm_caches(self, realm_names: List[str] = None) -> dict:
+        return self.clear(REALM_CACHE, realm_names)
+
+    def clear_user_caches(self, realm_names: List[str] = None) -> dict:
+        return self.clear(USER_CACHE, realm_names)
+
+def clear_all_realms_cache(kc: KeyCloakApiProxy, max_workers: int = DEFAULT_MAX_WORKERS) -> dict:
+    return CacheInvalidator(kc, max_workers).clear_realm_caches()
+
+def clear_all_users_cache(kc: KeyCloakApiProxy, max_workers: int = DEFAULT_MAX_WORKERS) -> dict:
+    return CacheInvalidator(kc, max_workers).clear_user_caches()
+
+# Returns the rotation summary; failed clients are reported in it instead of raising
+def rotate_and_store_client_secrets(kc: KeyCloakApiProxy, ssm_client, sns_client, ssm_prefix: str, sns_topicarn: str, max_workers: int = DEFAULT_MAX_WORKERS, realm_names: List[str] = None) -> dict:
+    engine = SecretRotationEngine(
+        kc, ssm_client, sns_client,
+        lambda realm_name, client_id: assemble_ssm_path(ssm_prefix, realm_name, client_id),
+        sns_topicarn,
+        max_workers = max_workers
+    )
+    return engine.run(realm_names)
@@ -1,14 +1,28 @@
-import requests, json, datetime, logging
-from urllib.parse import urlencode, quote_plus, urlparse
-from typing import List, Union
+import requests, json, logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, quote, quote_plus, urlparse
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from .transport import HttpTransport
+from .token_manager import TokenManager, TOKEN_ENDPOINT
+from .response_cache import ResponseCache, CachedResponse
+
+DEFAULT_USER_PAGE_SIZE = 100
+DEFAULT_BULK_WORKERS = 8
 
 class KeyCloakApiProxy( ):
-    def __init__(self, base_url: str, client_id: str, secret: str, logger = None):
+    def __init__(self, base_url: str, client_id: str, secret: str, logger = None, transport: HttpTransport = None, token_manager: TokenManager = None, response_cache: ResponseCache = None):
         parsed_url = urlparse(base_url)
         self.base_url = f"{parsed_url.scheme}://{parsed_url.netloc}/auth"
-        self._set_credentials(client_id, secret)
+        self.client_id = client_id
+        self.secret = secret
         self.verify_ssl = True if parsed_url.hostname != 'localhost' else False
         self.logger = logger or logging.getLogger(__name__)
+        # pass in a shared transport to reuse pooled connections between proxies/invocations
+        self.transport = transport or HttpTransport()
+        # same deal for the token manager; a shared one lets warm invocations skip the token grant
+        self.token_manager = token_manager or TokenManager(f"{self.base_url}{TOKEN_ENDPOINT}", self.transport, self.verify_ssl)
+        # opt in; read only GETs get served from here until their ttl runs out or we change something
+        self.response_cache = response_cache
 
     def _get_updated_credentials(self) -> tuple:
         # should return tuple of (client_id,secret)
@@ -19,54 +33,19 @@ class KeyCloakApiProxy( ):
     def _get_credentials(self) -> tuple:
         return (self.client_id, self.secret)
 
-    def _set_token_info(self, token: dict, from_time: datetime.datetime = datetime.datetime.utcnow() ):
-        self.access_token = token['access_token']
-        self.refresh_token = token['refresh_token']
-        self.token_refresh_expiration = from_time + datetime.timedelta(seconds=token['refresh_expires_in'])
-        self.token_expiration = from_time + datetime.timedelta(seconds=token['expires_in'])
-
     def _get_access_token(self) -> str:
-        return self.access_token
-
-    def _get_refresh_token(self) -> str:
-        return self.refresh_token
-
-    def _access_token_invalid(self, from_time: datetime.datetime = datetime.datetime.utcnow()) -> bool:
-        return not self.access_token or (self.token_refresh_expiration and self.token_refresh_expiration < from_time)
-
-    def _token_refresh_expired(self, from_time: datetime.datetime = datetime.datetime.utcnow()) -> bool:
-        return self.token_refresh_expiration and self.token_refresh_expiration < from_time
-
-    def _token_expired(self, from_time: datetime.datetime = datetime.datetime.utcnow()) -> bool:
-        return self.token_expiration < from_time
+        return self.token_manager.get_access_token(self._get_credentials)
 
     def _invalid_client_secret_response(self, response) -> bool:
-        return response.status_code in [400,401] and response.json()['error_description'] == 'Invalid client secret'
+        if response.status_code not in [400,401]:
+            return False
+        try:
+            return response.json().get('error_description') == 'Invalid client secret'
+        except ValueError:
+            # admin endpoints 401 with an empty body
+            return False
 
     def _get_auth_header( self ) -> dict:
-        endpoint = '/realms/master/protocol/openid-connect/token'
-        request_args = {
-            'url'     :  f"{self.base_url}{endpoint}",
-            'headers' : {
-                'Content-Type' : 'application/x-www-form-urlencoded'
-            },
-            'verify'  : self.verify_ssl 
-        }
-        now = datetime.datetime.utcnow()
-        if self._access_token_invalid(now):
-            client_id, secret = self._get_credentials()
-            self.logger.info(f"Creating new access token with user {client_id}")
-            payload = "grant_type=client_credentials"
-            r = requests.post( auth=(client_id, secret), data=bytes(payload.encode('utf-8')), **request_args )
-            r.raise_for_status()
-            self._set_token_info(r.json(), now)
-        if self._token_expired(now):
-            client_id, _ = self._get_credentials()
-            self.logger.info(f"Cached access token has expired for {client_id}; refreshing it")
-            payload = f"refresh_token={self._get_refresh_token()}&client_id={client_id}&grant_type=refresh_token"
-            r = requests.post( data=bytes(payload.encode('utf-8')), **request_args )
-            r.raise_for_status()
-            self._set_token_info(r.json(), now)
         return {"Authorization": f"Bearer {self._get_access_token()}"}
 
     def _refresh_credentials(self) -> bool:
@@ -79,7 +58,7 @@ class KeyCloakApiProxy( ):
         self.logger.warning("No updated credentials were found")
         return False
 
-    def _make_request(self, method: str, endpoint: str, query_params: dict = None, body: Union[dict,str,bytes] = None, headers: dict = None):
+    def _make_request(self, method: str, endpoint: str, query_params: dict = None, body: Union[dict,str,bytes] = None, headers: dict = None, timeout: Tuple[float,float] = None, ok_statuses: List[int] = None, _token_retry: bool = False):
         method = method.upper()
         body = body or {}
         # questionable default...
@@ -88,7 +67,8 @@ class KeyCloakApiProxy( ):
         request_args = {
             'verify'  : self.verify_ssl,
             'url'     : f"{self.base_url}{endpoint}{query_param_string}",
-            'method'  : method
+            'method'  : method,
+            'timeout' : timeout
         }
         # probably not a great approach.. should just make it dependent on if body was passed in
         if method != 'GET':
@@ -105,32 +85,70 @@ class KeyCloakApiProxy( ):
             request_args['headers'] = auth_headers
             # might be a bad idea for both security and random serialization?
             self.logger.debug(f"Making keycloak api request: {request_args}")
-            r = requests.request(**request_args)
-            r.raise_for_status()
+            r = self.transport.request(**request_args)
+            # lets callers treat things like a 404 on delete as an answer rather than an error
+            if r.status_code not in (ok_statuses or []):
+                r.raise_for_status()
         except requests.exceptions.HTTPError as e:
             if self._invalid_client_secret_response(e.response):
                 if self._refresh_credentials( ):
-                    r = self._make_request(method, endpoint, query_params, body, headers)
+                    r = self._make_request(method, endpoint, query_params, body, headers, timeout, ok_statuses)
                     pass
                 else:
                     self.logger.error(f"Client secret access failed for both default secret and value from credenital refresh hook")
                     raise
+            elif e.response.status_code == 401 and not _token_retry:
+                # cached token can be rejected early if the realm keys changed (ie a config import)
+                self.logger.warning("Access token was rejected; dropping cached token and retrying once")
+                self.token_manager.invalidate()
+                r = self._make_request(method, endpoint, query_params, body, headers, timeout, ok_statuses, _token_retry=True)
             else:
                 self.logger.exception(e)
                 raise
 
         return r
 
+    def _cached_get(self, endpoint_name: str, endpoint: str, query_params: dict = None):
+        # returns the response or a CachedResponse; both have .json()
+        if self.response_cache is None:
+            return self._make_request('GET', endpoint, query_params)
+        key = endpoint + ('' if not query_params else '?' + urlencode(query_params, quote_via=quote_plus))
+        entry = self.response_cache.lookup(key)
+        if entry is not None and self.response_cache.is_fresh(entry):
+            self.logger.debug(f"Serving {key} from response cache")
+            return entry
+        headers = {'Content-Type' : 'application/json'}
+        headers.update(entry.validators() if entry is not None else {})
+        r = self._make_request('GET', endpoint, query_params, headers=headers)
+        if r.status_code == 304 and entry is not None:
+            return self.response_cache.revalidated(key, endpoint_name, entry)
+        return self.response_cache.store(key, endpoint_name, CachedResponse(r.text, r.headers.get('ETag'), r.headers.get('Last-Modified')))
+
+    def _invalidate_cached(self, *prefixes: str) -> None:
+        if self.response_cache is not None:
+            for prefix in prefixes:
+                self.response_cache.invalidate_prefix(prefix)
+
     def _get_clients(self, realm_name: str, params: dict):
         endpoint = f"/admin/realms/{realm_name}/clients"
         self.logger.debug(f"Fetching clients for {realm_name} with params: {params}")
-        return self._make_request('GET', endpoint, params)
+        endpoint_name = 'client' if 'clientId' in params else 'clients'
+        return self._cached_get(endpoint_name, endpoint, params)
 
     def _set_credentials(self, client_id: str, secret: str) -> None:
         self.secret = secret
         # should pass through once tested
         self.client_id = client_id
-        self.access_token = self.token_refresh_expiration = self.token_expiration = self.refresh_token = None
+        self.token_manager.invalidate()
+
+    def get_connection_stats(self) -> dict:
+        return self.transport.get_stats()
+
+    def get_token_stats(self) -> dict:
+        return self.token_manager.get_stats()
+
+    def get_cache_stats(self) -> dict:
+        return self.response_cache.get_stats() if self.response_cache is not None else { }
 
     def get_client(self, realm_name: str, client_name: str) -> dict:
         self.logger.info(f"Fetching client '{client_name}' from realm '{realm_name}'")
@@ -151,12 +169,25 @@ class KeyCloakApiProxy( ):
         self.logger.info(f"Rotating client secret for '{client_id}' from realm '{realm_name}'")
         endpoint = f"/admin/realms/{realm_name}/clients/{client_id}/client-secret"
         r = self._make_request('POST', endpoint)
+        # client representations carry the secret
+        self._invalidate_cached(f"/admin/realms/{realm_name}/clients")
+        return r.json()
+
+    def get_client_secret(self, realm_name: str, client_id: str) -> dict:
+        # never cached; used to find out whether a rotate that errored actually went through
+        self.logger.info(f"Fetching client secret for '{client_id}' from realm '{realm_name}'")
+        endpoint = f"/admin/realms/{realm_name}/clients/{client_id}/client-secret"
+        r = self._make_request('GET', endpoint)
         return r.json()
 
     def clear_realm_cache(self, realm_name: str) -> None:
         self.logger.info(f"Clearing realm cache for realm {realm_name}")
         endpoint = f"/admin/realms/{realm_name}/clear-realm-cache"
         self._make_request('POST', endpoint)
+        # whatever we cached could be what keycloak itself had cached wrong
+        self._invalidate_cached(f"/admin/realms/{realm_name}/")
+        if self.response_cache is not None:
+            self.response_cache.invalidate("/admin/realms")
     
     def clear_user_cache(self, realm_name: str) -> None:
         self.logger.info(f"Clearing user cache for realm {realm_name}")
@@ -166,21 +197,132 @@ class KeyCloakApiProxy( ):
     def get_realms(self):
         self.logger.info("Fetching all realms")
         endpoint = f"/admin/realms"
-        r = self._make_request('GET', endpoint)
+        r = self._cached_get('realms', endpoint)
         return r.json()
 
+    # Realm as the admin console's partial export gives it: settings, clients, client scopes, idps,
+    # flows, roles and groups but no users. Secrets come back masked. None if the realm doesn't exist.
+    def partial_export_realm(self, realm_name: str) -> Optional[dict]:
+        self.logger.info(f"Exporting realm '{realm_name}'")
+        endpoint = f"/admin/realms/{realm_name}/partial-export"
+        query_params = {'exportClients': 'true', 'exportGroupsAndRoles': 'true'}
+        r = self._make_request('POST', endpoint, query_params, ok_statuses=[404])
+        return None if r.status_code == 404 else r.json()
+
+    # keycloak only touches the fields that are in the representation
+    def update_realm(self, realm_name: str, realm: dict) -> None:
+        self.logger.info(f"Updating realm '{realm_name}' settings {sorted(realm.keys())}")
+        endpoint = f"/admin/realms/{realm_name}"
+        self._make_request('PUT', endpoint, body=realm)
+        self._invalidate_cached(f"/admin/realms/{realm_name}/")
+        if self.response_cache is not None:
+            self.response_cache.invalidate("/admin/realms")
+
+    def create_client(self, realm_name: str, client: dict) -> None:
+        self.logger.info(f"Creating client '{client['clientId']}' in realm '{realm_name}'")
+        endpoint = f"/admin/realms/{realm_name}/clients"
+        self._make_request('POST', endpoint, body=client)
+        self._invalidate_cached(f"/admin/realms/{realm_name}/clients")
+
+    def update_client(self, realm_name: str, client_uuid: str, client: dict) -> None:
+        self.logger.info(f"Updating client '{client.get('clientId', client_uuid)}' in realm '{realm_name}'")
+        endpoint = f"/admin/realms/{realm_name}/clients/{client_uuid}"
+        self._make_request('PUT', endpoint, body=client)
+        self._invalidate_cached(f"/admin/realms/{realm_name}/clients")
+
+    def create_client_scope(self, realm_name: str, client_scope: dict) -> None:
+        self.logger.info(f"Creating client scope '{client_scope['name']}' in realm '{realm_name}'")
+        endpoint = f"/admin/realms/{realm_name}/client-scopes"
+        self._make_request('POST', endpoint, body=client_scope)
+
+    def update_client_scope(self, realm_name: str, client_scope_id: str, client_scope: dict) -> None:
+        self.logger.info(f"Updating client scope '{client_scope.get('name', client_scope_id)}' in realm '{realm_name}'")
+        endpoint = f"/admin/realms/{realm_name}/client-scopes/{client_scope_id}"
+        self._make_request('PUT', endpoint, body=client_scope)
+
+    def create_identity_provider(self, realm_name: str, identity_provider: dict) -> None:
+        self.logger.info(f"Creating identity provider '{identity_provider['alias']}' in realm '{realm_name}'")
+        endpoint = f"/admin/realms/{realm_name}/identity-provider/instances"
+        self._make_request('POST', endpoint, body=identity_provider)
+
+    def update_identity_provider(self, realm_name: str, alias: str, identity_provider: dict) -> None:
+        self.logger.info(f"Updating identity provider '{alias}' in realm '{realm_name}'")
+        endpoint = f"/admin/realms/{realm_name}/identity-provider/instances/{quote(alias, safe='')}"
+        self._make_request('PUT', endpoint, body=identity_provider)
+
+    # flattened: sub flows' executions follow the sub flow with a higher level
+    def get_flow_executions(self, realm_name: str, flow_alias: str) -> List[dict]:
+        self.logger.debug(f"Fetching executions of flow '{flow_alias}' in realm '{realm_name}'")
+        endpoint = f"/admin/realms/{realm_name}/authentication/flows/{quote(flow_alias, safe='')}/executions"
+        return self._make_request('GET', endpoint).json()
+
+    def update_flow_execution(self, realm_name: str, flow_alias: str, execution: dict) -> None:
+        self.logger.info(f"Setting execution '{execution.get('displayName', execution['id'])}' of flow '{flow_alias}' in realm '{realm_name}' to {execution['requirement']}")
+        endpoint = f"/admin/realms/{realm_name}/authentication/flows/{quote(flow_alias, safe='')}/executions"
+        self._make_request('PUT', endpoint, body=execution)
+
     def get_user_by_username(self, realm_name, username) -> dict:
         self.logger.info(f"Getting user '{username}' from realm '{realm_name}'")
-        endpoint = f"/admin/realms/navex/users"
+        endpoint = f"/admin/realms/{realm_name}/users"
         query_params = {'username':username}
         r = self._make_request('GET', endpoint, query_params)
         return r.json()
 
-    def remove_user_by_id(self, realm_name: str, user_id: str):
+    def get_user_by_id(self, realm_name: str, user_id: str) -> Optional[dict]:
+        self.logger.debug(f"Getting user '{user_id}' from realm '{realm_name}'")
+        endpoint = f"/admin/realms/{realm_name}/users/{user_id}"
+        r = self._make_request('GET', endpoint, ok_statuses=[404])
+        return None if r.status_code == 404 else r.json()
+
+    # filters are passed straight through as query params (search, email, enabled, briefRepresentation, ...)
+    def get_users_page(self, realm_name: str, first: int, page_size: int = DEFAULT_USER_PAGE_SIZE, filters: dict = None) -> List[dict]:
+        endpoint = f"/admin/realms/{realm_name}/users"
+        query_params = dict(filters or {}, first=first, max=page_size)
+        self.logger.debug(f"Fetching users {first}-{first + page_size} from realm '{realm_name}'")
+        return self._make_request('GET', endpoint, query_params).json()
+
+    # Walks a realm's users a page at a time with first/max so only one page is ever held in memory
+    def iter_users(self, realm_name: str, page_size: int = DEFAULT_USER_PAGE_SIZE, filters: dict = None) -> Iterator[dict]:
+        first = 0
+        while True:
+            page = self.get_users_page(realm_name, first, page_size, filters)
+            for user in page:
+                yield user
+            if len(page) < page_size:
+                return
+            first += page_size
+
+    def get_users_by_ids(self, realm_name: str, user_ids: List[str], max_workers: int = DEFAULT_BULK_WORKERS) -> Dict[str,Optional[dict]]:
+        # missing users come back as None
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return { }
+        self.logger.info(f"Getting {len(user_ids)} user(s) from realm '{realm_name}'")
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(user_ids)), thread_name_prefix='kc-users') as pool:
+            return dict(zip(user_ids, pool.map(lambda user_id: self.get_user_by_id(realm_name, user_id), user_ids)))
+
+    def remove_user_by_id(self, realm_name: str, user_id: str, missing_ok: bool = False) -> bool:
+        # returns False if the user was already gone (only possible with missing_ok)
         self.logger.info(f"Removing user '{user_id}' from realm '{realm_name}'")
-        endpoint = f"/admin/realms/navex/users/{user_id}"
-        r = self._make_request('DELETE', endpoint)
-        r.raise_for_status()
+        endpoint = f"/admin/realms/{realm_name}/users/{user_id}"
+        r = self._make_request('DELETE', endpoint, ok_statuses=[404] if missing_ok else None)
+        self._invalidate_cached(f"/admin/realms/{realm_name}/users")
+        return r.status_code != 404
+
+    def remove_users(self, realm_name: str, user_ids: List[str], max_workers: int = DEFAULT_BULK_WORKERS, missing_ok: bool = True) -> Dict[str,Optional[str]]:
+        # returns user id -> None if it was removed (or already gone) or the error message if it wasn't
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return { }
+        def remove(user_id: str) -> Optional[str]:
+            try:
+                self.remove_user_by_id(realm_name, user_id, missing_ok)
+                return None
+            except Exception as e:
+                self.logger.error(f"Failed to remove '{user_id}' from '{realm_name}': {e}")
+                return str(e)
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(user_ids)), thread_name_prefix='kc-users') as pool:
+            return dict(zip(user_ids, pool.map(remove, user_ids)))
 
     def remove_user_by_username(self, realm_name, username):
         user = self.get_user_by_username(realm_name, username)
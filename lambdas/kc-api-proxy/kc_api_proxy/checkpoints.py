@@ -0,0 +1,120 @@
+import os, json, tempfile, threading, logging
+from abc import ABC, abstractmethod
+from typing import Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+# High-water mark of a log scan: the newest event timestamp processed and the ids of every event
+# at exactly that timestamp (filter_log_events times are inclusive and plenty of events share a ms)
+class ScanCheckpoint( ):
+    def __init__(self, timestamp: int, event_ids: Iterable[str] = None):
+        self.timestamp = timestamp
+        self.event_ids = set(event_ids or [])
+    def to_dict(self):
+        return {
+            'timestamp': self.timestamp,
+            'eventIds' : sorted(self.event_ids)
+        }
+    @classmethod
+    def from_dict(cls, checkpoint: dict) -> 'ScanCheckpoint':
+        return cls(checkpoint['timestamp'], checkpoint.get('eventIds'))
+
+class CheckpointStore(ABC):
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def _load(self) -> dict:
+        pass
+
+    @abstractmethod
+    def _save(self, checkpoints: dict) -> None:
+        pass
+
+    def get(self, key: str) -> Optional[ScanCheckpoint]:
+        with self._lock:
+            checkpoint = self._load().get(key)
+        return ScanCheckpoint.from_dict(checkpoint) if checkpoint else None
+
+    def put(self, key: str, checkpoint: ScanCheckpoint) -> None:
+        with self._lock:
+            checkpoints = self._load()
+            checkpoints[key] = checkpoint.to_dict()
+            self._save(checkpoints)
+
+class InMemoryCheckpointStore(CheckpointStore):
+    def __init__(self):
+        super().__init__()
+        self._checkpoints = { }
+
+    def _load(self) -> dict:
+        return dict(self._checkpoints)
+
+    def _save(self, checkpoints: dict) -> None:
+        self._checkpoints = dict(checkpoints)
+
+class FileCheckpointStore(CheckpointStore):
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return { }
+        except ValueError:
+            logger.warning(f"Checkpoint store {self.path} is unreadable; scanning from scratch")
+            return { }
+
+    def _save(self, checkpoints: dict) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.checkpoints-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(checkpoints, f)
+        os.replace(temp_path, self.path)
+
+# Wraps one scan of one log location. start_ms() moves the requested start up to the stored mark,
+# filter() drops the events at the boundary that were already processed and tracks the new mark as
+# events go by (they have to come in timestamp order, which LogScanner guarantees), and commit()
+# saves it. Because the mark only covers events actually handed out, stopping early is safe too.
+class CheckpointedScan( ):
+    def __init__(self, store: CheckpointStore, key: str):
+        self.store = store
+        self.key = key
+        self.previous = store.get(key)
+        self.current = None
+        self.skipped = 0
+
+    def start_ms(self, requested_start_ms: int) -> int:
+        if self.previous and self.previous.timestamp > requested_start_ms:
+            logger.info(f"Resuming scan of {self.key} from checkpoint {self.previous.timestamp} instead of {requested_start_ms}")
+            return self.previous.timestamp
+        return requested_start_ms
+
+    def _already_processed(self, event: dict) -> bool:
+        if not self.previous:
+            return False
+        if event['timestamp'] == self.previous.timestamp:
+            return event['eventId'] in self.previous.event_ids
+        return event['timestamp'] < self.previous.timestamp
+
+    def filter(self, events: Iterable[dict]) -> Iterator[dict]:
+        for event in events:
+            if self._already_processed(event):
+                self.skipped += 1
+                continue
+            if self.current is None or event['timestamp'] > self.current.timestamp:
+                # still on the old boundary ms means the old ids are still needed
+                carried_ids = self.previous.event_ids if self.previous and self.previous.timestamp == event['timestamp'] else None
+                self.current = ScanCheckpoint(event['timestamp'], carried_ids)
+            self.current.event_ids.add(event['eventId'])
+            yield event
+
+    def commit(self) -> None:
+        # nothing new means the old mark is still the right one
+        if self.current is not None:
+            self.store.put(self.key, self.current)
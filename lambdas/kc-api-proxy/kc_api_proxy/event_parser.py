@@ -0,0 +1,80 @@
+import re
+from typing import Iterable, List, Optional, Tuple
+
+# A value runs until the next ", someKey=" or the end of the line, so commas inside a value
+# (redirect_uri query strings mostly) don't cut it short. Newer keycloak quotes every value;
+# quoted values run to the closing quote and can contain anything, escaped quotes included.
+KEY = r'[A-Za-z_][\w.-]*'
+VALUE_END = rf'(?=, {KEY}=|$)'
+QUOTED_VALUE = r'"([^"\\]*(?:\\.[^"\\]*)*)"'
+# runs of anything but a comma, plus any comma that isn't the start of the next pair (unrolled so
+# the regex engine isn't checking the lookahead after every single character)
+UNQUOTED_VALUE = rf'([^,]*(?:,(?! {KEY}=)[^,]*)*)'
+ESCAPED_CHAR = re.compile(r'\\(.)')
+
+KEY_START = re.compile(rf'{KEY}=')
+# key has to start the line or follow whitespace/a comma so userId doesn't match inside existing_userId
+KEY_VALUE = re.compile(rf'(?:^|(?<=[\s,]))({KEY})=(?:{QUOTED_VALUE}|{UNQUOTED_VALUE}){VALUE_END}')
+
+# Pulls just the requested keys out of keycloak event log lines, ex:
+#   ... type=IDENTITY_PROVIDER_FIRST_LOGIN_ERROR, realmId=navex, clientId=cmd-backend, userId=1fc3d2c0-..., redirect_uri=https://...
+# Lines without any quotes (what we get today) take the fast path: str.find for each key and one
+# search for where its value ends. Anything with quotes in it is walked pair by pair with one
+# precompiled pattern so nothing inside a quoted value is ever mistaken for a key; that walk stops
+# as soon as every requested key has turned up. Either way nothing else on the line gets split.
+class KeycloakEventParser( ):
+    def __init__(self, keys: Iterable[str]):
+        self.keys = tuple(keys)
+        self._needles = [ f"{key}=" for key in self.keys ]
+        self._indexes = { key: index for index, key in enumerate(self.keys) }
+
+    @staticmethod
+    def _value(match) -> str:
+        quoted = match.group(2)
+        if quoted is not None:
+            return ESCAPED_CHAR.sub(r'\1', quoted) if '\\' in quoted else quoted
+        return match.group(3)
+
+    @staticmethod
+    def _find_unquoted(line: str, needle: str) -> Optional[str]:
+        position = line.find(needle)
+        while position > 0 and line[position - 1] not in ' ,\t':
+            position = line.find(needle, position + 1)
+        if position < 0:
+            return None
+        value_start = position + len(needle)
+        value_end = line.find(', ', value_start)
+        while value_end >= 0 and not KEY_START.match(line, value_end + 2):
+            value_end = line.find(', ', value_end + 1)
+        return line[value_start:value_end] if value_end >= 0 else line[value_start:]
+
+    def _walk(self, line: str) -> Tuple[Optional[str], ...]:
+        values = [ None ] * len(self.keys)
+        remaining = len(self.keys)
+        for match in KEY_VALUE.finditer(line):
+            index = self._indexes.get(match.group(1))
+            if index is None or values[index] is not None:
+                continue
+            values[index] = self._value(match)
+            remaining -= 1
+            if not remaining:
+                break
+        return tuple(values)
+
+    def extract(self, line: str) -> Tuple[Optional[str], ...]:
+        # values in the order the keys were given; None for anything the line doesn't have
+        if '"' in line:
+            return self._walk(line)
+        find = self._find_unquoted
+        return tuple([ find(line, needle) for needle in self._needles ])
+
+    def parse(self, line: str) -> dict:
+        return { key: value for key, value in zip(self.keys, self.extract(line)) if value is not None }
+
+    def extract_many(self, lines: Iterable[str]) -> List[Tuple[Optional[str], ...]]:
+        extract = self.extract
+        return [ extract(line) for line in lines ]
+
+    def parse_many(self, lines: Iterable[str]) -> List[dict]:
+        parse = self.parse
+        return [ parse(line) for line in lines ]
@@ -1,27 +1,52 @@
-import os, boto3, logging
+import os, logging
 from datetime import datetime
-from .apiproxy import KeyCloakApiProxy
+from .apiproxy import KeyCloakApiProxy, DEFAULT_BULK_WORKERS
+from .transport import get_shared_transport, DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+from .token_manager import get_shared_token_manager, DEFAULT_REFRESH_SKEW_SECONDS
+from .response_cache import ResponseCache
 from .cpresponse import CodePipelineHelperResponse
+from .startup import get_client, profile_cold_start
 from .log_helpers import get_duplicate_user_locations
+from .task_definitions import task_definition_resolver
+from .log_scanner import LogScanner, DEFAULT_SCAN_WORKERS, DEFAULT_SLICE_MS
+from .log_query import LogsInsightsQuery, DEFAULT_QUERY_TIMEOUT
+from .checkpoints import CheckpointStore, InMemoryCheckpointStore, FileCheckpointStore
+from .remediation import remove_duplicate_users, IdempotencyStore, InMemoryIdempotencyStore, FileIdempotencyStore
+from .rotation import DEFAULT_MAX_WORKERS as DEFAULT_ROTATION_MAX_WORKERS
+from .realm_sync import RealmSyncEngine, load_desired_realms, DEFAULT_SYNC_WORKERS, DEFAULT_MAX_SYNC_USERS
 from .api_helpers import (
     assemble_ssm_path, 
     rotate_and_store_client_secrets, 
-    clear_all_users_cache
+    CacheInvalidator
 )
 
-ssm_client = boto3.client('ssm')
-sns_client = boto3.client('sns')
-logs_client = boto3.client('logs')
-ecs_client = boto3.client('ecs')
+# aws clients are built lazily (and cached) so each handler only pays for the ones it uses
+def get_ssm_client():
+    return get_client('ssm')
+
+def get_sns_client():
+    return get_client('sns')
+
+def get_logs_client():
+    return get_client('logs')
+
+def get_ecs_client():
+    return get_client('ecs')
+
+def get_s3_client():
+    return get_client('s3')
 
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
 
+DEFAULT_IDEMPOTENCY_STORE_PATH = '/tmp/kc-removed-users.json'
+DEFAULT_SCAN_CHECKPOINT_PATH = '/tmp/kc-duplicate-user-scan.json'
+
 class KcApiProxySsmRefresh(KeyCloakApiProxy):
     def _get_updated_credentials(self):
         ssm_secret_path = os.environ['AdminSecretSsmPath']
         self.logger.info(f"Checking ssm {ssm_secret_path} for updated client secret")
-        secret = ssm_client.get_parameter(
+        secret = get_ssm_client().get_parameter(
             Name=ssm_secret_path,
             WithDecryption=True
         )['Parameter']['Value']
@@ -31,15 +56,73 @@ def get_keycloak_api_proxy_from_env() -> KcApiProxySsmRefresh:
     base_url = os.environ['KeyCloakBaseUrl']
     client_id = os.environ['AdminClientId']
     default_secret = os.environ['AdminDefaultSecret']
-    return KcApiProxySsmRefresh(base_url, client_id, default_secret, logger)
+    # shared transport keeps the connection pool alive across warm invocations
+    transport = get_shared_transport(
+        pool_size       = int(os.environ.get('HttpPoolSize', DEFAULT_POOL_SIZE)),
+        connect_timeout = float(os.environ.get('HttpConnectTimeout', DEFAULT_CONNECT_TIMEOUT)),
+        read_timeout    = float(os.environ.get('HttpReadTimeout', DEFAULT_READ_TIMEOUT))
+    )
+    # per proxy (not shared across invocations); opt in with ResponseCacheEnabled for handlers that re-read realms/clients
+    response_cache = ResponseCache() if os.environ.get('ResponseCacheEnabled', 'false').lower() == 'true' else None
+    kc = KcApiProxySsmRefresh(base_url, client_id, default_secret, logger, transport, response_cache=response_cache)
+    # cached token survives warm invocations too; expiry is checked against a monotonic clock
+    kc.token_manager = get_shared_token_manager(
+        kc.base_url, client_id, transport, kc.verify_ssl,
+        refresh_skew_seconds = float(os.environ.get('TokenRefreshSkewSeconds', DEFAULT_REFRESH_SKEW_SECONDS))
+    )
+    return kc
+
+def get_rotation_max_workers() -> int:
+    return int(os.environ.get('RotationMaxWorkers', DEFAULT_ROTATION_MAX_WORKERS))
+
+def rotation_failure_message(summary: dict) -> str:
+    failed_clients = [ f"{c['realmName']}/{c['clientId']} ({c['failedStage']}: {c['error']})" for c in summary['clients'] if not c['success'] ]
+    failed_realms = [ f"{realm_name} ({error})" for realm_name, error in summary['realmErrors'].items() ]
+    return f"Secret rotation failed for client(s): {failed_clients}; realm(s) not listed: {failed_realms}"
 
 # This entry point will be called by a scheduled cloudwatch job
 # Should probably catch exceptions and return whatever lambdas ought to return...
+@profile_cold_start
 def cwe_rotate_handler(event, context):
     logger.info("Cloudwatch scheduled secret rotation started")
     kc = get_keycloak_api_proxy_from_env()
-    rotate_and_store_client_secrets(kc, ssm_client, sns_client, os.environ['SsmPrefix'], os.environ['RotateSecretTopicArn'])
-    logger.info("Cloudwatch scheduled secret rotation finished")
+    summary = rotate_and_store_client_secrets(kc, get_ssm_client(), get_sns_client(), os.environ['SsmPrefix'], os.environ['RotateSecretTopicArn'], get_rotation_max_workers())
+    logger.info(f"Cloudwatch scheduled secret rotation finished; connection stats: {kc.get_connection_stats()}, token stats: {kc.get_token_stats()}, cache stats: {kc.get_cache_stats()}")
+    # everything that could be rotated and stored has been by now; fail the invocation so the errors metric/alarms see the rest
+    if summary['failed'] or summary['realmErrors']:
+        raise RuntimeError(rotation_failure_message(summary))
+    return summary
+
+_in_memory_idempotency_store = InMemoryIdempotencyStore()
+
+# /tmp outlives warm invocations; set IdempotencyStorePath to 'memory' to keep it in process only
+def get_idempotency_store() -> IdempotencyStore:
+    path = os.environ.get('IdempotencyStorePath', DEFAULT_IDEMPOTENCY_STORE_PATH)
+    if path == 'memory':
+        return _in_memory_idempotency_store
+    return FileIdempotencyStore(path)
+
+def get_log_scanner() -> LogScanner:
+    slice_ms = int(float(os.environ.get('LogScanSliceMinutes', DEFAULT_SLICE_MS / 60000)) * 60000)
+    return LogScanner(get_logs_client(), int(os.environ.get('LogScanMaxWorkers', DEFAULT_SCAN_WORKERS)), slice_ms)
+
+# LogQueryBackend=insights pushes the duplicate user aggregation to logs insights; the default
+# (filter) is the plain filter_log_events scan, which is also what insights falls back to
+def get_insights_query() -> LogsInsightsQuery:
+    if os.environ.get('LogQueryBackend', 'filter') != 'insights':
+        return None
+    return LogsInsightsQuery(get_logs_client(), timeout=float(os.environ.get('LogQueryTimeout', DEFAULT_QUERY_TIMEOUT)))
+
+_in_memory_checkpoint_store = InMemoryCheckpointStore()
+
+# same deal as the idempotency store; ScanCheckpointPath 'memory' keeps it in process and 'none' turns it off
+def get_checkpoint_store() -> CheckpointStore:
+    path = os.environ.get('ScanCheckpointPath', DEFAULT_SCAN_CHECKPOINT_PATH)
+    if path == 'none':
+        return None
+    if path == 'memory':
+        return _in_memory_checkpoint_store
+    return FileCheckpointStore(path)
 
 def get_search_times_from_alarm_event(event):
     current_state_time = event['detail']['state']['timestamp']
@@ -47,6 +130,7 @@ def get_search_times_from_alarm_event(event):
     return ( datetime.strptime(last_state_time, "%Y-%m-%dT%H:%M:%S.%f+0000"), datetime.strptime(current_state_time, "%Y-%m-%dT%H:%M:%S.%f+0000") )
     
 
+@profile_cold_start
 def cwe_remove_duplicant_users_alarm_handler(event, context):
     if event.get('detail-type') != 'CloudWatch Alarm State Change':
         logger.warn("Unexpected event type triggered lambda..")
@@ -55,21 +139,35 @@ def cwe_remove_duplicant_users_alarm_handler(event, context):
     logger.info("Searching for duplicate users in logs..")
     keycloak_app_task_definition_arn = os.environ['TaskDefinitionArn']
     start_time, end_time = get_search_times_from_alarm_event(event)
-    duplicate_user_locations = get_duplicate_user_locations(ecs_client, logs_client, keycloak_app_task_definition_arn, start_time, end_time)
-    logger.info(f"Found {len(duplicate_user_locations)} duplicate user id(s) blocked from loggin in")
+    max_locations = int(os.environ.get('MaxDuplicateUsersPerRun', 0)) or None
+    scanner = get_log_scanner()
+    duplicate_user_locations = get_duplicate_user_locations(get_ecs_client(), get_logs_client(), keycloak_app_task_definition_arn, start_time, end_time, max_locations, scanner, get_checkpoint_store(), get_insights_query())
+    logger.info(f"Found {len(duplicate_user_locations)} duplicate user id(s) blocked from loggin in; log scan stats: {scanner.get_stats()}, task definition cache: {task_definition_resolver.get_stats()}")
     kc = get_keycloak_api_proxy_from_env()
-    for realm_name, user_id in duplicate_user_locations:
-        try:
-            kc.remove_user_by_id(realm_name, user_id)
-        except Exception as e:
-            logger.error(f"Failed to remove '{user_id}' from '{realm_name}'")
-            logger.exception(e)
-            pass
+    # failures are logged/reported per user; the rest still get removed
+    return remove_duplicate_users(kc, duplicate_user_locations, get_idempotency_store(), int(os.environ.get('RemoveUsersMaxWorkers', DEFAULT_BULK_WORKERS)))
+
+# Called by the config import lambda before it starts an import task (see sync_realms there) with
+# the same import units it got. Applies the realm files' changes through the admin api when it can
+# and says why not when it can't; DryRun just reports what it would do.
+@profile_cold_start
+def realm_sync_handler(event, context):
+    units = event.get('Imports') or [ ]
+    dry_run = bool(event.get('DryRun'))
+    logger.info(f"Realm sync started for import id {event.get('ImportId')} and unit(s) {units}{' (dry run)' if dry_run else ''}")
+    max_workers = int(os.environ.get('RealmSyncMaxWorkers', DEFAULT_SYNC_WORKERS))
+    desired_realms = load_desired_realms(get_s3_client(), os.environ['S3ConfigBucket'], units, max_workers)
+    kc = get_keycloak_api_proxy_from_env()
+    max_users = int(os.environ.get('RealmSyncMaxUsers', DEFAULT_MAX_SYNC_USERS))
+    summary = RealmSyncEngine(kc, max_workers, max_users).sync(desired_realms, dry_run)
+    logger.info(f"Realm sync connection stats: {kc.get_connection_stats()}, token stats: {kc.get_token_stats()}, cache stats: {kc.get_cache_stats()}")
+    return summary
 
 # This entry point will be called by codepipeline directly to cause
 # client secrets to rotate immediately following a deployment since they 
 # will get reset as is
 # it returns a dict expected by the CPInvokeLambda action
+@profile_cold_start
 def cp_post_deploy_handler(event, context):
     actions = list(set([ action.lower() for action in event.get('Actions',[]) ]))
     supported_actions = ['rotate_client_secrets','clear_realm_cache','clear_user_cache']
@@ -89,15 +187,18 @@ def cp_post_deploy_handler(event, context):
     # Always clear realm cache. I think importing the config easily leads to 
     # the ids not matching in db vs app cache and then rotating the secrets (or anything else hitting a client-id)
     # has a solid chance of of throwing a 500 :/
+    invalidator = CacheInvalidator(kc, get_rotation_max_workers())
     try:
-        kc.clear_realm_cache("master")
+        invalidator.clear_realm_caches(["master"])
         # reset the kc api proxy because once the master realm cache has been cleared
         # it will notice that the admin-api-proxy secret has been reset and no longer matches what was pulled 
         # from ssm.. which causes this to fail every deploy, but succeed on retrying the action.
-        # If we introduce more realms it is probably worth using the clear_all_realms_cache task_helper instead
-        # of hardcoding the two known ones
         kc = get_keycloak_api_proxy_from_env()
-        kc.clear_realm_cache("navex")
+        # the token is shared across proxies now so it has to be dropped explicitly
+        kc.token_manager.invalidate()
+        invalidator.kc = kc
+        # rest of the realms are discovered from the api; master is already done and gets skipped
+        invalidator.clear_realm_caches()
     except Exception as e:
         logger.exception(e)
         return CodePipelineHelperResponse.failed(f"Error clearing realm cache pre deploy actions: {e}")
@@ -109,18 +210,25 @@ def cp_post_deploy_handler(event, context):
     for action in actions:
         try:
             if 'rotate_client_secrets' == action:
-                rotate_and_store_client_secrets(kc, ssm_client, sns_client, os.environ['SsmPrefix'], os.environ['RotateSecretTopicArn'])
+                summary = rotate_and_store_client_secrets(kc, get_ssm_client(), get_sns_client(), os.environ['SsmPrefix'], os.environ['RotateSecretTopicArn'], get_rotation_max_workers(), invalidator.get_realm_names())
+                # rotated clients need their realm cache cleared again afterwards
+                invalidator.mark_dirty()
+                # every other client still got rotated and stored; fail the action so someone looks at the rest
+                if summary['failed'] or summary['realmErrors']:
+                    return CodePipelineHelperResponse.failed(rotation_failure_message(summary))
             if 'clear_user_cache' == action:
-                clear_all_users_cache(kc)
+                invalidator.clear_user_caches()
         except Exception as e:
             logger.exception(e)
             return CodePipelineHelperResponse.failed(f"Error performing action {action}: {e}")
 
     try:
-        kc.clear_realm_cache("master")
-        kc.clear_realm_cache("navex")
+        # only realms something touched since the pre deploy clear
+        invalidator.clear_realm_caches()
     except Exception as e:
         logger.exception(e)
         return CodePipelineHelperResponse.failed(f"Error clearing realm cache post deploy actions: {e}")
 
-    return CodePipelineHelperResponse.succeeded(f"Successfully performed actions: {actions}")
\ No newline at end of file
+    logger.info(f"Codepipeline post-deploy cache clear latencies: {invalidator.latencies}")
+    logger.info(f"Codepipeline post-deploy connection stats: {kc.get_connection_stats()}, token stats: {kc.get_token_stats()}, cache stats: {kc.get_cache_stats()}")
+    return CodePipelineHelperResponse.succeeded(f"Successfully performed actions: {actions}")
@@ -1,6 +1,11 @@
-import os, logging
-from typing import List,Tuple
+import os, re, logging
+from typing import Iterable, Iterator, List, Tuple
 from datetime import datetime
+from .log_scanner import LogScanner
+from .checkpoints import CheckpointStore, CheckpointedScan
+from .event_parser import KeycloakEventParser
+from .log_query import LogsInsightsQuery
+from .task_definitions import TaskDefinitionResolver, task_definition_resolver
 
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
@@ -16,36 +21,59 @@ def dedup_simple_list(simple_list: List) -> List:
 # A bit gold-plated. It handles multiple different log locations being specified
 # in a single task definition which we aren't doing at all..
 # Also should depup the results... which should never be multiple
+# The describe_task_definition answer is memoized by arn for as long as the container lives
 # Return ex
 #    [('/ecs/keycloak-psychic-potato', 'kc-app')]
-def get_log_locations_from_task_definition(ecs_client, task_definition_arn: str) -> List[Tuple[str,str]]:
-    task_def = ecs_client.describe_task_definition(taskDefinition=task_definition_arn)
+def get_log_locations_from_task_definition(ecs_client, task_definition_arn: str, resolver: TaskDefinitionResolver = None) -> List[Tuple[str,str]]:
+    resolver = resolver or task_definition_resolver
     return dedup_simple_list( 
-        [ 
-            (container_def['logConfiguration']['options']['awslogs-group'],container_def['logConfiguration']['options']['awslogs-stream-prefix']) 
-            for container_def in task_def['taskDefinition']['containerDefinitions'] 
-        ] 
+        [ (log_config.log_group, log_config.stream_prefix) for log_config in resolver.resolve(ecs_client, task_definition_arn) ] 
     )
 
 
-def get_duplicate_user_log_messages(logs_client, group: str, stream_prefix: str, start_time: datetime, end_time: datetime = None ) -> List[dict]:
+DUPLICATE_USER_FILTER_PATTERN = '"federated_identity_account_exists"'
+
+# Yields events in timestamp order as the scanner works through the window; nothing is accumulated here.
+# With a checkpoint the scan starts at its mark and skips whatever was already handed out last time.
+def iter_duplicate_user_log_events(logs_client, group: str, stream_prefix: str, start_time: datetime, end_time: datetime = None, scanner: LogScanner = None,
+                                   checkpoint: CheckpointedScan = None ) -> Iterator[dict]:
     end_time = end_time or datetime.now()
     start_time_epoch_ms = get_epoch_time_ms(start_time)
     end_time_epoch_ms = get_epoch_time_ms(end_time)
-    filter_pattern = '"federated_identity_account_exists"'
-    logger.info(f"Checking log group {group} and stream prefix {stream_prefix} for logs that match '{filter_pattern}' between {start_time} and {end_time}")
-    paginator = logs_client.get_paginator("filter_log_events")
-    filter_kwargs = {
-        'logGroupName'       : group, 
-        'logStreamNamePrefix': stream_prefix, 
-        'filterPattern'      : filter_pattern,
-        'startTime'          : start_time_epoch_ms,
-        'endTime'            : end_time_epoch_ms
-    }
-    messages = []
-    for logs in paginator.paginate(**filter_kwargs):
-        messages += [ event['message'] for event in logs['events'] ]
-    return messages
+    if checkpoint:
+        start_time_epoch_ms = checkpoint.start_ms(start_time_epoch_ms)
+    logger.info(f"Checking log group {group} and stream prefix {stream_prefix} for logs that match '{DUPLICATE_USER_FILTER_PATTERN}' between {start_time_epoch_ms} and {end_time_epoch_ms}")
+    scanner = scanner or LogScanner(logs_client)
+    events = scanner.scan(group, start_time_epoch_ms, end_time_epoch_ms, DUPLICATE_USER_FILTER_PATTERN, stream_prefix)
+    yield from checkpoint.filter(events) if checkpoint else events
+
+def iter_duplicate_user_log_messages(logs_client, group: str, stream_prefix: str, start_time: datetime, end_time: datetime = None, scanner: LogScanner = None ) -> Iterator[str]:
+    for event in iter_duplicate_user_log_events(logs_client, group, stream_prefix, start_time, end_time, scanner):
+        yield event['message']
+
+def get_duplicate_user_log_messages(logs_client, group: str, stream_prefix: str, start_time: datetime, end_time: datetime = None, scanner: LogScanner = None ) -> List[str]:
+    return list(iter_duplicate_user_log_messages(logs_client, group, stream_prefix, start_time, end_time, scanner))
+
+def get_duplicate_user_insights_query(stream_prefix: str) -> str:
+    # insights regexes are /delimited/ so slashes in the prefix need escaping on top of the usual
+    stream_regex = re.escape(f"{stream_prefix}/").replace('/', '\\/')
+    return '\n'.join([
+        'fields @message',
+        f'| filter @logStream like /^{stream_regex}/',
+        '| filter @message like /federated_identity_account_exists/',
+        '| parse @message /[\\s,]realmId="?(?<realmId>[^",]+)/',
+        '| parse @message /[\\s,]userId="?(?<userId>[^",]+)/',
+        '| filter ispresent(realmId) and ispresent(userId)',
+        '| stats count() as occurrences by realmId, userId'
+    ])
+
+# Server side version of the scan below: insights does the parsing and the dedupe so only the
+# unique (realm, user) pairs come back
+def query_duplicate_user_locations(insights: LogsInsightsQuery, group: str, stream_prefix: str, start_time: datetime, end_time: datetime = None ) -> List[Tuple[str,str]]:
+    end_time = end_time or datetime.now()
+    logger.info(f"Querying log group {group} and stream prefix {stream_prefix} with insights for duplicate users between {start_time} and {end_time}")
+    rows = insights.run([ group ], get_duplicate_user_insights_query(stream_prefix), get_epoch_time_ms(start_time), get_epoch_time_ms(end_time))
+    return [ (row['realmId'], row['userId']) for row in rows ]
 
 # log ex:
 #   16:01:27,100 WARN  [org.keycloak.events] (default task-1493) type=IDENTITY_PROVIDER_FIRST_LOGIN_ERROR, realmId=navex, clientId=cmd-backend, userId=1fc3d2c0-f472-4e6d-8d7e-86553caa499d, ipAddress=24.173.19.238, error=federated_identity_account_exists, identity_provider=doorman, existing_username=c75c8c04-a60d-eb11-a96a-0050568ba3ec, redirect_uri=https://maint.policytech.com/oidc/coderedirector/?ReturnUrl=https%3a%2f%2faplusfcu.policytech.com%2foidc%2fcodeconsumer%2f%3fReturnUrl%3d%252fdotNet%252fdocuments%252f%253fdocid%253d10910, identity_provider_identity=c75c8c04-a60d-eb11-a96a-0050568ba3ec, code_id=d9bca038-41d7-4b20-ad7a-2c193f01e35d, authSessionParentId=d9bca038-41d7-4b20-ad7a-2c193f01e35d, authSessionTabId=zVdvJj48L5Y
@@ -62,13 +90,65 @@ def convert_log_message_to_dict(message: str) -> dict:
         log_dict[k] = v
     return log_dict
 
+USER_LOCATION_PARSER = KeycloakEventParser(['realmId', 'userId'])
+
+# convert_log_message_to_dict is still around for anyone who wants the whole line, but this only
+# ever needed two keys (and the split above falls over on values with ', ' in them)
 def parse_user_location_from_log_message(message: str) -> Tuple[str,str]:
-    log_dict = convert_log_message_to_dict(message)
-    return (log_dict['realmId'], log_dict['userId'])
+    realm_id, user_id = USER_LOCATION_PARSER.extract(message)
+    if realm_id is None or user_id is None:
+        raise KeyError('realmId' if realm_id is None else 'userId')
+    return (realm_id, user_id)
+
+def iter_user_locations(messages: Iterable[str]) -> Iterator[Tuple[str,str]]:
+    for message in messages:
+        try:
+            yield parse_user_location_from_log_message(message)
+        except KeyError:
+            # filter pattern is just a substring match so the odd unrelated line sneaks in
+            logger.warning(f"Skipping log message without realmId/userId: {message[:200]}")
+
+# Only once the users found are on their way back to the caller; a scan that blows up part way
+# leaves every mark where it was so the next alarm goes over those events again
+def commit_checkpoints(checkpoints: List[CheckpointedScan]) -> None:
+    for checkpoint in checkpoints:
+        logger.info(f"Skipped {checkpoint.skipped} event(s) already seen by a previous scan of {checkpoint.key}")
+        checkpoint.commit()
 
-def get_duplicate_user_locations(ecs_client, logs_client, task_definition_arn: str, start_time: datetime, end_time: datetime = None ):
-    user_locations = [ ]
+# Pages are parsed as they arrive and only the unique (realm, user) pairs are kept, so memory
+# stays flat no matter how noisy the window was. max_locations stops paging once that many
+# unique users have been found; the next alarm picks up the rest.
+# With a checkpoint store each log location only gets scanned past where the last run left off, so
+# a flapping alarm doesn't keep rereading the same window. The marks are saved once the scans are
+# done (not if one failed); a user whose removal then fails will log the same error on their next
+# login anyway.
+# Given an insights query runner each location is queried server side first (no checkpoints there;
+# the window is whatever the alarm says) and only falls back to the scan if the query fails.
+def get_duplicate_user_locations(ecs_client, logs_client, task_definition_arn: str, start_time: datetime, end_time: datetime = None, max_locations: int = None,
+                                 scanner: LogScanner = None, checkpoint_store: CheckpointStore = None, insights: LogsInsightsQuery = None ) -> List[Tuple[str,str]]:
+    user_locations = set()
+    checkpoints = [ ]
+    scanner = scanner or LogScanner(logs_client)
     for log_group,log_prefix in get_log_locations_from_task_definition(ecs_client, task_definition_arn):
-        duplicate_user_messages = get_duplicate_user_log_messages(logs_client, log_group, log_prefix, start_time, end_time)
-        user_locations = user_locations + [ parse_user_location_from_log_message(message) for message in duplicate_user_messages ]
-    return dedup_simple_list(user_locations)
\ No newline at end of file
+        if insights:
+            try:
+                user_locations.update(query_duplicate_user_locations(insights, log_group, log_prefix, start_time, end_time))
+                if max_locations and len(user_locations) >= max_locations:
+                    break
+                continue
+            except Exception as e:
+                logger.warning(f"Insights query for {log_group}/{log_prefix} failed; falling back to filter_log_events: {e}")
+        checkpoint = CheckpointedScan(checkpoint_store, f"{log_group}/{log_prefix}") if checkpoint_store else None
+        if checkpoint:
+            checkpoints.append(checkpoint)
+        events = iter_duplicate_user_log_events(logs_client, log_group, log_prefix, start_time, end_time, scanner, checkpoint)
+        for user_location in iter_user_locations(event['message'] for event in events):
+            user_locations.add(user_location)
+            if max_locations and len(user_locations) >= max_locations:
+                break
+        if max_locations and len(user_locations) >= max_locations:
+            logger.info(f"Found {max_locations} unique duplicate user(s); stopping the log scan early")
+            break
+    commit_checkpoints(checkpoints)
+    # an insights query can overshoot the cap by a whole result set; both paths hand back the same number
+    return list(user_locations)[:max_locations] if max_locations else list(user_locations)
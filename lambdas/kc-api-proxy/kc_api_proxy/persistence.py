@@ -0,0 +1,173 @@
+import os, time, random, threading, logging
+from typing import Callable, List
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+SNS_PUBLISH_BATCH_SIZE = 10
+THROTTLING_ERROR_CODES = ['ThrottlingException', 'Throttling', 'TooManyUpdates', 'TooManyRequestsException', 'RequestLimitExceeded']
+ROTATED_SECRET_MESSAGE = 'A Keycloak secret has been rotated'
+
+def chunk_list(items: List, size: int) -> List[List]:
+    return [ items[i:i + size] for i in range(0, len(items), size) ]
+
+def is_throttling_error(e: Exception) -> bool:
+    # botocore ClientError; avoiding the import so this doesn't care which aws lib raised it
+    error = getattr(e, 'response', None) or {}
+    return isinstance(error, dict) and error.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+# Shared between all the workers hitting the same api. Every throttle doubles the delay
+# every caller waits before its next request; successes shrink it back down. Keeps us
+# near whatever TPS the account actually has instead of hammering it in lockstep.
+class AdaptiveThrottle( ):
+    def __init__(self, name: str, initial_delay: float = 0.05, max_delay: float = 5.0, max_attempts: int = 6):
+        self.name = name
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.delay = 0.0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def _on_success(self) -> None:
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay > self.initial_delay else 0.0
+
+    def _on_throttle(self) -> None:
+        with self._lock:
+            self.throttled += 1
+            self.delay = min(self.max_delay, max(self.initial_delay, self.delay * 2))
+
+    def call(self, func: Callable):
+        for attempt in range(1, self.max_attempts + 1):
+            if self.delay:
+                time.sleep(random.uniform(self.delay / 2, self.delay))
+            try:
+                result = func()
+                self._on_success()
+                return result
+            except Exception as e:
+                if not is_throttling_error(e) or attempt >= self.max_attempts:
+                    raise
+                self._on_throttle()
+                logger.warning(f"{self.name} throttled (attempt {attempt}/{self.max_attempts}); backing off to {self.delay:.2f}s")
+
+# Writes rotated secrets to ssm and announces them on sns with as few calls as we can get away with:
+#   * each secret is stored the moment its client rotates (by the rotating worker), so a crash
+#     part way through a run only loses the clients that hadn't rotated yet
+#   * notifications queue up and go out through publish_batch, 10 per call (subscribers still get one message per client)
+#   * throttling on either api slows every worker down instead of failing the client
+# Each item is expected to have realm_name, client_id, ssm_path and secret attributes, plus
+# the stage/error/success/timings fields of a ClientRotationResult that get filled in here.
+class SecretPersistenceStage( ):
+    def __init__(self, ssm_client, sns_client, sns_topicarn: str):
+        self.ssm_client = ssm_client
+        self.sns_client = sns_client
+        self.sns_topicarn = sns_topicarn
+        self.ssm_throttle = AdaptiveThrottle('ssm')
+        self.sns_throttle = AdaptiveThrottle('sns')
+        self._lock = threading.Lock()
+        self._pending = [ ]
+        self.persisted = 0
+        self.stats = {'ssmPutCalls': 0, 'snsCalls': 0}
+
+    def _incr(self, stat: str, amount: int = 1) -> None:
+        with self._lock:
+            self.stats[stat] += amount
+
+    def _put_parameter(self, item) -> None:
+        item.stage = 'store'
+        self._incr('ssmPutCalls')
+        self.ssm_throttle.call(lambda: self.ssm_client.put_parameter(
+            Name=item.ssm_path,
+            Description='Keycloak client secret source of truth',
+            Value=item.secret,
+            Type='SecureString',
+            Overwrite=True
+        ))
+
+    def store(self, item) -> bool:
+        # freshly rotated secrets never match what's stored, so there's nothing to gain reading first
+        start = time.monotonic()
+        try:
+            self._put_parameter(item)
+            return True
+        except Exception as e:
+            logger.error(f"Storing secret for {item.realm_name}/{item.client_id} at {item.ssm_path} failed: {e}")
+            item.error = str(e)
+            return False
+        finally:
+            item.timings['store'] = int((time.monotonic() - start) * 1000)
+            # ssm has it (or never will); nothing downstream needs the plaintext
+            item.secret = None
+
+    def submit(self, item) -> None:
+        # safe to call from any worker; whoever fills up a batch publishes it
+        with self._lock:
+            self.persisted += 1
+        if not self.store(item):
+            return
+        with self._lock:
+            self._pending.append(item)
+            batch = self._pending[:SNS_PUBLISH_BATCH_SIZE] if len(self._pending) >= SNS_PUBLISH_BATCH_SIZE else [ ]
+            self._pending = self._pending[len(batch):]
+        if batch:
+            self._notify(batch)
+    def _publish_entry(self, index: int, item) -> dict:
+        return {
+            'Id': str(index),
+            'Message': ROTATED_SECRET_MESSAGE,
+            'MessageAttributes': {
+                'realmName': {
+                    'DataType': 'String',
+                    'StringValue': item.realm_name
+                },
+                'clientId': {
+                    'DataType': 'String',
+                    'StringValue': item.client_id
+                },
+                'ssmPath': {
+                    'DataType': 'String',
+                    'StringValue': item.ssm_path
+                }
+            }
+        }
+
+    def _notify(self, items: List) -> None:
+        for batch in chunk_list(items, SNS_PUBLISH_BATCH_SIZE):
+            for item in batch:
+                item.stage = 'notify'
+            entries = { str(index): item for index, item in enumerate(batch) }
+            start = time.monotonic()
+            self._incr('snsCalls')
+            try:
+                response = self.sns_throttle.call(lambda: self.sns_client.publish_batch(
+                    TopicArn=self.sns_topicarn,
+                    PublishBatchRequestEntries=[ self._publish_entry(index, item) for index, item in enumerate(batch) ]
+                ))
+            except Exception as e:
+                logger.error(f"Publishing rotation notifications for {[ item.client_id for item in batch ]} failed: {e}")
+                response = {'Failed': [ {'Id': id, 'Message': str(e)} for id in entries ]}
+            elapsed_ms = int((time.monotonic() - start) * 1000)
+            failed = { failure['Id']: failure.get('Message', failure.get('Code')) for failure in response.get('Failed', []) }
+            for id, item in entries.items():
+                item.timings['notify'] = elapsed_ms
+                if id in failed:
+                    item.error = failed[id]
+                else:
+                    item.success = True
+
+    def flush(self) -> dict:
+        with self._lock:
+            batch, self._pending = self._pending, [ ]
+        self._notify(batch)
+        # what the old put_parameter + publish per client would have cost
+        unbatched_calls = self.persisted * 2
+        batched_calls = self.stats['ssmPutCalls'] + self.stats['snsCalls']
+        stats = dict(self.stats)
+        stats.update({
+            'throttled'   : self.ssm_throttle.throttled + self.sns_throttle.throttled,
+            'apiCallsSaved': unbatched_calls - batched_calls
+        })
+        logger.info(f"Persisted {self.persisted} rotated secret(s): {stats}")
+        return stats
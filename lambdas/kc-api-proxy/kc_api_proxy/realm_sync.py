@@ -0,0 +1,335 @@
+import os, re, json, time, logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from .apiproxy import KeyCloakApiProxy
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+DEFAULT_SYNC_WORKERS = 8
+# each user is its own lookup; past this many in a realm's files it's quicker to just import
+DEFAULT_MAX_SYNC_USERS = 50
+# what partial export puts in place of client/idp secrets
+MASKED_SECRET = '**********'
+REALM_FILE_SUFFIX = '-realm.json'
+USERS_FILE = re.compile(r'^(?P<realm>.+)-users-\d+\.json$')
+
+# sections synced an entry at a time, and what their entries are matched on
+SYNCED_SECTIONS = {
+    'clientScopes'     : 'name',
+    'identityProviders': 'alias',
+    'clients'          : 'clientId'
+}
+# bits of an entry its PUT endpoint doesn't touch (they have endpoints of their own); a change in one needs the import
+UNSYNCED_ENTRY_KEYS = {
+    'clientScopes'     : ['protocolMappers'],
+    'identityProviders': [ ],
+    'clients'          : ['protocolMappers', 'defaultClientScopes', 'optionalClientScopes', 'authorizationSettings']
+}
+# exports hand out new ids, so what's in git and what's live won't always agree on them; entries are
+# matched on their names/aliases instead and ids never count as a difference
+GENERATED_ID_KEYS = ['id', 'internalId', 'containerId']
+# realm settings that aren't plain values but still go through the realm PUT
+REALM_SETTING_SECTIONS = ['attributes', 'browserSecurityHeaders', 'smtpServer', 'supportedLocales', 'eventsListeners', 'enabledEventTypes']
+IGNORED_REALM_KEYS = ['keycloakVersion', 'users']
+# users are only checked, never synced; these are the fields the users endpoint gives back
+USER_COMPARED_KEYS = ['username', 'enabled', 'emailVerified', 'firstName', 'lastName', 'email', 'attributes', 'requiredActions']
+# applied in this order (everything in a phase at the same time) so clients can lean on new scopes/idps
+SYNC_PHASES = ['realm', 'clientScopes', 'identityProviders', 'clients', 'authenticationFlows']
+
+def get_elapsed_ms(start: float) -> int:
+    return int((time.monotonic() - start) * 1000)
+
+def _is_empty(value) -> bool:
+    # keycloak leaves empty/null things out of what it gives back
+    return value is None or value == [] or value == {}
+
+# Whether live already has everything desired has. Only keys in desired are compared (keycloak adds
+# plenty of its own), list order and ids don't matter and a masked secret matches whatever's in the file.
+def matches(desired, live) -> bool:
+    if isinstance(desired, str) and live == MASKED_SECRET:
+        return True
+    if isinstance(desired, dict):
+        return isinstance(live, dict) and all(matches_key(desired, live, key) for key in desired if key not in GENERATED_ID_KEYS)
+    if isinstance(desired, list):
+        if not isinstance(live, list) or len(desired) != len(live):
+            return False
+        unmatched = list(live)
+        for item in desired:
+            index = next((index for index, candidate in enumerate(unmatched) if matches(item, candidate)), None)
+            if index is None:
+                return False
+            unmatched.pop(index)
+        return True
+    return desired == live
+
+def matches_key(desired: dict, live: dict, key: str) -> bool:
+    if key not in desired:
+        return True
+    if key not in live:
+        return _is_empty(desired[key])
+    return matches(desired[key], live[key])
+
+class RealmChange( ):
+    def __init__(self, realm_name: str, section: str, key: str, action: str, desired, live: dict = None):
+        self.realm_name = realm_name
+        self.section = section
+        self.key = key
+        self.action = action
+        self.desired = desired
+        self.live = live
+    def to_dict(self):
+        return {
+            'realmName': self.realm_name,
+            'section'  : self.section,
+            'key'      : self.key,
+            'action'   : self.action
+        }
+
+# What it takes to get one realm from live to desired: changes the admin api can make and reasons
+# (if any) it can't, which means the realm has to go through the import
+class RealmDiff( ):
+    def __init__(self, realm_name: str):
+        self.realm_name = realm_name
+        self.changes = [ ]
+        self.structural = [ ]
+    def to_dict(self):
+        return {
+            'realmName' : self.realm_name,
+            'changes'   : [ change.to_dict() for change in self.changes ],
+            'structural': self.structural
+        }
+
+def _diff_entries(diff: RealmDiff, section: str, desired_entries: List[dict], live_entries: List[dict]) -> None:
+    identity_key = SYNCED_SECTIONS[section]
+    live_index = { entry.get(identity_key): entry for entry in live_entries }
+    for entry in desired_entries:
+        identity = entry.get(identity_key)
+        current = live_index.get(identity)
+        if current is None:
+            diff.changes.append(RealmChange(diff.realm_name, section, identity, 'create', entry))
+        elif not matches(entry, current):
+            unsynced = [ key for key in UNSYNCED_ENTRY_KEYS[section] if not matches_key(entry, current, key) ]
+            if unsynced:
+                diff.structural.append(f"{section} {identity} has changes to {unsynced}")
+            else:
+                diff.changes.append(RealmChange(diff.realm_name, section, identity, 'update', entry, current))
+    # the import drops anything that isn't in the file; the sync doesn't delete
+    removed = [ identity for identity in live_index if identity not in [ entry.get(identity_key) for entry in desired_entries ] ]
+    if removed:
+        diff.structural.append(f"{section} {removed} aren't in the realm file")
+
+def _by_priority(executions: List[dict]) -> List[dict]:
+    return sorted(executions, key=lambda execution: execution.get('priority', 0))
+
+# Flows only get their executions' requirements synced; anything else about a flow (new/removed/moved
+# executions, new flows, config) is left to the import
+def _diff_flows(diff: RealmDiff, desired_flows: List[dict], live_flows: List[dict]) -> None:
+    live_index = { flow.get('alias'): flow for flow in live_flows }
+    for flow in desired_flows:
+        alias = flow.get('alias')
+        current = live_index.get(alias)
+        if current is None:
+            diff.structural.append(f"authenticationFlows {alias} doesn't exist yet")
+            continue
+        if matches(flow, current):
+            continue
+        executions = _by_priority(flow.get('authenticationExecutions') or [])
+        current_executions = _by_priority(current.get('authenticationExecutions') or [])
+        settings = { key: value for key, value in flow.items() if key != 'authenticationExecutions' }
+        same_shape = len(executions) == len(current_executions) and all(
+            matches({ key: value for key, value in execution.items() if key != 'requirement' }, current_execution)
+            for execution, current_execution in zip(executions, current_executions)
+        )
+        if not matches(settings, current) or not same_shape:
+            diff.structural.append(f"authenticationFlows {alias} has changes beyond execution requirements")
+        else:
+            diff.changes.append(RealmChange(diff.realm_name, 'authenticationFlows', alias, 'update', executions, current))
+    removed = [ alias for alias in live_index if alias not in [ flow.get('alias') for flow in desired_flows ] ]
+    if removed:
+        diff.structural.append(f"authenticationFlows {removed} aren't in the realm file")
+
+def _diff_users(diff: RealmDiff, desired_users: List[dict], live_users: Dict[str,Optional[dict]]) -> None:
+    for user in desired_users:
+        current = live_users.get(user['username'])
+        if current is None:
+            diff.structural.append(f"user {user['username']} doesn't exist yet")
+        elif not matches({ key: user[key] for key in USER_COMPARED_KEYS if key in user }, current):
+            diff.structural.append(f"user {user['username']} differs")
+
+# live is the realm's partial export (None if there's no such realm) and live_users the desired
+# users as the users endpoint has them (None if missing). Removals inside an entry (an attribute
+# dropped from a client, say) aren't seen; the PUTs wouldn't remove them either.
+def diff_realm(desired: dict, live: Optional[dict], live_users: Dict[str,Optional[dict]]) -> RealmDiff:
+    diff = RealmDiff(desired['realm'])
+    if live is None:
+        diff.structural.append("realm doesn't exist yet")
+        return diff
+    settings = { }
+    for key, value in desired.items():
+        if key in IGNORED_REALM_KEYS or key in GENERATED_ID_KEYS or matches_key(desired, live, key):
+            continue
+        if key in SYNCED_SECTIONS:
+            _diff_entries(diff, key, value, live.get(key) or [])
+        elif key == 'authenticationFlows':
+            _diff_flows(diff, value, live.get(key) or [])
+        elif key in REALM_SETTING_SECTIONS or not isinstance(value, (list, dict)):
+            settings[key] = value
+        else:
+            diff.structural.append(f"{key} differs")
+    if settings:
+        diff.changes.insert(0, RealmChange(diff.realm_name, 'realm', ','.join(sorted(settings)), 'update', settings))
+    _diff_users(diff, desired.get('users') or [], live_users)
+    return diff
+
+# Realm files the import task would pick up for the given import units (see the config import
+# lambda): every top level *-realm.json/*-users-N.json under each prefix unit (or the bucket root),
+# only the named realm's for realm units. Users files get folded into their realm's users.
+def load_desired_realms(s3_client, bucket: str, units: List[str] = None, max_workers: int = DEFAULT_SYNC_WORKERS) -> Dict[str,dict]:
+    units = units or [ '' ]
+    listings = [ (unit, None) if unit.endswith('/') or not unit else ('', unit) for unit in units ]
+    keys = [ ]
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for prefix, realm_name in listings:
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+            for item in page.get('Contents', []):
+                file_name = item['Key'][len(prefix):]
+                users_file = USERS_FILE.match(file_name)
+                file_realm = file_name[:-len(REALM_FILE_SUFFIX)] if file_name.endswith(REALM_FILE_SUFFIX) else users_file and users_file.group('realm')
+                if file_realm and (realm_name is None or file_realm == realm_name):
+                    keys.append(item['Key'])
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return { }
+    logger.info(f"Loading {len(keys)} realm file(s) from s3://{bucket}: {keys}")
+    def load(key: str) -> dict:
+        return json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(keys)), thread_name_prefix='kc-sync') as pool:
+        documents = list(zip(keys, pool.map(load, keys)))
+    realms = { document['realm']: document for key, document in documents if key.endswith(REALM_FILE_SUFFIX) }
+    for key, document in documents:
+        if not key.endswith(REALM_FILE_SUFFIX):
+            realm = realms.setdefault(document['realm'], { 'realm': document['realm'] })
+            realm['users'] = (realm.get('users') or [ ]) + (document.get('users') or [ ])
+    return realms
+
+# Brings live realms in line with their realm files through the admin api when that's all it
+# takes, so a deploy that only touched clients/scopes/idps/settings doesn't have to wait on an
+# import task. Every realm is exported and diffed first (all at the same time); if any of them has
+# a change the api can't make nothing is applied and the summary says why, so the caller can run
+# the import instead. Otherwise the changes go out a phase at a time, everything within a phase
+# at once. A change that fails leaves things part way; the import puts that right too.
+class RealmSyncEngine( ):
+    def __init__(self, kc: KeyCloakApiProxy, max_workers: int = DEFAULT_SYNC_WORKERS, max_users: int = DEFAULT_MAX_SYNC_USERS):
+        self.kc = kc
+        self.max_workers = max_workers
+        self.max_users = max_users
+
+    def _get_user(self, realm_name: str, username: str) -> Optional[dict]:
+        # the users endpoint searches; keycloak keeps usernames lower case
+        found = [ user for user in self.kc.get_user_by_username(realm_name, username) if user['username'] == username.lower() ]
+        return found[0] if found else None
+
+    def plan(self, desired_realms: Dict[str,dict]) -> List[RealmDiff]:
+        if not desired_realms:
+            return [ ]
+        # decided before any api calls; the import is happening either way so there's no point diffing
+        too_many_users = [ ]
+        for realm_name, realm in desired_realms.items():
+            user_count = len(realm.get('users') or [ ])
+            if user_count > self.max_users:
+                diff = RealmDiff(realm_name)
+                diff.structural.append(f"{user_count} users to check; more than the {self.max_users} the sync looks up")
+                too_many_users.append(diff)
+        if too_many_users:
+            return too_many_users
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='kc-sync') as pool:
+            exports = { realm_name: pool.submit(self.kc.partial_export_realm, realm_name) for realm_name in desired_realms }
+            users = {
+                (realm_name, user['username']): pool.submit(self._get_user, realm_name, user['username'])
+                for realm_name, realm in desired_realms.items() for user in realm.get('users') or [ ]
+            }
+            diffs = [ ]
+            for realm_name, desired in desired_realms.items():
+                live_users = { username: future.result() for (user_realm, username), future in users.items() if user_realm == realm_name }
+                diffs.append(diff_realm(desired, exports[realm_name].result(), live_users))
+        return diffs
+
+    def _apply_flow_requirements(self, change: RealmChange) -> None:
+        # the executions endpoint flattens sub flows in; the flow's own executions are level 0, in priority order
+        executions = [ execution for execution in self.kc.get_flow_executions(change.realm_name, change.key) if execution.get('level', 0) == 0 ]
+        executions.sort(key=lambda execution: execution.get('index', 0))
+        if len(executions) != len(change.desired):
+            raise RuntimeError(f"Flow {change.key} in realm {change.realm_name} has {len(executions)} executions; expected {len(change.desired)}")
+        for desired, execution in zip(change.desired, executions):
+            expected = desired.get('flowAlias') if desired.get('autheticatorFlow') else desired.get('authenticator')
+            actual = execution.get('displayName') if execution.get('authenticationFlow') else execution.get('providerId')
+            if expected != actual:
+                raise RuntimeError(f"Flow {change.key} in realm {change.realm_name} has {actual} where {expected} was expected")
+            if desired.get('requirement') != execution.get('requirement'):
+                self.kc.update_flow_execution(change.realm_name, change.key, dict(execution, requirement=desired['requirement']))
+
+    def _apply_change(self, change: RealmChange) -> None:
+        realm_name, desired, live = change.realm_name, change.desired, change.live
+        if change.section == 'realm':
+            self.kc.update_realm(realm_name, desired)
+        elif change.section == 'clientScopes':
+            if change.action == 'create':
+                self.kc.create_client_scope(realm_name, desired)
+            else:
+                self.kc.update_client_scope(realm_name, live['id'], dict(desired, id=live['id']))
+        elif change.section == 'identityProviders':
+            if change.action == 'create':
+                self.kc.create_identity_provider(realm_name, desired)
+            else:
+                self.kc.update_identity_provider(realm_name, change.key, dict(desired, internalId=live.get('internalId')))
+        elif change.section == 'clients':
+            if change.action == 'create':
+                self.kc.create_client(realm_name, desired)
+            else:
+                # the file only has the default secret; an update keeps whatever it's been rotated to
+                client = { key: value for key, value in desired.items() if key != 'secret' }
+                self.kc.update_client(realm_name, live['id'], dict(client, id=live['id']))
+        elif change.section == 'authenticationFlows':
+            self._apply_flow_requirements(change)
+
+    def apply(self, diffs: List[RealmDiff]) -> List[str]:
+        # returns the errors from changes that failed; a failed phase stops the ones after it
+        changes = [ change for diff in diffs for change in diff.changes ]
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='kc-sync') as pool:
+            for phase in SYNC_PHASES:
+                phase_changes = [ change for change in changes if change.section == phase ]
+                futures = [ (change, pool.submit(self._apply_change, change)) for change in phase_changes ]
+                errors = [ ]
+                for change, future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"Failed to {change.action} {change.section} {change.key} in realm {change.realm_name}: {e}")
+                        errors.append(f"{change.realm_name}: {change.action} {change.section} {change.key} failed: {e}")
+                if errors:
+                    return errors
+        return [ ]
+
+    def sync(self, desired_realms: Dict[str,dict], dry_run: bool = False) -> dict:
+        start = time.monotonic()
+        diffs = self.plan(desired_realms)
+        fallback_reasons = [ f"{diff.realm_name}: {reason}" for diff in diffs for reason in diff.structural ]
+        if not diffs:
+            fallback_reasons.append("no realm files to sync")
+        changes = [ change for diff in diffs for change in diff.changes ]
+        logger.info(f"Realm sync planned {len(changes)} change(s) across {len(diffs)} realm(s) in {get_elapsed_ms(start)}ms; {len(fallback_reasons)} reason(s) to import instead")
+        errors = [ ]
+        if not fallback_reasons and not dry_run:
+            errors = self.apply(diffs)
+            fallback_reasons.extend(errors)
+        summary = {
+            'synced'         : not fallback_reasons and not dry_run,
+            'dryRun'         : dry_run,
+            'fallbackReasons': fallback_reasons,
+            'applyFailed'    : bool(errors),
+            'durationMs'     : get_elapsed_ms(start),
+            'realms'         : [ diff.to_dict() for diff in diffs ]
+        }
+        logger.info(f"Realm sync finished in {summary['durationMs']}ms; synced: {summary['synced']}, fallback reasons: {fallback_reasons}")
+        return summary
@@ -0,0 +1,114 @@
+import os, json, time, tempfile, threading, logging
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Set, Tuple
+from .apiproxy import KeyCloakApiProxy, DEFAULT_BULK_WORKERS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+DEFAULT_IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60
+
+# Remembers which (realm, userId) pairs were recently removed so an alarm that keeps firing
+# doesn't delete (or look up) the same users over and over. Wall clock time on purpose; the
+# records have to make sense to the next container too.
+class IdempotencyStore(ABC):
+    def __init__(self, ttl_seconds: float = DEFAULT_IDEMPOTENCY_TTL_SECONDS, clock: Callable[[], float] = time.time):
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def _load(self) -> dict:
+        pass
+
+    @abstractmethod
+    def _save(self, records: dict) -> None:
+        pass
+
+    @staticmethod
+    def _key(location: Tuple[str,str]) -> str:
+        return '/'.join(location)
+
+    def _live_records(self) -> dict:
+        cutoff = self.clock() - self.ttl_seconds
+        return { key: removed_at for key, removed_at in self._load().items() if removed_at > cutoff }
+
+    def seen(self, locations: Iterable[Tuple[str,str]]) -> Set[Tuple[str,str]]:
+        with self._lock:
+            records = self._live_records()
+        return { location for location in locations if self._key(location) in records }
+
+    def record(self, locations: Iterable[Tuple[str,str]]) -> None:
+        with self._lock:
+            # expired records get dropped whenever we write so the store doesn't grow forever
+            records = self._live_records()
+            now = self.clock()
+            records.update({ self._key(location): now for location in locations })
+            self._save(records)
+
+# Lives as long as the container does; good for tests and as a warm invocation fallback
+class InMemoryIdempotencyStore(IdempotencyStore):
+    def __init__(self, ttl_seconds: float = DEFAULT_IDEMPOTENCY_TTL_SECONDS, clock: Callable[[], float] = time.time):
+        super().__init__(ttl_seconds, clock)
+        self._records = { }
+
+    def _load(self) -> dict:
+        return dict(self._records)
+
+    def _save(self, records: dict) -> None:
+        self._records = dict(records)
+
+class FileIdempotencyStore(IdempotencyStore):
+    def __init__(self, path: str, ttl_seconds: float = DEFAULT_IDEMPOTENCY_TTL_SECONDS, clock: Callable[[], float] = time.time):
+        super().__init__(ttl_seconds, clock)
+        self.path = path
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return { }
+        except ValueError:
+            logger.warning(f"Idempotency store {self.path} is unreadable; starting fresh")
+            return { }
+
+    def _save(self, records: dict) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        # write + rename so a timed out invocation can't leave half a file behind
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.idempotency-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(records, f)
+        os.replace(temp_path, self.path)
+
+# Removes the given duplicate users concurrently. Locations are deduped, anything the store says
+# was already removed is skipped, and a 404 counts as removed since that's what we wanted anyway.
+def remove_duplicate_users(kc: KeyCloakApiProxy, user_locations: Iterable[Tuple[str,str]], store: IdempotencyStore, max_workers: int = DEFAULT_BULK_WORKERS) -> dict:
+    locations = set(user_locations)
+    already_removed = store.seen(locations)
+    pending = locations - already_removed
+    if already_removed:
+        logger.info(f"Skipping {len(already_removed)} user(s) removed by a previous invocation")
+
+    realm_user_ids = { }
+    for realm_name, user_id in pending:
+        realm_user_ids.setdefault(realm_name, [ ]).append(user_id)
+
+    removed, failed = [ ], { }
+    for realm_name, user_ids in realm_user_ids.items():
+        for user_id, error in kc.remove_users(realm_name, user_ids, max_workers, missing_ok=True).items():
+            if error is None:
+                removed.append((realm_name, user_id))
+            else:
+                failed[f"{realm_name}/{user_id}"] = error
+    store.record(removed)
+
+    summary = {
+        'found'  : len(locations),
+        'skipped': len(already_removed),
+        'removed': len(removed),
+        'failed' : failed
+    }
+    logger.info(f"Duplicate user remediation: {summary}")
+    return summary
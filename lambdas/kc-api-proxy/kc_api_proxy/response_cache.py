@@ -0,0 +1,97 @@
+import time, json, threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_TTL_SECONDS = 30
+# seconds; anything not listed gets default_ttl
+DEFAULT_ENDPOINT_TTLS = {
+    'realms' : 60,
+    'clients': 30,
+    'client' : 30
+}
+
+class CachedResponse( ):
+    def __init__(self, body: str, etag: str = None, last_modified: str = None):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = 0
+    def json(self):
+        # parsed fresh on every hit so callers can't mutate what's cached
+        return json.loads(self.body)
+    def validators(self) -> dict:
+        headers = { }
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+# Read-through cache for the read only admin GETs. Entries live for a per endpoint TTL and the
+# least recently used ones get evicted past max_entries. Expired entries that came back with an
+# ETag/Last-Modified are revalidated with a conditional GET instead of refetched outright (the
+# admin api doesn't send validators today, so in practice that's just a plain refetch).
+class ResponseCache( ):
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, endpoint_ttls: dict = None, default_ttl: float = DEFAULT_TTL_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.endpoint_ttls = dict(DEFAULT_ENDPOINT_TTLS, **(endpoint_ttls or {}))
+        self.default_ttl = default_ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries))
+
+    def lookup(self, key: str) -> Optional[CachedResponse]:
+        # returns the entry (fresh or stale) and counts a hit only if it is still fresh
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            if entry.expires_at > self.clock():
+                self.stats['hits'] += 1
+            else:
+                self.stats['misses'] += 1
+            return entry
+
+    def is_fresh(self, entry: CachedResponse) -> bool:
+        return entry.expires_at > self.clock()
+
+    def store(self, key: str, endpoint_name: str, entry: CachedResponse) -> CachedResponse:
+        with self._lock:
+            entry.expires_at = self.clock() + self.endpoint_ttls.get(endpoint_name, self.default_ttl)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+        return entry
+
+    def revalidated(self, key: str, endpoint_name: str, entry: CachedResponse) -> CachedResponse:
+        with self._lock:
+            self.stats['revalidated'] += 1
+        return self.store(key, endpoint_name, entry)
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.stats['invalidations'] += 1
+
+    def invalidate_prefix(self, prefix: str) -> None:
+        with self._lock:
+            stale_keys = [ key for key in self._entries if key.startswith(prefix) ]
+            for key in stale_keys:
+                del self._entries[key]
+            self.stats['invalidations'] += len(stale_keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.stats['invalidations'] += len(self._entries)
+            self._entries.clear()
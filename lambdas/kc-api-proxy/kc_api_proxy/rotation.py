@@ -0,0 +1,173 @@
+import os, time, random, logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+from .apiproxy import KeyCloakApiProxy
+from .persistence import SecretPersistenceStage
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_BASE_DELAY = 0.5
+# realm the proxy's own admin client lives in
+ADMIN_REALM = 'master'
+
+def get_elapsed_ms(start: float) -> int:
+    return int((time.monotonic() - start) * 1000)
+
+def retry_call(func: Callable, max_attempts: int = DEFAULT_MAX_ATTEMPTS, base_delay: float = DEFAULT_RETRY_BASE_DELAY, description: str = ""):
+    # returns (result, attempts); re-raises whatever the last attempt threw
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return func(), attempt
+        except Exception as e:
+            if attempt >= max_attempts:
+                raise
+            # full jitter so a bunch of workers failing together don't retry together
+            delay = random.uniform(0, base_delay * (2 ** (attempt - 1)))
+            logger.warning(f"{description} failed on attempt {attempt}/{max_attempts}: {e}; retrying in {delay:.2f}s")
+            time.sleep(delay)
+
+class ClientRotationResult( ):
+    def __init__(self, realm_name: str, client: dict, ssm_path: str):
+        self.realm_name = realm_name
+        self.client_id = client['clientId']
+        self.client_uuid = client['id']
+        self.ssm_path = ssm_path
+        # only held until it's stored in ssm; never part of to_dict
+        self.secret = None
+        self.success = False
+        self.stage = None
+        self.error = None
+        self.attempts = 0
+        self.timings = {}
+        self.duration_ms = 0
+    def to_dict(self):
+        return {
+            'realmName' : self.realm_name,
+            'clientId'  : self.client_id,
+            'ssmPath'   : self.ssm_path,
+            'success'   : self.success,
+            'failedStage': None if self.success else self.stage,
+            'error'     : self.error,
+            'attempts'  : self.attempts,
+            'timingsMs' : self.timings,
+            'durationMs': self.duration_ms
+        }
+
+# Rotates every confidential client across all realms. Client lists are fetched in parallel
+# and secrets are rotated on a bounded worker pool. Each worker stores its client's secret in
+# ssm as soon as it rotates and queues the sns notification, which goes out in batches. The
+# admin client the proxy itself logs in with goes first, on its own, so its new secret is in
+# ssm (and in the proxy) before anything else is rotated. One bad client doesn't stop the rest.
+class SecretRotationEngine( ):
+    def __init__(self, kc: KeyCloakApiProxy, ssm_client, sns_client, get_ssm_path: Callable[[str,str],str], sns_topicarn: str,
+                 max_workers: int = DEFAULT_MAX_WORKERS, max_attempts: int = DEFAULT_MAX_ATTEMPTS, retry_base_delay: float = DEFAULT_RETRY_BASE_DELAY):
+        self.kc = kc
+        self.get_ssm_path = get_ssm_path
+        self.persistence = SecretPersistenceStage(ssm_client, sns_client, sns_topicarn)
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+
+    def _retry(self, func: Callable, description: str):
+        return retry_call(func, self.max_attempts, self.retry_base_delay, description)
+
+    def _get_confidential_clients(self, realm_name: str) -> List[dict]:
+        clients, _ = self._retry(lambda: self.kc.get_clients(realm_name), f"Fetching clients for realm {realm_name}")
+        return [ client for client in clients if not client['publicClient'] and not client['bearerOnly'] ]
+
+    def _is_admin_client(self, realm_name: str, client: dict) -> bool:
+        return realm_name == ADMIN_REALM and client['clientId'] == self.kc.client_id
+
+    def _rotate_secret(self, result: ClientRotationResult, client: dict) -> str:
+        # The rotate POST isn't idempotent; blindly retrying one whose response got lost would
+        # rotate again and throw away a secret keycloak already handed out. So after a failure
+        # the secret is re-read (a plain GET, safe to retry) and we only rotate again if it's
+        # still the one the client had when we listed it.
+        previous = client.get('secret')
+        description = f"rotate for {result.realm_name}/{result.client_id}"
+        for attempt in range(1, self.max_attempts + 1):
+            result.attempts += 1
+            try:
+                return self.kc.rotate_secret(result.realm_name, result.client_uuid)['value']
+            except Exception as e:
+                error = e
+                logger.warning(f"{description} failed on attempt {attempt}/{self.max_attempts}: {e}; checking whether it went through")
+            current, _ = self._retry(lambda: self.kc.get_client_secret(result.realm_name, result.client_uuid)['value'], f"Re-reading secret for {result.realm_name}/{result.client_id}")
+            # without the listed secret we can't tell, but whatever keycloak holds now is the one ssm needs
+            if previous is None or current != previous:
+                logger.info(f"{description} went through despite the error; keeping the secret it set")
+                return current
+            if attempt < self.max_attempts:
+                time.sleep(random.uniform(0, self.retry_base_delay * (2 ** (attempt - 1))))
+        raise error
+
+    def _rotate_client(self, realm_name: str, client: dict) -> ClientRotationResult:
+        result = ClientRotationResult(realm_name, client, self.get_ssm_path(realm_name, client['clientId']))
+        result.stage = 'rotate'
+        start = time.monotonic()
+        try:
+            result.secret = self._rotate_secret(result, client)
+        except Exception as e:
+            logger.error(f"Rotation for {realm_name}/{result.client_id} failed during {result.stage}: {e}")
+            result.error = str(e)
+        finally:
+            result.timings['rotate'] = get_elapsed_ms(start)
+        return result
+
+    def _rotate_and_store(self, realm_client: Tuple[str,dict]) -> ClientRotationResult:
+        result = self._rotate_client(*realm_client)
+        if result.secret is not None:
+            self.persistence.submit(result)
+        return result
+
+    def _rotate_admin_client(self, realm_name: str, client: dict) -> ClientRotationResult:
+        result = self._rotate_client(realm_name, client)
+        if result.secret is None:
+            return result
+        secret = result.secret
+        # stored before anything else rotates: a credential refresh reads the admin secret back out of ssm
+        self.persistence.submit(result)
+        # and the proxy switches over now instead of waiting for keycloak to reject the old secret
+        self.kc._set_credentials(result.client_id, secret)
+        return result
+
+    def _list_realm_clients(self, pool: ThreadPoolExecutor, realm_names: List[str]) -> Tuple[List[Tuple[str,dict]], dict]:
+        futures = { realm_name: pool.submit(self._get_confidential_clients, realm_name) for realm_name in realm_names }
+        realm_clients, realm_errors = [ ], { }
+        for realm_name, future in futures.items():
+            try:
+                realm_clients += [ (realm_name, client) for client in future.result() ]
+            except Exception as e:
+                logger.error(f"Unable to list clients for realm {realm_name}; skipping it: {e}")
+                realm_errors[realm_name] = str(e)
+        return realm_clients, realm_errors
+
+    def run(self, realm_names: List[str] = None) -> dict:
+        start = time.monotonic()
+        # fetched serially first (if not handed to us); this also settles the token/credential refresh before fanning out
+        realm_names = realm_names if realm_names is not None else [ realm['realm'] for realm in self.kc.get_realms() ]
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='kc-rotate') as pool:
+            realm_clients, realm_errors = self._list_realm_clients(pool, realm_names)
+            admin_clients = [ rc for rc in realm_clients if self._is_admin_client(*rc) ]
+            other_clients = [ rc for rc in realm_clients if not self._is_admin_client(*rc) ]
+            results = [ self._rotate_admin_client(*realm_client) for realm_client in admin_clients ]
+            logger.info(f"Rotating {len(other_clients)} more confidential client(s) across {len(realm_names)} realm(s) with {self.max_workers} worker(s)")
+            results += list(pool.map(self._rotate_and_store, other_clients))
+        persistence_stats = self.persistence.flush()
+        for r in results:
+            r.secret = None
+            r.duration_ms = sum(r.timings.values())
+        summary = {
+            'realms'     : len(realm_names),
+            'succeeded'  : len([ r for r in results if r.success ]),
+            'failed'     : len([ r for r in results if not r.success ]),
+            'realmErrors': realm_errors,
+            'persistence': persistence_stats,
+            'durationMs' : get_elapsed_ms(start),
+            'clients'    : [ r.to_dict() for r in results ]
+        }
+        logger.info(f"Secret rotation finished: {summary['succeeded']} succeeded, {summary['failed']} failed, {len(realm_errors)} realm(s) skipped in {summary['durationMs']}ms")
+        return summary
@@ -0,0 +1,64 @@
+import os, time, json, threading, functools, logging
+
+# Imported first thing by the package so this is as close to the start of the cold start as we get
+IMPORT_STARTED = time.monotonic()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+def get_elapsed_ms(start: float, end: float = None) -> int:
+    return int(((end or time.monotonic()) - start) * 1000)
+
+# Cold start timings for this container. Import time is filled in once the handler module has
+# finished loading, client times as each boto3 client gets built, and the first request once the
+# first invocation returns. Logged as a single json line so it can be pulled out with insights.
+class StartupProfile( ):
+    def __init__(self, import_started: float):
+        self.import_started = import_started
+        self.import_ms = None
+        self.client_init_ms = { }
+        self.first_request_ms = None
+        self.first_handler = None
+
+    def mark_imported(self) -> None:
+        if self.import_ms is None:
+            self.import_ms = get_elapsed_ms(self.import_started)
+
+    def to_dict(self) -> dict:
+        return {
+            'importMs'      : self.import_ms,
+            'clientInitMs'  : dict(self.client_init_ms),
+            'firstRequestMs': self.first_request_ms,
+            'firstHandler'  : self.first_handler
+        }
+
+startup_profile = StartupProfile(IMPORT_STARTED)
+
+_clients = { }
+_clients_lock = threading.Lock()
+
+# boto3 clients are built the first time a handler actually needs one instead of at import time,
+# then cached for the rest of the container's life
+def get_client(service_name: str):
+    with _clients_lock:
+        if service_name not in _clients:
+            start = time.monotonic()
+            # boto3 itself is a big chunk of import time so it waits too
+            import boto3
+            _clients[service_name] = boto3.client(service_name)
+            startup_profile.client_init_ms[service_name] = get_elapsed_ms(start)
+        return _clients[service_name]
+
+def profile_cold_start(handler):
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if startup_profile.first_handler is not None:
+            return handler(event, context)
+        startup_profile.first_handler = handler.__name__
+        start = time.monotonic()
+        try:
+            return handler(event, context)
+        finally:
+            startup_profile.first_request_ms = get_elapsed_ms(start)
+            logger.info(f"Cold start profile: {json.dumps(startup_profile.to_dict())}")
+    return wrapper
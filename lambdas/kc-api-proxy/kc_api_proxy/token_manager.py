@@ -0,0 +1,123 @@
+import time, threading, logging
+from typing import Callable, Optional, Tuple
+from .transport import HttpTransport
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_SKEW_SECONDS = 30
+TOKEN_ENDPOINT = '/realms/master/protocol/openid-connect/token'
+
+# Caches the admin access token and refreshes it before it expires. Expiry is tracked
+# against a monotonic clock so a warm lambda (or a wall clock adjustment) can't make us
+# trust a stale token. Only one grant is ever in flight; concurrent callers block on the
+# lock and pick up whatever token the winner fetched.
+class TokenManager( ):
+    def __init__(self, token_url: str, transport: HttpTransport, verify_ssl: bool = True,
+                 refresh_skew_seconds: float = DEFAULT_REFRESH_SKEW_SECONDS, clock: Callable[[], float] = time.monotonic):
+        self.token_url = token_url
+        self.transport = transport
+        self.verify_ssl = verify_ssl
+        self.refresh_skew_seconds = refresh_skew_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'client_credentials_grants': 0, 'refresh_grants': 0, 'failed_refresh_grants': 0, 'cache_hits': 0}
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._clear_token()
+
+    def _clear_token(self) -> None:
+        self.access_token = self.refresh_token = None
+        self.access_expires_at = self.refresh_expires_at = 0
+
+    def _incr(self, stat: str) -> None:
+        with self._stats_lock:
+            self._stats[stat] += 1
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def _usable_access_token(self, now: float) -> Optional[str]:
+        # read once; an invalidate() from another thread can clear it at any point outside the lock
+        access_token = self.access_token
+        if access_token and now < self.access_expires_at - self.refresh_skew_seconds:
+            return access_token
+        return None
+
+    def _refresh_token_usable(self, now: float) -> bool:
+        return bool(self.refresh_token) and now < self.refresh_expires_at - self.refresh_skew_seconds
+
+    def _set_token_info(self, token: dict, issued_at: float) -> None:
+        self.access_token = token['access_token']
+        self.access_expires_at = issued_at + token['expires_in']
+        # newer keycloak versions don't hand out refresh tokens for client_credentials grants
+        self.refresh_token = token.get('refresh_token')
+        self.refresh_expires_at = issued_at + token.get('refresh_expires_in', 0)
+
+    def _post_token_request(self, payload: str, credentials: Tuple[str,str]) -> None:
+        # stamp the issue time before the round trip so expiry errs on the early side
+        issued_at = self.clock()
+        r = self.transport.post(
+            url     = self.token_url,
+            auth    = credentials,
+            headers = {'Content-Type' : 'application/x-www-form-urlencoded'},
+            data    = bytes(payload.encode('utf-8')),
+            verify  = self.verify_ssl
+        )
+        r.raise_for_status()
+        self._set_token_info(r.json(), issued_at)
+
+    def _client_credentials_grant(self, credentials: Tuple[str,str]) -> None:
+        logger.info(f"Creating new access token with user {credentials[0]}")
+        self._incr('client_credentials_grants')
+        self._post_token_request("grant_type=client_credentials", credentials)
+
+    def _refresh_grant(self, credentials: Tuple[str,str]) -> bool:
+        logger.info(f"Cached access token is about to expire for {credentials[0]}; refreshing it")
+        self._incr('refresh_grants')
+        payload = f"refresh_token={self.refresh_token}&client_id={credentials[0]}&grant_type=refresh_token"
+        try:
+            self._post_token_request(payload, credentials)
+            return True
+        except Exception as e:
+            # refresh token may have been revoked (session cleared, realm cache cleared, etc)
+            logger.warning(f"Refreshing access token failed; falling back to client_credentials grant: {e}")
+            self._incr('failed_refresh_grants')
+            self._clear_token()
+            return False
+
+    def has_usable_token(self) -> bool:
+        return self._usable_access_token(self.clock()) is not None
+
+    def get_access_token(self, get_credentials: Callable[[], Tuple[str,str]]) -> str:
+        access_token = self._usable_access_token(self.clock())
+        if access_token:
+            self._incr('cache_hits')
+            return access_token
+        with self._lock:
+            # someone else may have refreshed while we waited on the lock
+            now = self.clock()
+            access_token = self._usable_access_token(now)
+            if access_token:
+                self._incr('cache_hits')
+                return access_token
+            credentials = get_credentials()
+            if not (self._refresh_token_usable(now) and self._refresh_grant(credentials)):
+                self._client_credentials_grant(credentials)
+            return self.access_token
+
+_shared_token_managers = {}
+_shared_token_managers_lock = threading.Lock()
+
+# Keyed by token url + client id so warm lambda invocations keep using a token
+# that is still good instead of doing another grant
+def get_shared_token_manager(base_url: str, client_id: str, transport: HttpTransport, verify_ssl: bool = True, **manager_kwargs) -> TokenManager:
+    token_url = f"{base_url}{TOKEN_ENDPOINT}"
+    with _shared_token_managers_lock:
+        key = (token_url, client_id)
+        if key not in _shared_token_managers:
+            _shared_token_managers[key] = TokenManager(token_url, transport, verify_ssl, **manager_kwargs)
+        return _shared_token_managers[key]
@@ -0,0 +1,77 @@
+import requests, threading, logging
+from requests.adapters import HTTPAdapter
+from typing import Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 15
+
+# Owns a requests.Session with a sized connection pool so every admin api call
+# doesn't pay for a brand new TCP+TLS handshake with the ALB. One of these can be
+# shared by multiple proxies (and across warm lambda invocations) since the session
+# only holds connections and not any auth state.
+class HttpTransport( ):
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE, keep_alive: bool = True,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT, read_timeout: float = DEFAULT_READ_TIMEOUT):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.default_timeout = (connect_timeout, read_timeout)
+        self._lock = threading.Lock()
+        self._requests_sent = 0
+        self.session = self._build_session()
+
+    def _build_session(self) -> requests.Session:
+        session = requests.Session()
+        # retries are left to the callers; the proxy already has its own
+        # invalid secret retry and we don't want urllib3 silently replaying POSTs
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0, pool_block=False)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Connection'] = 'keep-alive' if self.keep_alive else 'close'
+        return session
+
+    def request(self, method: str, url: str, timeout: Union[float, Tuple[float,float]] = None, **kwargs) -> requests.Response:
+        with self._lock:
+            self._requests_sent += 1
+        return self.session.request(method, url, timeout=timeout or self.default_timeout, **kwargs)
+
+    def post(self, url: str, timeout: Union[float, Tuple[float,float]] = None, **kwargs) -> requests.Response:
+        return self.request('POST', url, timeout, **kwargs)
+
+    def _connection_pools(self) -> list:
+        # both schemes get the same adapter mounted; don't count its pools twice
+        adapters = { id(adapter): adapter for adapter in self.session.adapters.values() }.values()
+        pools = [ ]
+        for adapter in adapters:
+            pool_manager = getattr(adapter, 'poolmanager', None)
+            if pool_manager:
+                pools += [ pool_manager.pools[key] for key in pool_manager.pools.keys() ]
+        return pools
+
+    def get_stats(self) -> dict:
+        # urllib3 tracks how many connections each host pool has had to open;
+        # anything sent beyond that went over an already open (kept alive) connection
+        opened = sum(pool.num_connections for pool in self._connection_pools())
+        return {
+            'requests'           : self._requests_sent,
+            'connections_opened' : opened,
+            'connections_reused' : max(self._requests_sent - opened, 0)
+        }
+
+    def close(self) -> None:
+        self.session.close()
+
+_shared_transport = None
+_shared_transport_lock = threading.Lock()
+
+# Module level so it survives across warm lambda invocations; the first caller
+# decides the pool configuration
+def get_shared_transport(**transport_kwargs) -> HttpTransport:
+    global _shared_transport
+    with _shared_transport_lock:
+        if _shared_transport is None:
+            logger.debug(f"Creating shared http transport with {transport_kwargs or 'default settings'}")
+            _shared_transport = HttpTransport(**transport_kwargs)
+        return _shared_transport
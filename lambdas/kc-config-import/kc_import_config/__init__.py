@@ -1,5 +1,10 @@
+# has to be first so the cold start import timing covers everything below
+from .startup import startup_profile
+
 import logging
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-from .cp_config_import import handler as cp_handler
\ No newline at end of file
+from .cp_config_import import handler as cp_handler
+
+startup_profile.mark_imported()
@@ -1,6 +1,9 @@
-import boto3, os, logging, re
-from datetime import datetime
-from typing import List, Tuple
+import os, logging, re
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+from .log_scanner import LogScanner
+from .log_query import LogsInsightsQuery
+from .task_definitions import TaskDefinitionResolver, task_definition_resolver
 
 logger = logging.getLogger(__name__)
 
@@ -14,30 +17,41 @@ def find_task(ecs_client, cluster, startedby_id):
         logger.warn(f"Found {len(task_arns)} in {cluster} startedBy {startedby_id}.. there shouldn't be more than one and we are going to pretend there only was one")
     return ecs_client.describe_tasks(cluster=cluster, tasks=task_arns)['tasks'][0]
 
-def get_task_logs_location(ecs_client, task_definition_arn: str, task_arn: str) -> Tuple[str,str]:
-    task_definition = ecs_client.describe_task_definition(taskDefinition=task_definition_arn)
-    log_options = task_definition['taskDefinition']['containerDefinitions'][0]['logConfiguration']['options']
-    container_name = task_definition['taskDefinition']['containerDefinitions'][0]['name']
+def get_task_logs_locations(ecs_client, task_definition_arn: str, task_arn: str, resolver: TaskDefinitionResolver = None) -> List[Tuple[str,str]]:
+    # (group, stream) for every container in the task that logs to cloudwatch
+    resolver = resolver or task_definition_resolver
     task_id = task_arn.split('/')[-1]
-    return (log_options['awslogs-group'], f"{log_options['awslogs-stream-prefix']}/{container_name}/{task_id}")
+    return [ (log_config.log_group, log_config.stream_for_task(task_id)) for log_config in resolver.resolve(ecs_client, task_definition_arn) ]
 
-def run_task(ecs_client, cluster: str, task_subnets: List[str], task_definition: str, startedby_id: str = "config-importer") -> dict:
+def get_task_logs_location(ecs_client, task_definition_arn: str, task_arn: str, container_name: str, resolver: TaskDefinitionResolver = None) -> Tuple[str,str]:
+    # (group, stream) of the named container; the import finished message only shows up in keycloak's logs
+    resolver = resolver or task_definition_resolver
+    task_id = task_arn.split('/')[-1]
+    for log_config in resolver.resolve(ecs_client, task_definition_arn):
+        if log_config.container_name == container_name:
+            return (log_config.log_group, log_config.stream_for_task(task_id))
+    raise RuntimeError(f"Container {container_name} in {task_definition_arn} doesn't log to cloudwatch (or isn't in the task definition)")
+
+def run_task(ecs_client, cluster: str, task_subnets: List[str], task_definition: str, startedby_id: str = "config-importer", overrides: dict = None) -> dict:
     # public ip is needed for fargate so that it can pull the container image.
     # if we set up a nat gateway/instance this can just be set to disabled either way.
     logger.info(f'Starting task {task_definition} in cluster {cluster}...')
-    tasks = ecs_client.run_task(
-        cluster              = cluster,
-        launchType           = 'FARGATE',
-        taskDefinition       = task_definition,
-        count                = 1,
-        startedBy            = startedby_id,
-        networkConfiguration = {
+    run_task_kwargs = {
+        'cluster'             : cluster,
+        'launchType'          : 'FARGATE',
+        'taskDefinition'      : task_definition,
+        'count'               : 1,
+        'startedBy'           : startedby_id,
+        'networkConfiguration': {
             'awsvpcConfiguration' : {
                 'subnets'       :  task_subnets,
                 'assignPublicIp': 'ENABLED'
             }
         }
-    )
+    }
+    if overrides:
+        run_task_kwargs['overrides'] = overrides
+    tasks = ecs_client.run_task(**run_task_kwargs)
     return tasks['tasks'][0]
 
 def stop_task(ecs_client, cluster: str, task_arn: str, reason: str):
@@ -50,22 +64,64 @@ def get_timestamp(datetime_obj: datetime) -> int:
 def get_timestamp_now() -> int:
     return get_timestamp(datetime.utcnow())
     
-def kc_finished_importing(logs_client, group: str, stream: str) -> bool:
-    logFilterEndTime = get_timestamp_now()
-    # now - 1 hour
-    logFilterStartTime = logFilterEndTime - 3600000
-    regex_match = r".*Import finished successfully"
-    filter_pattern = '"KC-SERVICES0032"'
-    logger.info(f"Checking log group {group} and stream {stream} for logs that match '{filter_pattern}'")
-    paginator = logs_client.get_paginator("filter_log_events")
-    messages = []
-    for logs in paginator.paginate(logGroupName=group, logStreamNames=[stream], filterPattern=filter_pattern, startTime=logFilterStartTime, endTime=logFilterEndTime):
-        messages += [ event['message'] for event in logs['events'] if re.match(regex_match, event['message']) ]
-    return len(messages) >= 1
+# Log lines that mark the phases of an import after the container is up. WFLYSRV0049 is wildfly
+# announcing "Keycloak x.y.z (WildFly Core ...) starting", KC-SERVICES0032 the end of the import.
+IMPORT_LOG_PHASES = {
+    'keycloakBoot'  : ('WFLYSRV0049', r".*starting"),
+    'importFinished': ('KC-SERVICES0032', r".*Import finished successfully")
+}
+
+def get_import_phases_insights_query(stream: str) -> str:
+    codes = '|'.join([ code for code, _ in IMPORT_LOG_PHASES.values() ])
+    return '\n'.join([
+        'fields @timestamp, @message',
+        f'| filter @logStream = "{stream}"',
+        f'| filter @message like /{codes}/',
+        '| sort @timestamp asc',
+        '| limit 50'
+    ])
+
+def get_insights_timestamp(value: str) -> int:
+    # insights hands back "2021-03-04 05:06:07.890" in utc
+    return get_timestamp(datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f").replace(tzinfo=timezone.utc))
+
+def match_import_phase(message: str) -> str:
+    for phase, (code, regex_match) in IMPORT_LOG_PHASES.items():
+        if code in message and re.match(regex_match, message):
+            return phase
+    return None
+
+# Finds when each of the given log phases first happened between start/end (epoch ms). Returns
+# phase -> epoch ms for the ones that turned up; stops scanning once all of them have.
+def find_import_phases(logs_client, group: str, stream: str, start_time: int, end_time: int, phases: List[str] = None,
+                       scanner: LogScanner = None, insights: LogsInsightsQuery = None) -> Dict[str,int]:
+    wanted = set(phases or IMPORT_LOG_PHASES)
+    found = { }
+    if insights:
+        logger.info(f"Querying log group {group} and stream {stream} with insights for import phases {sorted(wanted)}")
+        try:
+            for row in insights.run([ group ], get_import_phases_insights_query(stream), start_time, end_time):
+                phase = match_import_phase(row.get('@message', ''))
+                if phase in wanted and phase not in found:
+                    found[phase] = get_insights_timestamp(row['@timestamp'])
+            return found
+        except Exception as e:
+            logger.warning(f"Insights query for {group}/{stream} failed; falling back to filter_log_events: {e}")
+            found = { }
+    filter_pattern = ' '.join([ f'?"{IMPORT_LOG_PHASES[phase][0]}"' for phase in sorted(wanted) ])
+    logger.info(f"Checking log group {group} and stream {stream} for logs that match '{filter_pattern}' between {start_time} and {end_time}")
+    scanner = scanner or LogScanner(logs_client)
+    for event in scanner.scan(group, start_time, end_time, filter_pattern, stream_names=[stream]):
+        phase = match_import_phase(event['message'])
+        if phase in wanted and phase not in found:
+            found[phase] = event['timestamp']
+            if len(found) == len(wanted):
+                break
+    return found
 
 def get_task(ecs_client, cluster: str, task_arn: str) -> dict:
     tasks = ecs_client.describe_tasks(cluster=cluster, tasks=[task_arn])['tasks']
     return tasks[0]
 
-def taken_too_long(start_time: int, ttl_minutes: int = 15) -> bool:
+def taken_too_long(start_time: int, ttl_minutes: float = 15) -> bool:
     return (get_timestamp_now() - start_time) > (ttl_minutes * 60 * 1000)
\ No newline at end of file
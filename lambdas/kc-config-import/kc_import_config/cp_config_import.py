@@ -1,24 +1,76 @@
-import boto3, os, re
+import os, re, json, time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple
 from . import logger
+from .startup import get_client, profile_cold_start
+from .log_query import LogsInsightsQuery
+from .task_definitions import task_definition_resolver
+from .import_tracker import ImportTracker, ImportState, SsmDurationHistory, DEFAULT_TRACKER_PATH, predict_import_timeout_ms, predict_import_duration_ms
 from .config_importer import (
     stop_task,
     run_task,
-    kc_finished_importing,
+    find_import_phases,
+    IMPORT_LOG_PHASES,
     get_timestamp,
     get_timestamp_now,
-    get_task,
     get_task_logs_location,
     find_task,
     taken_too_long
 )
 
-logs_client = boto3.client('logs')
-ecs_client = boto3.client('ecs')
 logger.info("Container initialization completed")
 
+# aws clients are built lazily (and cached) so the cold start doesn't pay for them up front
+def get_logs_client():
+    return get_client('logs')
+
+def get_ecs_client():
+    return get_client('ecs')
+
+def get_lambda_client():
+    return get_client('lambda')
+
+def get_ssm_client():
+    return get_client('ssm')
+
+# the lambda only gets 45s (most of which a first poll can spend on the realm sync) so insights gets less time here than in the api proxy lambdas
+DEFAULT_LOG_QUERY_TIMEOUT = 10
+
+# LogQueryBackend=insights checks for the import finished message with a logs insights query
+# instead of filter_log_events (which it still falls back to)
+def get_insights_query() -> LogsInsightsQuery:
+    if os.environ.get('LogQueryBackend', 'filter') != 'insights':
+        return None
+    return LogsInsightsQuery(get_logs_client(), timeout=float(os.environ.get('LogQueryTimeout', DEFAULT_LOG_QUERY_TIMEOUT)))
+
+# keeps this far from the lambda timeout while waiting on an import inside one invocation
+INVOCATION_SAFETY_MARGIN_MS = 5000
+# rough allowance for the filter_log_events scan a finished check does (or falls back to)
+FILTER_SCAN_BUDGET_MS = 2000
+INITIAL_WAIT_DELAY = 1
+MAX_WAIT_DELAY = 4
+
+_import_tracker = None
+
+# one tracker per container so warm invocations skip the file too; ImportTrackerPath 'memory' skips it altogether.
+# Durations also go to the ImportDurationsSsmPath parameter when set, since the file only lives as long as the container
+def get_import_tracker() -> ImportTracker:
+    global _import_tracker
+    if _import_tracker is None:
+        path = os.environ.get('ImportTrackerPath', DEFAULT_TRACKER_PATH)
+        durations_path = os.environ.get('ImportDurationsSsmPath')
+        duration_history = SsmDurationHistory(get_ssm_client(), durations_path) if durations_path else None
+        _import_tracker = ImportTracker(None if path == 'memory' else path, duration_history=duration_history)
+    return _import_tracker
+
 SUCCESSFUL_STOP_REASON = "Successfully imported config to kc"
 UNSUCCESSFUL_STOP_REASON = "Import took longer than we want to wait"
+GROUP_FAILED_STOP_REASON = "Another import in the same group failed"
+DEFAULT_IMPORTER_CONTAINER_NAME = 'KC-Config-Importer'
+DEFAULT_KEYCLOAK_CONTAINER_NAME = 'Navex-Keycloak-Config'
+MAX_FANOUT_WORKERS = 8
+# the realm sync lambda's own timeout; it isn't started with less than this (plus the margin) left
+REALM_SYNC_TIMEOUT_MS = 30000
 
 # This really isn't doing anything useful at all.. but i wanted to explicitly give it a type
 # since i'm considering having the generic cp invoke lambda helper consume the return value
@@ -65,26 +117,76 @@ def import_task_successfully_stopped(task: dict) -> bool:
 def import_task_still_starting_up(task: dict) -> bool:
     return task['lastStatus'] != 'RUNNING'
 
-def import_task_timed_out(task: dict, log_group, log_stream) -> bool:
-    task_timed_out = taken_too_long(get_timestamp(task['startedAt']))
-    return not kc_finished_importing(logs_client, log_group, log_stream) and task_timed_out
+# Scans from wherever the last poll got to (or from when the task started) up to now for the log
+# phases still missing, and moves the cursor along. Once the finished message has been seen it's
+# remembered and never rescanned.
+def import_task_finished(task: dict, state: ImportState) -> bool:
+    if not state.finished:
+        scan_end = get_timestamp_now()
+        scan_start = state.log_cursor or get_timestamp(task['startedAt'])
+        missing_phases = [ phase for phase in IMPORT_LOG_PHASES if phase not in state.phases ]
+        found = find_import_phases(get_logs_client(), state.log_group, state.log_stream, scan_start, scan_end, missing_phases, insights=get_insights_query())
+        for phase, timestamp in found.items():
+            state.record_phase(phase, timestamp)
+        state.finished = 'importFinished' in state.phases
+        state.advance_log_cursor(scan_end)
+    return state.finished
 
-def import_task_still_importing(task: dict, log_group, log_stream) -> bool:
-    task_timed_out = taken_too_long(get_timestamp(task['startedAt']))
-    return not kc_finished_importing(logs_client, log_group, log_stream) and not task_timed_out
+def record_task_phases(task: dict, state: ImportState) -> None:
+    if task.get('createdAt'):
+        state.record_phase('provisioning', get_timestamp(task['createdAt']))
+    if task.get('startedAt'):
+        state.record_phase('containerStarted', get_timestamp(task['startedAt']))
 
-def handler(event, context):
-    cluster = os.environ['Cluster']
-    task_definition = os.environ['TaskDefinition']
-    task_subnets = os.environ['TaskSubnets'].split(',')
-    logger.info(f"KC Config import lamba called with event: {event}")
-    import_id = get_startedby_id(event['ImportId'])
+# How long one import_task_finished call can take: the insights query when there is one, plus the scan
+def get_finished_check_budget_ms() -> int:
+    query_ms = 0
+    if os.environ.get('LogQueryBackend', 'filter') == 'insights':
+        query_ms = int(float(os.environ.get('LogQueryTimeout', DEFAULT_LOG_QUERY_TIMEOUT)) * 1000)
+    return query_ms + FILTER_SCAN_BUDGET_MS
+
+# CodePipeline decides when we get polled next, so an import that's due to finish any second would
+# otherwise sit there until the next poll. If history says it should be done before this invocation
+# runs out of time, keep checking here with a short backoff instead of returning in progress.
+def wait_for_import(task: dict, state: ImportState, context, durations: List[int]) -> bool:
+    expected_duration = predict_import_duration_ms(durations)
+    if context is None or expected_duration is None:
+        return state.finished
+    remaining_ms = lambda: context.get_remaining_time_in_millis() - INVOCATION_SAFETY_MARGIN_MS
+    expected_in_ms = state.phases['containerStarted'] + expected_duration - get_timestamp_now()
+    if expected_in_ms > remaining_ms():
+        return state.finished
+    # the sleep and the check after it both have to fit in what's left
+    check_budget_ms = get_finished_check_budget_ms()
+    delay = INITIAL_WAIT_DELAY
+    while not state.finished and remaining_ms() > delay * 1000 + check_budget_ms:
+        logger.info(f"Import expected to finish within {max(expected_in_ms, 0)}ms; checking again in {delay}s")
+        time.sleep(delay)
+        import_task_finished(task, state)
+        delay = min(delay * 2, MAX_WAIT_DELAY)
+    return state.finished
+
+# describe_tasks on the arn we already know about; only falls back to the list_tasks search when
+# there's nothing tracked or ecs has forgotten the task
+def get_tracked_task(ecs_client, cluster: str, import_id: str, state: ImportState) -> dict:
+    if state.task_arn:
+        tasks = ecs_client.describe_tasks(cluster=cluster, tasks=[state.task_arn])['tasks']
+        if tasks:
+            return tasks[0]
+        logger.info(f"Tracked task {state.task_arn} for import id {import_id} wasn't found; searching for it again")
+    return find_task(ecs_client, cluster, import_id)
+
+# One import task's worth of the handler: starts the task the first time, then reports on it
+def poll_import(ecs_client, cluster: str, task_definition: str, task_subnets: List[str], import_id: str, context, overrides: dict = None) -> dict:
+    tracker = get_import_tracker()
+    state = tracker.get(import_id)
     # Check if there is a running task with this import id already
-    task = find_task(ecs_client, cluster, import_id)
+    task = get_tracked_task(ecs_client, cluster, import_id, state)
     if not task:
         # kickoff import task if not
         logger.info(f"Unable to find previously started task with import id: {import_id} in cluster: {cluster}... starting one now")
-        task = run_task(ecs_client, cluster, task_subnets, task_definition, import_id)
+        task = run_task(ecs_client, cluster, task_subnets, task_definition, import_id, overrides)
+        tracker.save(ImportState(import_id, task['taskArn'], task['taskDefinitionArn']))
         message = f"Started {task['taskArn']} in cluster {cluster}"
         logger.info(message)
         return CodePipelineHelperResponse.in_progress(message)
@@ -93,7 +195,14 @@ def handler(event, context):
     task_status = task['lastStatus']
     task_arn = task['taskArn']
     logger.info(f"Found task {task_arn} previously started with import id {import_id} in cluster {cluster}")
-    log_group, log_stream = get_task_logs_location(ecs_client, task['taskDefinitionArn'], task_arn)
+    if state.task_arn != task_arn:
+        state = ImportState(import_id, task_arn, task['taskDefinitionArn'])
+    if not state.log_group:
+        state.log_group, state.log_stream = get_task_logs_location(ecs_client, task['taskDefinitionArn'], task_arn, os.environ.get('KeycloakContainerName', DEFAULT_KEYCLOAK_CONTAINER_NAME))
+        logger.info(f"Resolved logs for {task_arn} to {state.log_group}/{state.log_stream}; task definition cache: {task_definition_resolver.get_stats()}")
+    log_group, log_stream = state.log_group, state.log_stream
+    record_task_phases(task, state)
+    tracker.save(state)
     
     if import_task_failed(task):
         message = f"{task_arn} was found in unexpected stop state. Check {log_group}/{log_stream} for logs"
@@ -102,26 +211,145 @@ def handler(event, context):
     elif import_task_successfully_stopped(task):
         message = f"{task_arn} was stopped after successful import. Returning success since this is most likely a retry that should no-op"
         logger.warning(message)
-        return CodePipelineHelperResponse.succeeded(message)
+        return CodePipelineHelperResponse.succeeded(message, OutputVariables=dict(state.output_variables(), TaskArn=task_arn))
     elif import_task_still_starting_up(task):
         message = f"{task_arn} status {task_status} not in stable state; check again later..."
         logger.info(message)
         return CodePipelineHelperResponse.in_progress(message)
 
-    
-    if import_task_still_importing(task, log_group, log_stream):
+    # the finished check is the expensive bit so it only happens once per poll (unless we're waiting on it below)
+    durations = tracker.get_durations()
+    timeout_ms = predict_import_timeout_ms(durations)
+    finished = import_task_finished(task, state)
+    task_timed_out = taken_too_long(get_timestamp(task['startedAt']), timeout_ms / 60000)
+    if not finished and not task_timed_out:
+        finished = wait_for_import(task, state, context, durations)
+    tracker.save(state)
+    if not finished and not task_timed_out:
         message = f"KC Import config task ({task_arn}) still running through startup/import process; check again later..."
         logger.info(message)
         return CodePipelineHelperResponse.in_progress(message)
-    elif import_task_timed_out(task, log_group, log_stream):
-        message = f"KC Import config task ({task_arn}) still not done importing and we are done waiting"
+    elif not finished:
+        message = f"KC Import config task ({task_arn}) still not done importing after {timeout_ms}ms and we are done waiting; phases so far: {state.phases}"
         logger.warning(message)
         stop_task(ecs_client, cluster, task_arn, UNSUCCESSFUL_STOP_REASON)
         return CodePipelineHelperResponse.failed(message)
 
     # if here then the task is running as expected and has completed the import process
     # so it needs to get stopped
-    message = f"{task_arn} has successfully finished importing config; stopping it..."
+    tracker.record_duration(state)
+    message = f"{task_arn} has successfully finished importing config in {state.import_duration_ms()}ms; stopping it..."
     logger.info(message)
     stop_task(ecs_client, cluster, task_arn, SUCCESSFUL_STOP_REASON )
-    return CodePipelineHelperResponse.succeeded(message, OutputVariables={'TaskArn': task_arn})
\ No newline at end of file
+    output_variables = dict(state.output_variables(), TaskArn=task_arn, ImportTimeoutMs=str(timeout_ms))
+    return CodePipelineHelperResponse.succeeded(message, OutputVariables=output_variables)
+
+# Everything in the config bucket gets imported by one task unless the event (Imports) or the
+# ImportUnits env var lists units to fan out over. A unit ending in / is a bucket prefix (a variant
+# directory); anything else is a realm name and only that realm's files get synced. Units run as
+# separate tasks at the same time so they must not share realms; keycloak imports a realm
+# by overwriting it and two tasks doing that to the same realm at once will not end well.
+def get_import_units(event: dict) -> List[str]:
+    units = event.get('Imports') or [ unit for unit in os.environ.get('ImportUnits', '').split(',') if unit ]
+    return [ unit.strip() for unit in units ]
+
+def get_import_unit_overrides(unit: str) -> dict:
+    if unit.endswith('/'):
+        environment = [ {'name': 'S3_CONFIG_PREFIX', 'value': unit} ]
+    else:
+        environment = [ {'name': 'S3_SYNC_FILTER', 'value': f'--exclude * --include {unit}-realm.json --include {unit}-users-*.json'} ]
+    return {
+        'containerOverrides': [
+            {
+                'name'       : os.environ.get('ImporterContainerName', DEFAULT_IMPORTER_CONTAINER_NAME),
+                'environment': environment
+            }
+        ]
+    }
+
+# Polls every unit's import at once and reports on them as a group: in progress until every one
+# has finished, failed (and the rest stopped) as soon as any one fails. The whole thing takes as
+# long as the slowest import instead of all of them back to back.
+def poll_import_group(ecs_client, cluster: str, task_definition: str, task_subnets: List[str], import_id: str, units: List[str], context) -> dict:
+    unit_ids = { unit: get_startedby_id(f"{import_id}-{index}") for index, unit in enumerate(units) }
+    with ThreadPoolExecutor(max_workers=min(len(units), MAX_FANOUT_WORKERS), thread_name_prefix='kc-import') as pool:
+        futures = {
+            unit: pool.submit(poll_import, ecs_client, cluster, task_definition, task_subnets, unit_id, context, get_import_unit_overrides(unit))
+            for unit, unit_id in unit_ids.items()
+        }
+        responses = { unit: future.result() for unit, future in futures.items() }
+
+    failed = [ unit for unit, response in responses.items() if not response['Success'] ]
+    waiting = [ unit for unit, response in responses.items() if response['Success'] and response['InProgress'] ]
+    if failed:
+        tracker = get_import_tracker()
+        for unit in waiting:
+            task_arn = tracker.get(unit_ids[unit]).task_arn
+            if task_arn:
+                stop_task(ecs_client, cluster, task_arn, GROUP_FAILED_STOP_REASON)
+        message = f"Import(s) {failed} failed; stopped {waiting}: " + '; '.join([ f"{unit}: {responses[unit]['Message']}" for unit in failed ])
+        logger.warning(message)
+        return CodePipelineHelperResponse.failed(message)
+    if waiting:
+        message = f"{len(units) - len(waiting)}/{len(units)} import(s) finished; still waiting on {waiting}"
+        logger.info(message)
+        return CodePipelineHelperResponse.in_progress(message)
+
+    output_variables = { }
+    for index, unit in enumerate(units):
+        for name, value in (responses[unit]['OutputVariables'] or {}).items():
+            output_variables[f"Import{index}{name}"] = value
+    message = f"All {len(units)} import(s) finished: {units}"
+    logger.info(message)
+    return CodePipelineHelperResponse.succeeded(message, OutputVariables=output_variables)
+
+# Whether any of the import's tasks was already started (by this container or an earlier one)
+def import_started(ecs_client, cluster: str, startedby_ids: List[str]) -> bool:
+    tracker = get_import_tracker()
+    return any(tracker.get(startedby_id).task_arn or find_task(ecs_client, cluster, startedby_id) for startedby_id in startedby_ids)
+
+# The realm sync lambda (RealmSyncFunction) gets first go at an import. When every change in the
+# realm files is one the admin api can make it makes them and there's no import task to wait on;
+# otherwise (or if the sync fails) the import task runs as usual and overwrites whatever it did.
+def sync_realms(import_id: str, units: List[str], context) -> dict:
+    function_name = os.environ.get('RealmSyncFunction')
+    if not function_name:
+        return None
+    if context is not None and context.get_remaining_time_in_millis() < REALM_SYNC_TIMEOUT_MS + INVOCATION_SAFETY_MARGIN_MS:
+        logger.warning(f"Not enough time left to wait on realm sync; importing {import_id} instead")
+        return None
+    logger.info(f"Trying realm sync through {function_name} before importing {import_id}")
+    try:
+        response = get_lambda_client().invoke(FunctionName=function_name, InvocationType='RequestResponse', Payload=json.dumps({'ImportId': import_id, 'Imports': units}))
+        summary = json.loads(response['Payload'].read())
+    except Exception as e:
+        logger.exception(e)
+        return None
+    if response.get('FunctionError'):
+        logger.warning(f"Realm sync failed ({summary}); importing {import_id} instead")
+        return None
+    if not summary.get('synced'):
+        logger.info(f"Realm sync can't handle these changes ({summary.get('fallbackReasons')}); importing {import_id} instead")
+        return None
+    changes = [ change for realm in summary['realms'] for change in realm['changes'] ]
+    message = f"Synced {len(changes)} change(s) to {[ realm['realmName'] for realm in summary['realms'] ]} through the admin api in {summary['durationMs']}ms; no import needed"
+    logger.info(f"{message}: {changes}")
+    return CodePipelineHelperResponse.succeeded(message, OutputVariables={'ImportMode': 'sync', 'SyncedChanges': str(len(changes))})
+
+@profile_cold_start
+def handler(event, context):
+    cluster = os.environ['Cluster']
+    task_definition = os.environ['TaskDefinition']
+    task_subnets = os.environ['TaskSubnets'].split(',')
+    logger.info(f"KC Config import lamba called with event: {event}")
+    ecs_client = get_ecs_client()
+    units = get_import_units(event)
+    startedby_ids = [ get_startedby_id(f"{event['ImportId']}-{index}") for index in range(len(units)) ] if units else [ get_startedby_id(event['ImportId']) ]
+    # only before anything's been started; a sync racing a running import would be undone by it
+    if os.environ.get('RealmSyncFunction') and not import_started(ecs_client, cluster, startedby_ids):
+        response = sync_realms(event['ImportId'], units, context)
+        if response:
+            return response
+    if units:
+        return poll_import_group(ecs_client, cluster, task_definition, task_subnets, event['ImportId'], units, context)
+    return poll_import(ecs_client, cluster, task_definition, task_subnets, get_startedby_id(event['ImportId']), context)
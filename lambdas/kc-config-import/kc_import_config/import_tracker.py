@@ -0,0 +1,207 @@
+import os, json, time, tempfile, threading, logging
+from typing import List
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_TRACKER_PATH = '/tmp/kc-import-tracker.json'
+DEFAULT_TRACKER_TTL_SECONDS = 24 * 60 * 60
+# log events can show up a bit after their timestamp so every scan rereads this much of the last one
+LOG_CURSOR_OVERLAP_MS = 2 * 60 * 1000
+# how many finished import durations are kept around to predict the next one from
+DURATION_HISTORY_SIZE = 20
+DEFAULT_IMPORT_TIMEOUT_MS = 15 * 60 * 1000
+MIN_IMPORT_TIMEOUT_MS = 5 * 60 * 1000
+MAX_IMPORT_TIMEOUT_MS = 30 * 60 * 1000
+# import phases in the order they happen; all epoch ms
+IMPORT_PHASES = ['provisioning', 'containerStarted', 'keycloakBoot', 'importFinished']
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+# Stop waiting once an import has taken well past what imports usually take (p90 with 50% headroom),
+# clamped so one weird history can't make it silly in either direction. Until there's enough history
+# it's the old fixed 15 minutes.
+def predict_import_timeout_ms(durations: List[int], min_samples: int = 3, headroom: float = 1.5) -> int:
+    if len(durations) < min_samples:
+        return DEFAULT_IMPORT_TIMEOUT_MS
+    return int(min(MAX_IMPORT_TIMEOUT_MS, max(MIN_IMPORT_TIMEOUT_MS, percentile(durations, 0.9) * headroom)))
+
+def predict_import_duration_ms(durations: List[int], min_samples: int = 3) -> int:
+    return int(percentile(durations, 0.5)) if len(durations) >= min_samples else None
+
+# What we know about one import between codepipeline polls so the next poll doesn't have to
+# go looking for it again
+class ImportState( ):
+    def __init__(self, import_id: str, task_arn: str = None, task_definition_arn: str = None, log_group: str = None, log_stream: str = None,
+                 log_cursor: int = None, finished: bool = False, updated_at: float = None, phases: dict = None, duration_recorded: bool = False):
+        self.import_id = import_id
+        self.task_arn = task_arn
+        self.task_definition_arn = task_definition_arn
+        self.log_group = log_group
+        self.log_stream = log_stream
+        # epoch ms the next "finished" scan starts from
+        self.log_cursor = log_cursor
+        self.finished = finished
+        self.updated_at = updated_at
+        self.phases = dict(phases or {})
+        self.duration_recorded = duration_recorded
+    def to_dict(self):
+        return {
+            'importId'         : self.import_id,
+            'taskArn'          : self.task_arn,
+            'taskDefinitionArn': self.task_definition_arn,
+            'logGroup'         : self.log_group,
+            'logStream'        : self.log_stream,
+            'logCursor'        : self.log_cursor,
+            'finished'         : self.finished,
+            'updatedAt'        : self.updated_at,
+            'phases'           : self.phases,
+            'durationRecorded' : self.duration_recorded
+        }
+    @classmethod
+    def from_dict(cls, state: dict) -> 'ImportState':
+        return cls(state['importId'], state.get('taskArn'), state.get('taskDefinitionArn'), state.get('logGroup'), state.get('logStream'),
+                   state.get('logCursor'), state.get('finished', False), state.get('updatedAt'), state.get('phases'),
+                   state.get('durationRecorded', False))
+    def advance_log_cursor(self, scanned_until: int) -> None:
+        self.log_cursor = max(self.log_cursor or 0, scanned_until - LOG_CURSOR_OVERLAP_MS)
+    def record_phase(self, phase: str, timestamp: int) -> None:
+        # first sighting wins; retries shouldn't move a phase
+        if timestamp is not None and phase not in self.phases:
+            self.phases[phase] = timestamp
+    def import_duration_ms(self) -> int:
+        # container start to import finished; the same span the timeout is measured over
+        if 'containerStarted' in self.phases and 'importFinished' in self.phases:
+            return self.phases['importFinished'] - self.phases['containerStarted']
+        return None
+    def output_variables(self) -> dict:
+        # codepipeline output variables have to be strings
+        variables = { f"{phase[0].upper()}{phase[1:]}At": str(self.phases[phase]) for phase in IMPORT_PHASES if phase in self.phases }
+        if self.import_duration_ms() is not None:
+            variables['ImportDurationMs'] = str(self.import_duration_ms())
+        return variables
+
+def is_parameter_not_found(e: Exception) -> bool:
+    # botocore ClientError; avoiding the import so this doesn't care which aws lib raised it
+    error = getattr(e, 'response', None) or {}
+    return isinstance(error, dict) and error.get('Error', {}).get('Code') == 'ParameterNotFound'
+
+# The durable copy of the duration history: a small json list in an ssm parameter so every
+# execution environment (and every cold start) predicts from the same imports.
+class SsmDurationHistory( ):
+    def __init__(self, ssm_client, parameter_name: str):
+        self.ssm_client = ssm_client
+        self.parameter_name = parameter_name
+
+    def load(self) -> List[int]:
+        try:
+            value = self.ssm_client.get_parameter(Name=self.parameter_name)['Parameter']['Value']
+        except Exception as e:
+            if is_parameter_not_found(e):
+                return [ ]
+            raise
+        return [ int(duration) for duration in json.loads(value) ][-DURATION_HISTORY_SIZE:]
+
+    def save(self, durations: List[int]) -> None:
+        self.ssm_client.put_parameter(
+            Name=self.parameter_name,
+            Description='Recent keycloak config import durations (ms)',
+            Value=json.dumps(durations[-DURATION_HISTORY_SIZE:]),
+            Type='String',
+            Overwrite=True
+        )
+
+# Import states keyed by import id plus the durations of the last few finished imports. Kept in
+# memory for warm invocations and mirrored to a file (when given a path) as a best effort cache; /tmp
+# belongs to one lambda execution environment, so it only helps invocations that land on that same
+# environment and nothing else should count on it. Nothing in here is the source of truth; losing it
+# just means one poll does the full lookup again. The durations are the exception: given a
+# duration_history they're read from and written through to it, and the file only caches them.
+class ImportTracker( ):
+    def __init__(self, path: str = None, ttl_seconds: float = DEFAULT_TRACKER_TTL_SECONDS, duration_history: SsmDurationHistory = None):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.duration_history = duration_history
+        self._states = None
+        self._durations = [ ]
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        if self._states is not None:
+            return self._states
+        self._states = { }
+        self._durations = [ ]
+        if self.path:
+            try:
+                with open(self.path) as f:
+                    saved = json.load(f)
+                self._states = saved.get('imports', { })
+                self._durations = saved.get('durations', [ ])
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                logger.warning(f"Import tracker file {self.path} is unreadable; starting fresh")
+        self._durations = self._load_durations(self._durations)
+        return self._states
+
+    def _load_durations(self, fallback: List[int]) -> List[int]:
+        if not self.duration_history:
+            return fallback
+        try:
+            return self.duration_history.load()
+        except Exception as e:
+            logger.warning(f"Unable to read import duration history; using the {len(fallback)} cached: {e}")
+            return fallback
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.import-tracker-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'imports': self._states, 'durations': self._durations}, f)
+        os.replace(temp_path, self.path)
+
+    def get(self, import_id: str) -> ImportState:
+        with self._lock:
+            state = self._load().get(import_id)
+        return ImportState.from_dict(state) if state else ImportState(import_id)
+
+    def _put(self, state: ImportState) -> None:
+        states = self._load()
+        now = time.time()
+        state.updated_at = now
+        states[state.import_id] = state.to_dict()
+        # old imports are never polled again so they get dropped on the way through
+        for import_id in [ i for i, s in states.items() if (s.get('updatedAt') or 0) < now - self.ttl_seconds ]:
+            del states[import_id]
+        self._save()
+
+    def save(self, state: ImportState) -> None:
+        with self._lock:
+            self._put(state)
+
+    def get_durations(self) -> List[int]:
+        with self._lock:
+            self._load()
+            return list(self._durations)
+
+    def record_duration(self, state: ImportState) -> None:
+        with self._lock:
+            self._load()
+            # a retried poll on an already finished import must not count it twice
+            if state.duration_recorded or state.import_duration_ms() is None:
+                return
+            # re-read so imports other environments finished since our load aren't overwritten
+            durations = self._load_durations(self._durations)
+            self._durations = (durations + [ state.import_duration_ms() ])[-DURATION_HISTORY_SIZE:]
+            if self.duration_history:
+                try:
+                    self.duration_history.save(self._durations)
+                except Exception as e:
+                    logger.warning(f"Unable to save import duration history; only the local cache has it: {e}")
+            state.duration_recorded = True
+            self._put(state)
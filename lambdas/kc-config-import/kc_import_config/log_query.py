@@ -0,0 +1,64 @@
+import time, logging
+from typing import Callable, List
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_QUERY_TIMEOUT = 30
+DEFAULT_RESULT_LIMIT = 10000
+FINISHED_QUERY_STATUSES = ['Complete', 'Failed', 'Cancelled', 'Timeout', 'Unknown']
+
+class InsightsQueryError(Exception):
+    pass
+
+# Runs a Logs Insights query and polls until it's done. The aggregation happens on aws's side so
+# only the result rows come back over the wire. Rows come back as plain dicts of field -> value
+# (the @ptr field insights tacks on is dropped). Callers are expected to fall back to
+# filter_log_events when this raises; insights can lag ingestion and isn't in every account's
+# budget. Anything with start_query/get_query_results/stop_query works as the client.
+class LogsInsightsQuery( ):
+    def __init__(self, logs_client, poll_interval: float = DEFAULT_POLL_INTERVAL, timeout: float = DEFAULT_QUERY_TIMEOUT,
+                 limit: int = DEFAULT_RESULT_LIMIT, sleep: Callable[[float], None] = time.sleep, clock: Callable[[], float] = time.monotonic):
+        self.logs_client = logs_client
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.limit = limit
+        self.sleep = sleep
+        self.clock = clock
+        self.stats = {'queries': 0, 'polls': 0, 'rows': 0, 'bytesScanned': 0}
+
+    def get_stats(self) -> dict:
+        return dict(self.stats)
+
+    def run(self, log_group_names: List[str], query_string: str, start_ms: int, end_ms: int) -> List[dict]:
+        # insights wants epoch seconds; rounding outwards so the window never shrinks
+        query_id = self.logs_client.start_query(
+            logGroupNames = log_group_names,
+            startTime     = start_ms // 1000,
+            endTime       = -(-end_ms // 1000),
+            queryString   = query_string,
+            limit         = self.limit
+        )['queryId']
+        self.stats['queries'] += 1
+        deadline = self.clock() + self.timeout
+        while True:
+            response = self.logs_client.get_query_results(queryId=query_id)
+            self.stats['polls'] += 1
+            if response['status'] in FINISHED_QUERY_STATUSES:
+                break
+            if self.clock() >= deadline:
+                try:
+                    self.logs_client.stop_query(queryId=query_id)
+                except Exception as e:
+                    logger.warning(f"Unable to stop insights query {query_id}: {e}")
+                raise InsightsQueryError(f"Insights query {query_id} still {response['status']} after {self.timeout}s")
+            self.sleep(self.poll_interval)
+        if response['status'] != 'Complete':
+            raise InsightsQueryError(f"Insights query {query_id} finished with status {response['status']}")
+        rows = [ { field['field']: field['value'] for field in row if field['field'] != '@ptr' } for row in response['results'] ]
+        self.stats['rows'] += len(rows)
+        self.stats['bytesScanned'] += int(response.get('statistics', {}).get('bytesScanned', 0))
+        if len(rows) >= self.limit:
+            logger.warning(f"Insights query {query_id} hit the {self.limit} row limit; results are probably truncated")
+        return rows
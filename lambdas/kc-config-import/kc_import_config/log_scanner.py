@@ -0,0 +1,128 @@
+import heapq, threading, logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_SCAN_WORKERS = 4
+DEFAULT_SLICE_MS = 5 * 60 * 1000
+
+def event_order(event: dict) -> Tuple[int,str]:
+    return (event['timestamp'], event.get('eventId', ''))
+
+def split_time_range(start_ms: int, end_ms: int, slice_ms: int) -> List[Tuple[int,int]]:
+    # inclusive bounds on both ends (that's how filter_log_events treats them) so slices can't overlap
+    slices = [ ]
+    slice_start = start_ms
+    while slice_start <= end_ms:
+        slice_end = min(slice_start + slice_ms - 1, end_ms)
+        slices.append((slice_start, slice_end))
+        slice_start = slice_end + 1
+    return slices
+
+# filter_log_events over a wide window on a busy group is one long serial pagination. This
+# splits [start_ms, end_ms] into slices (and optionally each slice into one shard per log
+# stream) and pages through the shards on a bounded pool. Events come back in timestamp order:
+# filter_log_events already pages through a shard in time order, so shards are merged page by
+# page and at most one page per shard (plus the first page of the next few slices) is held in
+# memory. Anything still queued is cancelled when the caller stops iterating early.
+class LogScanner( ):
+    def __init__(self, logs_client, max_workers: int = DEFAULT_SCAN_WORKERS, slice_ms: int = DEFAULT_SLICE_MS):
+        self.logs_client = logs_client
+        self.max_workers = max_workers
+        self.slice_ms = slice_ms
+        self._stats_lock = threading.Lock()
+        self.stats = {'shards': 0, 'pages': 0, 'events': 0}
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def _incr(self, stat: str, amount: int = 1) -> None:
+        with self._stats_lock:
+            self.stats[stat] += amount
+
+    def _get_stream_names(self, group: str, stream_prefix: str, start_ms: int, end_ms: int) -> List[str]:
+        # streams that can't have anything in the window are dropped up front
+        paginator = self.logs_client.get_paginator('describe_log_streams')
+        stream_names = [ ]
+        for page in paginator.paginate(logGroupName=group, logStreamNamePrefix=stream_prefix):
+            for stream in page['logStreams']:
+                if stream.get('firstEventTimestamp', start_ms) > end_ms or stream.get('lastEventTimestamp', end_ms) < start_ms:
+                    continue
+                stream_names.append(stream['logStreamName'])
+        return stream_names
+
+    def _fetch_page(self, filter_kwargs: dict, next_token: str = None) -> dict:
+        kwargs = dict(filter_kwargs, nextToken=next_token) if next_token else filter_kwargs
+        page = self.logs_client.filter_log_events(**kwargs)
+        self._incr('pages')
+        self._incr('events', len(page['events']))
+        # events sharing a millisecond can come back in any order within the page
+        page['events'].sort(key=event_order)
+        return page
+
+    def _start_shard(self, pool: ThreadPoolExecutor, filter_kwargs: dict) -> Tuple[dict,Future]:
+        self._incr('shards')
+        return filter_kwargs, pool.submit(self._fetch_page, filter_kwargs)
+
+    def _scan_shard(self, pool: ThreadPoolExecutor, filter_kwargs: dict, future: Future) -> Iterator[dict]:
+        # the next page is requested before this one is handed out, so one page of read ahead per shard
+        try:
+            while future is not None:
+                page = future.result()
+                next_token = page.get('nextToken')
+                future = pool.submit(self._fetch_page, filter_kwargs, next_token) if next_token else None
+                yield from page['events']
+        finally:
+            if future is not None:
+                future.cancel()
+
+    def _shard_kwargs(self, group: str, slice_start: int, slice_end: int, filter_pattern: str, stream_prefix: str, stream_names: List[str]) -> List[dict]:
+        base_kwargs = {
+            'logGroupName': group,
+            'startTime'   : slice_start,
+            'endTime'     : slice_end
+        }
+        if filter_pattern:
+            base_kwargs['filterPattern'] = filter_pattern
+        if stream_names is None:
+            if stream_prefix:
+                base_kwargs['logStreamNamePrefix'] = stream_prefix
+            return [ base_kwargs ]
+        return [ dict(base_kwargs, logStreamNames=[ stream_name ]) for stream_name in stream_names ]
+
+    def scan(self, group: str, start_ms: int, end_ms: int, filter_pattern: str = None, stream_prefix: str = None,
+             stream_names: List[str] = None, shard_by_stream: bool = False) -> Iterator[dict]:
+        if shard_by_stream and stream_names is None:
+            stream_names = self._get_stream_names(group, stream_prefix or '', start_ms, end_ms)
+        if stream_names is not None and not stream_names:
+            return
+        slices = split_time_range(start_ms, end_ms, self.slice_ms)
+        logger.info(f"Scanning log group {group} between {start_ms} and {end_ms} in {len(slices)} slice(s) across {len(stream_names) if stream_names else 1} shard(s) per slice with {self.max_workers} worker(s)")
+        pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='kc-logscan')
+        pending = deque()
+        remaining = iter(slices)
+        shards = [ ]
+        try:
+            while True:
+                # keep roughly one slice of read ahead per worker
+                while len(pending) < self.max_workers:
+                    next_slice = next(remaining, None)
+                    if next_slice is None:
+                        break
+                    pending.append([ self._start_shard(pool, kwargs) for kwargs in self._shard_kwargs(group, *next_slice, filter_pattern, stream_prefix, stream_names) ])
+                if not pending:
+                    return
+                # slices are disjoint in time so they only need merging shard against shard
+                shards = [ self._scan_shard(pool, kwargs, future) for kwargs, future in pending.popleft() ]
+                yield from heapq.merge(*shards, key=event_order)
+        finally:
+            for shard in shards:
+                shard.close()
+            for started in pending:
+                for _, future in started:
+                    future.cancel()
+            pool.shutdown(wait=False)
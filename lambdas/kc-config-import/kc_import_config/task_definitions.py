@@ -0,0 +1,72 @@
+import re, threading, logging
+from collections import OrderedDict
+from typing import List
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_MAX_TASK_DEFINITIONS = 32
+# family:revision (or the full arn ending in it); a bare family name means "latest" and can change
+REVISIONED_TASK_DEFINITION = re.compile(r':\d+$')
+
+class ContainerLogConfig( ):
+    def __init__(self, container_name: str, log_group: str, stream_prefix: str):
+        self.container_name = container_name
+        self.log_group = log_group
+        self.stream_prefix = stream_prefix
+    def stream_for_task(self, task_id: str) -> str:
+        # awslogs names streams prefix/container-name/ecs-task-id
+        return f"{self.stream_prefix}/{self.container_name}/{task_id}"
+    def to_dict(self):
+        return {
+            'containerName': self.container_name,
+            'logGroup'     : self.log_group,
+            'streamPrefix' : self.stream_prefix
+        }
+
+# describe_task_definition answers never change for a given revision, so they're kept (LRU,
+# bounded) for the life of the container. Containers that don't log with awslogs are left out
+# instead of blowing up on a missing logConfiguration.
+class TaskDefinitionResolver( ):
+    def __init__(self, max_entries: int = DEFAULT_MAX_TASK_DEFINITIONS):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries))
+
+    @staticmethod
+    def _log_configs(task_definition: dict) -> List[ContainerLogConfig]:
+        log_configs = [ ]
+        for container_def in task_definition['containerDefinitions']:
+            log_configuration = container_def.get('logConfiguration') or {}
+            options = log_configuration.get('options') or {}
+            if log_configuration.get('logDriver', 'awslogs') != 'awslogs' or 'awslogs-group' not in options:
+                logger.info(f"Container {container_def.get('name')} doesn't log to cloudwatch; ignoring it")
+                continue
+            log_configs.append(ContainerLogConfig(container_def['name'], options['awslogs-group'], options.get('awslogs-stream-prefix')))
+        return log_configs
+
+    def resolve(self, ecs_client, task_definition_arn: str) -> List[ContainerLogConfig]:
+        with self._lock:
+            if task_definition_arn in self._entries:
+                self._entries.move_to_end(task_definition_arn)
+                self.stats['hits'] += 1
+                return list(self._entries[task_definition_arn])
+            self.stats['misses'] += 1
+        task_definition = ecs_client.describe_task_definition(taskDefinition=task_definition_arn)['taskDefinition']
+        log_configs = self._log_configs(task_definition)
+        if not REVISIONED_TASK_DEFINITION.search(task_definition_arn):
+            return log_configs
+        with self._lock:
+            self._entries[task_definition_arn] = log_configs
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+        return list(log_configs)
+
+# module level so it lives as long as the container does
+task_definition_resolver = TaskDefinitionResolver()
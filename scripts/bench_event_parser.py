@@ -0,0 +1,39 @@
+# Micro-benchmark: old split based keycloak event parsing vs KeycloakEventParser
+#   python scripts/bench_event_parser.py [--lines 20000] [--repeat 5]
+import os, sys, argparse, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas', 'kc-api-proxy'))
+from kc_api_proxy.log_helpers import convert_log_message_to_dict, USER_LOCATION_PARSER
+
+# straight from the duplicate user alarm logs (see log_helpers)
+SAMPLE_LINE = (
+    "16:01:27,100 WARN  [org.keycloak.events] (default task-1493) type=IDENTITY_PROVIDER_FIRST_LOGIN_ERROR, realmId=navex, "
+    "clientId=cmd-backend, userId=1fc3d2c0-f472-4e6d-8d7e-86553caa499d, ipAddress=24.173.19.238, error=federated_identity_account_exists, "
+    "identity_provider=doorman, existing_username=c75c8c04-a60d-eb11-a96a-0050568ba3ec, "
+    "redirect_uri=https://maint.policytech.com/oidc/coderedirector/?ReturnUrl=https%3a%2f%2faplusfcu.policytech.com%2foidc%2fcodeconsumer%2f%3fReturnUrl%3d%252fdotNet%252fdocuments%252f%253fdocid%253d10910, "
+    "identity_provider_identity=c75c8c04-a60d-eb11-a96a-0050568ba3ec, code_id=d9bca038-41d7-4b20-ad7a-2c193f01e35d, "
+    "authSessionParentId=d9bca038-41d7-4b20-ad7a-2c193f01e35d, authSessionTabId=zVdvJj48L5Y"
+)
+
+def make_lines(count: int):
+    return [ SAMPLE_LINE.replace('1fc3d2c0', f"{i:08x}") for i in range(count) ]
+
+def split_parser(lines):
+    return [ (d['realmId'], d['userId']) for d in map(convert_log_message_to_dict, lines) ]
+
+def event_parser(lines):
+    return USER_LOCATION_PARSER.extract_many(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    lines = make_lines(args.lines)
+    assert split_parser(lines) == event_parser(lines)
+    results = { }
+    for name, func in [ ('split', split_parser), ('event_parser', event_parser) ]:
+        best = min(timeit.repeat(lambda: func(lines), number=1, repeat=args.repeat))
+        results[name] = best
+        print(f"{name:>13}: {best * 1000:8.1f}ms for {args.lines} lines ({best / args.lines * 1e6:.2f}us/line)")
+    print(f"      speedup: {results['split'] / results['event_parser']:.1f}x")
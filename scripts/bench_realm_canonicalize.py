@@ -0,0 +1,72 @@
+# Benchmark: the old jq export processing vs realm_canonicalize on a realm export padded out with
+# generated users and shuffled arrays
+#   python scripts/bench_realm_canonicalize.py [--users 20000] [--repeat 3]
+import os, sys, json, random, shutil, argparse, tempfile, timeit, subprocess
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'aws-inf'))
+sys.path.insert(0, os.path.join(REPO_DIR, 'scripts'))
+from realm_canonicalize import canonicalize_realm_file
+from bench_realm_stream import REALM_FILE, make_user
+
+# what Export-KeyCloakConfig.ps1 ran every export through (exportProcessing.jq)
+JQ_FILTER = 'del( .components."org.keycloak.keys.KeyProvider") | walk(if type == "array" then sort else . end)'
+
+def shuffled(value, rng: random.Random):
+    if isinstance(value, dict):
+        return { key: shuffled(item, rng) for key, item in value.items() }
+    if isinstance(value, list):
+        items = [ shuffled(item, rng) for item in value ]
+        rng.shuffle(items)
+        return items
+    return value
+
+def make_export_file(directory: str, users: int) -> str:
+    with open(REALM_FILE) as f:
+        realm_dict = json.load(f)
+    realm_dict['users'] = realm_dict.get('users', []) + [ make_user(i) for i in range(users) ]
+    path = os.path.join(directory, 'export.json')
+    with open(path, 'w') as f:
+        json.dump(shuffled(realm_dict, random.Random(0)), f, indent=2)
+    return path
+
+def jq_pipeline(source: str, output: str) -> None:
+    with open(output, 'w') as f:
+        subprocess.run([ 'jq', '-S', JQ_FILTER, source ], stdout=f, check=True)
+
+def canonicalizer(source: str, output: str) -> None:
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        canonicalize_realm_file(source, output)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    runs = [ ('canonicalizer', canonicalizer) ]
+    if shutil.which('jq'):
+        runs.insert(0, ('jq', jq_pipeline))
+    else:
+        print("jq isn't on the path; only timing the canonicalizer")
+    with tempfile.TemporaryDirectory() as directory:
+        source = make_export_file(directory, args.users)
+        print(f"export file: {os.path.getsize(source) / 1024 / 1024:.1f}MB with {args.users} generated users")
+        results = { }
+        outputs = { }
+        for name, func in runs:
+            output = os.path.join(directory, f"{name}.json")
+            best = min(timeit.repeat(lambda: func(source, output), number=1, repeat=args.repeat))
+            with open(output, encoding='utf-8') as f:
+                outputs[name] = json.load(f)
+            results[name] = best
+            print(f"{name:>14}: {best * 1000:8.1f}ms")
+        # same content either way; only the order of arrays of objects differs
+        if 'jq' in results:
+            assert outputs['jq'].keys() == outputs['canonicalizer'].keys()
+            assert sorted(u['id'] for u in outputs['jq']['users']) == sorted(u['id'] for u in outputs['canonicalizer']['users'])
+            print(f"       speedup: {results['jq'] / results['canonicalizer']:.1f}x")
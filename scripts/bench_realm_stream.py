@@ -0,0 +1,97 @@
+# Benchmark: whole-document load/dump vs the streaming realm writer for --disable-users with both
+# -o and -i, on a realm export padded out with generated users
+#   python scripts/bench_realm_stream.py [--users 50000] [--repeat 3]
+import os, sys, json, argparse, tempfile, timeit, tracemalloc
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'aws-inf'))
+import realm_transform
+from realm_stream import load_realm_sections, write_realm_file
+
+REALM_FILE = os.path.join(REPO_DIR, 'import', 'variants', 'keycloak-app', 'navex-realm.json')
+
+def make_user(i: int) -> dict:
+    return {
+        'id'              : f"{i:08x}-0000-4000-8000-000000000000",
+        'createdTimestamp': 1600000000000 + i,
+        'username'        : f"user-{i}",
+        'enabled'         : True,
+        'emailVerified'   : False,
+        'firstName'       : f"First{i}",
+        'lastName'        : f"Last{i}",
+        'email'           : f"user-{i}@example.com",
+        # every 50th one looks like a hardcoded account
+        'credentials'     : [ {'type': 'password', 'hashedSaltedValue': 'x' * 44, 'salt': 'y' * 24, 'hashIterations': 27500} ] if i % 50 == 0 else [ ],
+        'requiredActions' : [ ],
+        'realmRoles'      : [ 'offline_access', 'uma_authorization' ],
+        'clientRoles'     : {'account': [ 'view-profile', 'manage-account' ]},
+        'notBefore'       : 0,
+        'groups'          : [ ]
+    }
+
+def make_realm_file(directory: str, users: int) -> str:
+    with open(REALM_FILE) as f:
+        realm_dict = json.load(f)
+    realm_dict['users'] = realm_dict.get('users', []) + [ make_user(i) for i in range(users) ]
+    path = os.path.join(directory, 'realm.json')
+    with open(path, 'w') as f:
+        json.dump(realm_dict, f, indent=2)
+    return path
+
+def whole_document(path: str, output_path: str) -> None:
+    # what realm_transform did before: load everything, transform, dump once per output
+    realm_dict = realm_transform.load_json_file(path)
+    realm_transform.disable_users(realm_dict)
+    realm_transform.save_dict_as_json(output_path, realm_dict)
+    realm_transform.save_dict_as_json(path, realm_dict)
+
+def streaming(path: str, output_path: str) -> None:
+    load_realm_sections(path, [])
+    write_realm_file(path, [ output_path, path ], element_transforms={'users': realm_transform.disable_user})
+
+def quietly(func, *args):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        func(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def peak_memory(func, *args) -> int:
+    tracemalloc.start()
+    try:
+        quietly(func, *args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        source = make_realm_file(directory, args.users)
+        with open(source) as f:
+            original = f.read()
+        print(f"realm file: {len(original) / 1024 / 1024:.1f}MB with {args.users} generated users")
+        results = { }
+        outputs = { }
+        for name, func in [ ('whole_document', whole_document), ('streaming', streaming) ]:
+            output = os.path.join(directory, f"{name}.json")
+            def run():
+                with open(source, 'w') as f:
+                    f.write(original)
+                quietly(func, source, output)
+            best = min(timeit.repeat(run, number=1, repeat=args.repeat))
+            with open(output) as f:
+                outputs[name] = f.read()
+            with open(source, 'w') as f:
+                f.write(original)
+            peak = peak_memory(func, source, output)
+            results[name] = (best, peak)
+            print(f"{name:>15}: {best * 1000:8.1f}ms, peak {peak / 1024 / 1024:7.1f}MB traced")
+        assert outputs['whole_document'] == outputs['streaming']
+        print(f"        speedup: {results['whole_document'][0] / results['streaming'][0]:.1f}x, "
+              f"memory: {results['whole_document'][1] / results['streaming'][1]:.1f}x less")